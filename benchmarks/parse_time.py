@@ -0,0 +1,77 @@
+"""
+parse_time.py
+
+Compare !schedule's time parsing before (parsedatetime for everything, and a
+fresh pytz timezone per call) and after (robohound.timeparse)
+
+Run from the repository root:
+    python -m benchmarks.parse_time [rounds]
+"""
+import sys
+import time
+import datetime
+
+import parsedatetime
+import pytz
+
+from robohound import timeparse
+
+
+# What people actually type, roughly in proportion
+EXPRESSIONS = [
+    'in 2 hours', 'in 30 minutes', 'in an hour', 'in 10 minutes',
+    'in 1 day', 'in 3 days', 'in a week', 'in 2 hours and 30 minutes',
+    'tomorrow at 7PM', 'tomorrow at 9am', 'tomorrow at 12:30 pm',
+    'today at 5pm', 'at 8pm', '6:45pm', 'at 19:00', 'noon', 'tonight',
+    'friday at 3pm', 'on monday at 9AM', 'tomorrow',
+    # These still go to parsedatetime
+    'next monday', 'in 1 month', 'on November 12th at 10AM',
+]
+
+TZ = 'US/Eastern'
+
+
+def before(cal, text):
+    tz = pytz.timezone(TZ)
+    dt, _ = cal.parseDT(datetimeString=text)
+    return dt.astimezone(tz)
+
+
+def after(cal, text):
+    return timeparse.parse(text, cal).astimezone(timeparse.timezone(TZ))
+
+
+def run(parse, cal, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in EXPRESSIONS:
+            parse(cal, text)
+    return rounds * len(EXPRESSIONS) / (time.perf_counter() - start)
+
+
+def check(cal):
+    """The fast path has to agree with parsedatetime"""
+    now = datetime.datetime.now().replace(microsecond=0)
+    for text in EXPRESSIONS:
+        fast = timeparse.parse(text, cal, now)
+        slow, _ = cal.parseDT(datetimeString=text, sourceTime=now)
+        if fast != slow:
+            raise AssertionError(f'{text!r}: {fast} != {slow}')
+
+
+def main(rounds=200):
+    cal = parsedatetime.Calendar()
+    check(cal)
+
+    fast = sum(timeparse.compile_template(timeparse.normalise(e)[0])
+               is not None for e in EXPRESSIONS)
+    print(f'{fast}/{len(EXPRESSIONS)} expressions take the fast path')
+
+    slow_rate = run(before, cal, rounds)
+    fast_rate = run(after, cal, rounds)
+    print(f'before: {slow_rate:10.0f} parses/s')
+    print(f'after:  {fast_rate:10.0f} parses/s ({fast_rate / slow_rate:.1f}x)')
+
+
+if __name__ == '__main__':
+    main(*(int(a) for a in sys.argv[1:]))
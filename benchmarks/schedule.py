@@ -0,0 +1,367 @@
+"""
+schedule.py
+
+Benchmark and soak test for the schedule extension, driven by a stand-in bot
+on top of EmbeddedDb, so no Discord connection or Redis server is needed
+
+Run from the repository root:
+    python -m benchmarks.schedule [sizes...] [--output FILE] [--soak SECONDS]
+
+For each size it measures load time, resident memory per loaded item, insert
+and cancel throughput, listing latency and dispatch jitter (how late items
+fire compared to when they were due).  With --soak it then keeps adding,
+canceling and firing items for that long, sampling memory and jitter, to
+show leaks and slowdowns.  Results are written as JSON.
+"""
+import sys
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import platform
+import resource
+import subprocess
+
+from robohound.embedded import EmbeddedDb
+from robohound.extensions.schedule import Schedule, SAVED_CODEC
+
+
+SERVERS = 10
+CHANNELS_PER_SERVER = 10
+AUTHORS = 1000
+
+# Items are spread over twice the schedule's load horizon, so about half of
+#   them are loaded into memory
+SPREAD = 2 * Schedule.LOAD_HORIZON
+
+INSERTS = 5000
+LISTINGS = 200
+JITTER_ITEMS = 500
+JITTER_WINDOW = 3
+
+
+class FakeServer:
+    def __init__(self, id):
+        self.id = id
+        self.name = f'server {id}'
+        self.members = {}
+
+    def get_member(self, id):
+        return self.members.get(id)
+
+
+class FakeChannel:
+    def __init__(self, id, server):
+        self.id = id
+        self.server = server
+        self.mention = f'<#{id}>'
+
+
+class FakeMember:
+    def __init__(self, id):
+        self.id = id
+        self.name = f'member {id}'
+        self.mention = f'<@{id}>'
+        self.discriminator = '0000'
+
+
+class FakeBot:
+    """Just enough of RoboHound for the schedule extension"""
+    def __init__(self, loop, storage):
+        self.loop = loop
+        self.storage = storage
+        self.debug = False
+        self.log = logging.getLogger('benchmark')
+        self.metrics = []
+
+        self.servers = {}
+        self.channels = {}
+        for s in range(SERVERS):
+            server = FakeServer(str(10 ** 17 + s))
+            self.servers[server.id] = server
+            for c in range(CHANNELS_PER_SERVER):
+                channel = FakeChannel(str(2 * 10 ** 17 + s * 1000 + c), server)
+                self.channels[channel.id] = channel
+
+        self.authors = [FakeMember(str(3 * 10 ** 17 + a))
+                        for a in range(AUTHORS)]
+        for server in self.servers.values():
+            server.members.update((m.id, m) for m in self.authors)
+
+        # Called with (content, time) for every message sent
+        self.on_send = None
+        self.said = 0
+
+    async def wait_until_ready(self):
+        pass
+
+    def get_channel(self, id):
+        # discord.py walks every server to find a channel
+        for server in self.servers.values():
+            channel = self.channels.get(id)
+            if channel is not None and channel.server is server:
+                return channel
+        return None
+
+    def get_server(self, id):
+        return self.servers.get(id)
+
+    async def send_message(self, channel, content):
+        if self.on_send is not None:
+            self.on_send(content, time.time())
+        return content
+
+    async def add_reaction(self, message, emoji):
+        pass
+
+    async def process_commands(self, message):
+        pass
+
+    async def say(self, content, delete_after=None):
+        self.said += 1
+
+    def type(self):
+        pass
+
+
+def rss():
+    """Resident memory of this process in bytes"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # Peak, rather than current, resident memory
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {}
+    def at(q):
+        return values[min(int(q * len(values)), len(values) - 1)]
+    return {'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99),
+            'max': values[-1], 'mean': sum(values) / len(values)}
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always',
+            '--dirty'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def random_item(sched, bot, when):
+    channel = random.choice(list(bot.channels.values()))
+    author = random.choice(bot.authors)
+    return sched.decode_saved(
+        content = f'reminder {random.getrandbits(32)}',
+        when = when,
+        channel = channel.id,
+        author = author.id,
+        server = channel.server.id,
+    )
+
+
+async def background_tasks(before):
+    """Wait for the tasks started since before to finish"""
+    pending = asyncio.Task.all_tasks() - before
+    if pending:
+        await asyncio.wait(pending)
+
+
+async def populate(storage, bot, size):
+    """Write size items straight into the database"""
+    sched_storage = storage.get_namespace('Schedule')
+    sched_storage.codecs.register(SAVED_CODEC)
+    now = time.time()
+    page = 10000
+    for start in range(0, size, page):
+        async with sched_storage.pipeline() as p:
+            for i in range(start, min(start + page, size)):
+                channel = random.choice(list(bot.channels.values()))
+                id_ = f'{i:032x}'
+                when = now + 120 + random.random() * SPREAD
+                p.hset_obj('items', id_, {
+                    'content': f'reminder {i}',
+                    'when': when,
+                    'channel': channel.id,
+                    'server': channel.server.id,
+                    'author': random.choice(bot.authors).id,
+                }, 'saved')
+                p.zadd('due', when, id_)
+
+
+async def wait_loaded(sched):
+    # The claimer only starts once load() has finished
+    while sched._claimer is None:
+        await asyncio.sleep(0.001)
+
+
+async def bench_size(loop, size):
+    # EmbeddedDb starts itself
+    db = EmbeddedDb(loop=loop, log=logging.getLogger('benchmark.storage'))
+    storage = db.get_namespace('')
+    await storage.ready()
+    bot = FakeBot(loop, storage)
+
+    await populate(storage, bot, size)
+    result = {'size': size}
+
+    # Load
+    mem_before = rss()
+    start = time.perf_counter()
+    sched = Schedule(bot)
+    await wait_loaded(sched)
+    result['load_seconds'] = time.perf_counter() - start
+    result['loaded'] = len(sched._items)
+    result['rss_per_item'] = \
+        (rss() - mem_before) / max(result['loaded'], 1)
+
+    # Insert
+    later = time.time() + 3600
+    items = [random_item(sched, bot, later + i) for i in range(INSERTS)]
+    start = time.perf_counter()
+    for s in items:
+        await sched.add_saved(s)
+    result['insert_per_second'] = INSERTS / (time.perf_counter() - start)
+
+    # Cancel, including the database round trips it sets off
+    before = asyncio.Task.all_tasks()
+    start = time.perf_counter()
+    for s in items:
+        sched._cancel_saved(s)
+    await background_tasks(before)
+    result['cancel_per_second'] = INSERTS / (time.perf_counter() - start)
+
+    # Listing, both the first page and one deep in
+    class Ctx:
+        class command:
+            qualified_name = 'schedule admin list server'
+    server = next(iter(bot.servers))
+    pages = max(sched.indices['server'].count(server) // Schedule.PAGE_SIZE, 1)
+    for name, page in (('first', 1), ('middle', pages // 2 + 1)):
+        latencies = []
+        for _ in range(LISTINGS):
+            start = time.perf_counter()
+            await sched._say_page(Ctx, 'server', server, page, str)
+            latencies.append(time.perf_counter() - start)
+        result[f'list_{name}_page_seconds'] = percentiles(latencies)
+
+    result['dispatch_lag_seconds'] = await bench_jitter(sched, bot)
+
+    sched._Schedule__unload()
+    await db.close()
+    return result
+
+
+async def bench_jitter(sched, bot, count=JITTER_ITEMS, window=JITTER_WINDOW):
+    """Fire count items due over the next window seconds"""
+    due = {}
+    lags = []
+    done = asyncio.Event()
+
+    def on_send(content, at):
+        when = due.pop(content, None)
+        if when is not None:
+            lags.append(at - when)
+            if not due:
+                done.set()
+    bot.on_send = on_send
+
+    now = time.time()
+    for _ in range(count):
+        s = random_item(sched, bot, now + 0.5 + random.random() * window)
+        due[s.content] = s.timestamp
+        await sched.add_saved(s)
+
+    try:
+        await asyncio.wait_for(done.wait(), window + 2 * Schedule.POLL_INTERVAL)
+    except asyncio.TimeoutError:
+        pass
+    bot.on_send = None
+
+    result = percentiles(lags)
+    result['missed'] = len(due)
+    return result
+
+
+async def soak(loop, size, seconds, sample=10):
+    """Keep the schedule busy for seconds, sampling every sample seconds"""
+    # EmbeddedDb starts itself
+    db = EmbeddedDb(loop=loop, log=logging.getLogger('benchmark.storage'))
+    storage = db.get_namespace('')
+    await storage.ready()
+    bot = FakeBot(loop, storage)
+    await populate(storage, bot, size)
+
+    sched = Schedule(bot)
+    await wait_loaded(sched)
+
+    samples = []
+    end = time.time() + seconds
+    while time.time() < end:
+        # Churn: new items far out, some canceled, and a batch firing soon
+        items = [random_item(sched, bot, time.time() + random.random() *
+                 Schedule.LOAD_HORIZON) for _ in range(1000)]
+        for s in items:
+            await sched.add_saved(s)
+        for s in random.sample(items, 500):
+            sched._cancel_saved(s)
+
+        jitter = await bench_jitter(sched, bot, 100, 1)
+        samples.append({
+            'elapsed': seconds - (end - time.time()),
+            'rss': rss(),
+            'in_memory': len(sched._items),
+            'queue': len(sched._queue),
+            'dispatch_lag_p99': jitter.get('p99'),
+            'missed': jitter['missed'],
+        })
+        await asyncio.sleep(sample)
+
+    sched._Schedule__unload()
+    await db.close()
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[3])
+    parser.add_argument('sizes', nargs='*', type=int,
+                        default=[10000, 100000])
+    parser.add_argument('--output', help='file for the JSON results')
+    parser.add_argument('--soak', type=float, default=0,
+                        help='seconds to soak for after the benchmarks')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    loop = asyncio.get_event_loop()
+
+    results = {
+        'version': version(),
+        'python': platform.python_version(),
+        'time': time.time(),
+        'benchmarks': [],
+    }
+    for size in args.sizes:
+        r = loop.run_until_complete(bench_size(loop, size))
+        print(json.dumps(r), file=sys.stderr)
+        results['benchmarks'].append(r)
+    if args.soak:
+        results['soak'] = loop.run_until_complete(
+            soak(loop, args.sizes[0], args.soak))
+
+    out = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out)
+    else:
+        print(out)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,10 +18,26 @@ client_secret = os.getenv('RH_BOT_CLIENT_SECRET')
 
 owner_id = os.getenv('RH_OWNER_ID')
 
-redis = os.getenv('RH_REDIS_PORT')
+storage = os.getenv('RH_STORAGE', 'redis')
+storage_path = os.getenv('RH_STORAGE_PATH', 'robohound.aof')
+
+redis = os.getenv('RH_REDIS_PORT', 6379)
+redis_pool_min = os.getenv('RH_REDIS_POOL_MIN', 1)
+redis_pool_max = os.getenv('RH_REDIS_POOL_MAX', 10)
 
 debug = os.getenv('RH_DEBUG')
 
+metrics_port = os.getenv('RH_METRICS_PORT')
+
+# Extension options, left at the extensions' defaults if not set
+config = {'Schedule': {}}
+schedule_horizon = os.getenv('RH_SCHEDULE_HORIZON')
+if schedule_horizon:
+    config['Schedule']['horizon'] = float(schedule_horizon)
+schedule_grace = os.getenv('RH_SCHEDULE_GRACE')
+if schedule_grace:
+    config['Schedule']['grace'] = float(schedule_grace)
+
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -38,6 +54,12 @@ logger.addHandler(handler)
 # Start the bot
 bot = RoboHound(
     redis_address = ('localhost', int(redis)),
+    redis_minsize = int(redis_pool_min),
+    redis_maxsize = int(redis_pool_max),
+    storage = storage,
+    storage_path = storage_path,
+    metrics_port = int(metrics_port) if metrics_port else None,
+    config = config,
     log = logger,
     owner_id = owner_id,
     debug = debug,
@@ -8,23 +8,19 @@ import os
 import re
 from discord.ext import commands
 
-from .utils import is_bot_ower
+from .utils import is_bot_ower, paginate
 
 class Extension:
     def __init__(self, bot):
         self.bot = bot
         self.log = bot.log.getChild(self.__class__.__name__)
-        self.storage = None
+        self.storage = self.bot.storage.get_namespace(self.__class__.__name__)
         
         self.bot.loop.create_task(self.init_storage())
     
     async def init_storage(self):
-        await self.bot.wait_until_ready()
-        self.storage = self.bot.storage.get_namespace(self.__class__.__name__)
-        self.log.debug('Storage initialized')
-        
-        result = await self.storage.set('_', self.__class__.__name__)
-        self.log.info(f'Storage up and running (test SET returned {result})')
+        await self.storage.ready()
+        self.log.info('Storage up and running')
 
 
 class Base(Extension):
@@ -36,6 +32,13 @@ class Base(Extension):
     EXT_PREFIX = 'robohound.extensions.'
     EXTENSION_FILENAME = re.compile('(?P<ext>\w+)\.py')
     
+    MESSAGE_LIMIT = 2000
+    SCAN_LIMIT = 100
+    
+    # Most rows !db stats shows in each table, and characters of each key
+    STATS_LIMIT = 50
+    STATS_KEY_WIDTH = 100
+    
     @commands.command()
     async def about(self):
         """Print a short message about the bot"""
@@ -202,14 +205,69 @@ class Base(Extension):
             
     @redis.command()
     @is_bot_ower()
-    async def all(self, pattern:str):
-        """Retreive all keys that match 'pattern'"""
-        value = await self.bot.storage.keys(pattern)
-        if value:
-            await self.bot.say(f'`{pattern}`:\n```{value}```')
+    async def all(self, pattern:str, limit:int=SCAN_LIMIT):
+        """Retreive keys that match 'pattern', up to 'limit' of them"""
+        await self.bot.type()
+        
+        m = f'`{pattern}`:\n```'
+        found = 0
+        async for key in self.bot.storage.scan_iter(pattern, count=100):
+            if found >= limit:
+                m += f'```*Stopped after {limit} keys*'
+                await self.bot.say(m)
+                return
+            
+            # Send what we have so far before it outgrows a single message,
+            #   leaving room for the closing ticks and the "stopped" note
+            if len(m) + len(key) + 40 > self.MESSAGE_LIMIT:
+                await self.bot.say(m + '```')
+                m = '```'
+            
+            m += f'\n{key}'
+            found += 1
+        
+        if found:
+            await self.bot.say(m + '```')
         else:
             await self.bot.say(f"*Couldn't find* `{pattern}`")
             
+    @redis.command()
+    @is_bot_ower()
+    async def stats(self, top:int=10):
+        """Show the busiest storage commands, keys and key patterns"""
+        await self.bot.type()
+        stats = self.bot.storage.db.stats
+        top = max(1, min(top, self.STATS_LIMIT))
+        
+        def ms(seconds):
+            return f'{seconds * 1000:.2f}ms'
+        
+        def key(k):
+            if len(k) > self.STATS_KEY_WIDTH:
+                k = k[:self.STATS_KEY_WIDTH - 3] + '...'
+            return k
+        
+        rows = sorted(stats.commands.items(), key=lambda i: -i[1].count)
+        lines = [f'{"namespace":<20}{"command":<16}{"calls":>8}' + \
+            f'{"errors":>8}{"p50":>10}{"p99":>10}']
+        for (namespace, command), c in rows[:top]:
+            lines.append(f'{namespace:<20}{command:<16}{c.count:>8}' + \
+                f'{c.errors:>8}{ms(c.latency.percentile(0.5)):>10}' + \
+                f'{ms(c.latency.percentile(0.99)):>10}')
+        await self._say_table('Storage commands', lines)
+        
+        await self._say_table('Hottest keys', [f'{n:>8}  {key(k)}'
+            for k, n in stats.keys.most_common(top)])
+        await self._say_table('Hottest patterns', [f'{n:>8}  {key(p)}'
+            for p, n in stats.patterns.most_common(top)])
+    
+    async def _say_table(self, title, lines):
+        """Send lines in code blocks, split over as many messages as needed"""
+        title = f'**{title}:**\n'
+        limit = self.MESSAGE_LIMIT - len(title) - len('```\n```')
+        for i, page in enumerate(paginate(lines, limit=limit)):
+            await self.bot.say((title if i == 0 else '') + f'```\n{page}```')
+            
     @redis.command()
     @is_bot_ower()
     @commands.cooldown(1,20.0)
@@ -9,6 +9,9 @@ import discord
 from discord.ext import commands
 
 from .storage import Db, Storage
+from .embedded import EmbeddedDb
+from .directory import Directory
+from .metrics import serve
 from .utils import *
 
 
@@ -21,15 +24,20 @@ class RoboHound(commands.Bot, UtilityMixin):
         """
         owner_id        ID of discord useer who is running the bot (ie you)
         redis_address   tuple in the form (hostname, port) of a redis server
+        redis_minsize   Minimum number of pooled redis connections
+        redis_maxsize   Maximum number of pooled redis connections
+        storage         'redis' (the default) or 'embedded' to keep the data
+                        in-process instead of on a redis server
+        storage_path    Append-only file for the embedded storage
+        metrics_port    Serve storage metrics for scraping on this port
+        config          {extension class name: {option: value}} passed to
+                        extensions that take options when they're loaded
         log             Python logging object.  RoboHound will log to a child
         """
         super().__init__(command_prefix='!', description=self.__doc__)
         
         self._owner_id = kwargs.get('owner_id')
         
-        self._db = Db(kwargs.get('redis_address'))
-        self.storage = None
-        
         self.log = kwargs.get('log', logging.getLogger()).getChild('RoboHound')
         self.debug = kwargs.get('debug', False)
         if self.debug:
@@ -37,6 +45,34 @@ class RoboHound(commands.Bot, UtilityMixin):
         else:
             self.log.setLevel(logging.INFO)
         
+        if kwargs.get('storage', 'redis') == 'embedded':
+            self._db = EmbeddedDb(
+                kwargs.get('storage_path'),
+                loop = self.loop,
+                log = self.log.getChild('Db'),
+            )
+        else:
+            self._db = Db(
+                kwargs.get('redis_address'),
+                loop = self.loop,
+                minsize = kwargs.get('redis_minsize', 1),
+                maxsize = kwargs.get('redis_maxsize', 10),
+                log = self.log.getChild('Db'),
+            )
+        self.storage = self._db.get_namespace('')
+        self.config = kwargs.get('config') or {}
+        
+        # Members, roles and channels by name, for the get_* utilities, which
+        #   match names exactly unless asked to complete a prefix
+        self.directory = Directory(prefix=True)
+        self.directory.listen(self)
+        
+        # Anything with a prometheus() method; extensions add their own
+        self.metrics = [self._db.stats]
+        if kwargs.get('metrics_port'):
+            self.loop.create_task(serve(self.metrics,
+                port=kwargs['metrics_port'], loop=self.loop))
+        
     
     
     def run(self, t):
@@ -55,7 +91,6 @@ class RoboHound(commands.Bot, UtilityMixin):
             self.log.warning("Couldn't set game status")
             raise e
             
-        self.storage = self._db.get_namespace('')
         self.owner = await self.get_user_info(self._owner_id)
         
         # This extensions holds most of the bot's base capabilities
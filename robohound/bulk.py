@@ -0,0 +1,114 @@
+"""
+bulk.py
+
+Running one action over lots of things (eg members or channels) with only a
+few in flight at once, progress reports, and cancellation
+"""
+import asyncio
+import collections
+
+
+class BulkJob:
+    """
+    Runs action(item) for every item, at most concurrency at a time
+    If bucket is given, bucket(item) names the rate limit bucket the action
+    on item falls into, and only one action per bucket runs at once.  More
+    would just wait inside discord.py, which holds each bucket's lock until
+    the bucket resets, tying up workers that could be running actions in
+    other buckets.
+    """
+    # Seconds between progress reports
+    PROGRESS_INTERVAL = 2
+
+    # Failure reasons listed in the summary
+    SUMMARY_REASONS = 5
+
+    def __init__(self, action, items, concurrency=4, bucket=None, loop=None):
+        self.action = action
+        self.items = list(items)
+        self.concurrency = concurrency
+        self.bucket = bucket
+        self.loop = loop or asyncio.get_event_loop()
+
+        self.succeeded = 0
+        self.failures = collections.Counter()
+        self.canceled = False
+        self._locks = {}
+
+    @property
+    def total(self):
+        return len(self.items)
+
+    @property
+    def failed(self):
+        return sum(self.failures.values())
+
+    @property
+    def finished(self):
+        return self.succeeded + self.failed
+
+    def status(self):
+        m = f'{self.finished} of {self.total} done'
+        if self.failed:
+            m += f', {self.failed} failed'
+        return m
+
+    def summary(self):
+        """The status, and the most common reasons things failed"""
+        lines = [self.status() + (' (canceled)' if self.canceled else '')]
+        for reason, n in self.failures.most_common(self.SUMMARY_REASONS):
+            lines.append(f'{reason} ({n})')
+        return '\n'.join(lines)
+
+    def cancel(self):
+        """Stop once the actions already running finish"""
+        self.canceled = True
+
+    async def run(self, progress=None):
+        """
+        Run the action on every item, or until canceled
+        progress, if given, is a coroutine function called with the job
+        every PROGRESS_INTERVAL seconds while it runs
+        """
+        items = iter(self.items)
+
+        async def worker():
+            # The workers share the iterator, so each item is taken once
+            for item in items:
+                if self.canceled:
+                    return
+                await self._run_one(item)
+
+        workers = [self.loop.create_task(worker())
+                   for _ in range(min(self.concurrency, self.total))]
+        try:
+            pending = workers
+            while pending:
+                _, pending = await asyncio.wait(pending,
+                    timeout=self.PROGRESS_INTERVAL)
+                if pending and progress is not None:
+                    await progress(self)
+        finally:
+            for w in workers:
+                w.cancel()
+
+    async def _run_one(self, item):
+        lock = None
+        if self.bucket is not None:
+            key = self.bucket(item)
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = asyncio.Lock()
+
+        try:
+            if lock is not None:
+                async with lock:
+                    await self.action(item)
+            else:
+                await self.action(item)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures[str(e) or type(e).__name__] += 1
+        else:
+            self.succeeded += 1
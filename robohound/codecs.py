@@ -0,0 +1,152 @@
+"""
+codecs.py
+
+Compact, versioned encodings for records kept in storage
+
+Every encoded value starts with a one byte codec tag and a one byte schema
+version, so old records stay readable after a codec changes, and values
+written before codecs existed (plain JSON) are still recognised.
+"""
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class CodecError(Exception):
+    pass
+
+
+class Codec:
+    """Base class for codecs, which turn dicts into bytes and back"""
+    name = None
+    tag = None
+    version = 1
+
+    def encode(self, obj):
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    """Plain JSON, for records without a fixed shape"""
+    name = 'json'
+    tag = b'J'
+
+    def encode(self, obj):
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, data):
+        return json.loads(data.decode('utf-8'))
+
+
+class MsgpackCodec(Codec):
+    """MessagePack; only available when the msgpack package is installed"""
+    name = 'msgpack'
+    tag = b'M'
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class StructCodec(Codec):
+    """
+    Packs a fixed set of fields with struct
+    fields is a sequence of (name, format) pairs using struct format codes,
+    plus 'S' for Discord snowflake IDs (strings of digits, packed as an
+    unsigned 64 bit integer).  tail optionally names one text field that is
+    stored after the fixed fields with no length limit.
+    """
+    def __init__(self, name, tag, fields, tail=None, version=1):
+        self.name = name
+        self.tag = tag
+        self.version = version
+        self.tail = tail
+
+        self._names = [n for n, _ in fields]
+        self._ids = {n for n, f in fields if f == 'S'}
+        self._struct = struct.Struct(
+            '<' + ''.join('Q' if f == 'S' else f for _, f in fields))
+
+    def encode(self, obj):
+        values = [int(obj[n]) if n in self._ids else obj[n]
+                  for n in self._names]
+        data = self._struct.pack(*values)
+        if self.tail is not None:
+            data += obj[self.tail].encode('utf-8')
+        return data
+
+    def decode(self, data):
+        values = self._struct.unpack_from(data)
+        obj = {n: str(v) if n in self._ids else v
+               for n, v in zip(self._names, values)}
+        if self.tail is not None:
+            obj[self.tail] = data[self._struct.size:].decode('utf-8')
+        return obj
+
+
+class Codecs:
+    """
+    Registry of codecs, by name for encoding and by tag and version for
+    decoding.  Registering a newer version of a codec makes it the one used
+    for encoding, while records in older versions can still be read.
+    """
+    # Values that start with this are JSON written before codecs existed
+    LEGACY_JSON = b'{'
+
+    def __init__(self, default='json'):
+        self.default = default
+        self._by_name = {}
+        self._by_tag = {}
+
+        self.register(JsonCodec())
+        if msgpack is not None:
+            self.register(MsgpackCodec())
+
+    def register(self, codec):
+        if codec.tag == self.LEGACY_JSON or len(codec.tag) != 1:
+            raise CodecError(f'Invalid tag {codec.tag!r} for {codec.name}')
+
+        current = self._by_name.get(codec.name)
+        if current is None or current.version <= codec.version:
+            self._by_name[codec.name] = codec
+        self._by_tag[(codec.tag, codec.version)] = codec
+
+    def get(self, name=None):
+        try:
+            return self._by_name[name or self.default]
+        except KeyError:
+            raise CodecError(f'No codec named {name}')
+
+    def encode(self, obj, name=None):
+        codec = self.get(name)
+        return codec.tag + bytes((codec.version,)) + codec.encode(obj)
+
+    def decode(self, data):
+        """Decode a stored value; None stays None"""
+        if data is None:
+            return None
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if data[:1] == self.LEGACY_JSON:
+            return json.loads(data.decode('utf-8'))
+
+        try:
+            codec = self._by_tag[(data[:1], data[1])]
+        except (KeyError, IndexError):
+            raise CodecError(f'Unknown codec for value {data[:2]!r}')
+        return codec.decode(data[2:])
+
+    def is_current(self, data, name=None):
+        """Whether data is already in the latest version of codec name"""
+        codec = self.get(name)
+        return data is not None and \
+            data[:2] == codec.tag + bytes((codec.version,))
@@ -0,0 +1,225 @@
+"""
+directory.py
+
+Per-server indices for looking up members, roles and channels by ID, mention,
+name or nick without scanning the whole server
+"""
+import re
+from sortedcontainers import SortedList
+
+
+# Mentions of members, nicknamed members, roles and channels
+MENTION = re.compile(r'<(?:@[!&]?|#)(\d+)>$')
+
+
+class Lookup:
+    """
+    Objects (anything with an id) by their ID and every name they have
+    Names are casefolded, so they match whatever their case, and mentions
+    are looked up by the ID in them.  IDs win over names that look like
+    them.  Several objects can share a name; the one added first wins, as
+    with discord.utils.find.
+    """
+    def __init__(self, prefix=False):
+        self.by_key = {}
+        # Objects that share a key with the one in by_key, in the order added
+        self.shadowed = {}
+        # id: (object, its keys)
+        self.entries = {}
+        # Sorted (key, id) pairs, for finding names by what they start with
+        self.prefixes = SortedList() if prefix else None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, obj, keys):
+        self.remove(obj.id)
+        if self.prefixes is not None:
+            self.prefixes.update(self._index(obj, keys))
+        else:
+            self._index(obj, keys)
+
+    def extend(self, objs, keys):
+        """Add lots of objects at once, with keys(obj) giving each one's keys"""
+        prefixes = []
+        for obj in objs:
+            self.remove(obj.id)
+            prefixes.extend(self._index(obj, keys(obj)))
+        if self.prefixes is not None:
+            # Much faster than adding them one at a time
+            self.prefixes.update(prefixes)
+
+    def _index(self, obj, keys):
+        """Add obj by keys, returning the (key, id) pairs to prefix index"""
+        keys = tuple({k.casefold() for k in keys if k})
+        self.entries[obj.id] = (obj, keys)
+        by_key = self.by_key
+        for k in keys:
+            if k in by_key:
+                self.shadowed.setdefault(k, []).append(obj)
+            else:
+                by_key[k] = obj
+        return [(k, obj.id) for k in keys]
+
+    def remove(self, id):
+        _, keys = self.entries.pop(id, (None, ()))
+        for k in keys:
+            if self.by_key[k].id == id:
+                others = self.shadowed.get(k)
+                if others:
+                    self.by_key[k] = others.pop(0)
+                else:
+                    del self.by_key[k]
+            else:
+                self.shadowed[k] = [o for o in self.shadowed[k] if o.id != id]
+            if not self.shadowed.get(k, True):
+                del self.shadowed[k]
+            if self.prefixes is not None:
+                self.prefixes.discard((k, id))
+
+    def get(self, key, prefix=False):
+        """
+        The object with ID or name key, or with prefix, the only one with a
+        name starting with key if none has it exactly
+        Guessing from a prefix can pick the wrong object, so it's only for
+        lookups that don't act on what they find.
+        """
+        key = key.strip().casefold()
+        if key.startswith('<'):
+            m = MENTION.match(key)
+            if m:
+                key = m.group(1)
+        entry = self.entries.get(key)
+        if entry is not None:
+            return entry[0]
+        obj = self.by_key.get(key)
+        if obj is not None:
+            return obj
+        if not prefix or self.prefixes is None or not key:
+            return None
+
+        # Two matches (for different objects) is enough to be ambiguous
+        found = None
+        for k, id in self.prefixes.irange((key,), (key + '\uffff',)):
+            if found is not None and found != id:
+                return None
+            found = id
+        return self.entries[found][0] if found is not None else None
+
+
+# The names each kind of object can be looked up by, besides its ID
+
+def member_keys(m):
+    return (m.name, m.nick, f'{m.name}#{m.discriminator}')
+
+def role_keys(r):
+    return (r.name,)
+
+def channel_keys(c):
+    return (c.name,)
+
+
+class ServerIndex:
+    """Members, roles and channels of one server"""
+    def __init__(self, server, prefix=False):
+        self.server = server
+        self.members = Lookup(prefix)
+        self.roles = Lookup(prefix)
+        self.channels = Lookup(prefix)
+
+        self.members.extend(server.members, member_keys)
+        self.roles.extend(server.roles, role_keys)
+        self.channels.extend(server.channels, channel_keys)
+
+    def stale(self, server):
+        """
+        Whether the index no longer matches server, eg after a reconnect
+        replaced the server object, or offline members were loaded in bulk
+        (which doesn't raise any events)
+        """
+        return server is not self.server or \
+            len(self.members) != len(server.members)
+
+    def member(self, key, prefix=False):
+        return self.members.get(key, prefix)
+
+    def role(self, key, prefix=False):
+        return self.roles.get(key, prefix)
+
+    def channel(self, key, prefix=False):
+        return self.channels.get(key, prefix)
+
+
+class Directory:
+    """
+    ServerIndex for every server, built the first time it's needed and then
+    kept up to date from the bot's events
+    """
+    def __init__(self, prefix=False):
+        self.prefix = prefix
+        self.servers = {}
+
+    def server(self, server):
+        """The index for server"""
+        index = self.servers.get(server.id)
+        if index is None or index.stale(server):
+            index = self.servers[server.id] = ServerIndex(server, self.prefix)
+        return index
+
+    def _built(self, server):
+        """The index for server, if it has been built"""
+        return self.servers.get(server.id) if server is not None else None
+
+    def listen(self, bot):
+        """Keep the indices up to date with bot's events"""
+        for name in ('on_member_join', 'on_member_remove', 'on_member_update',
+                     'on_server_role_create', 'on_server_role_delete',
+                     'on_server_role_update', 'on_channel_create',
+                     'on_channel_delete', 'on_channel_update',
+                     'on_server_remove'):
+            bot.add_listener(getattr(self, name), name)
+
+    async def on_member_join(self, member):
+        index = self._built(member.server)
+        if index is not None:
+            index.members.add(member, member_keys(member))
+
+    async def on_member_remove(self, member):
+        index = self._built(member.server)
+        if index is not None:
+            index.members.remove(member.id)
+
+    async def on_member_update(self, before, after):
+        # Most updates are presence and status changes, which don't matter
+        if before.name != after.name or before.nick != after.nick or \
+            before.discriminator != after.discriminator:
+            await self.on_member_join(after)
+
+    async def on_server_role_create(self, role):
+        index = self._built(role.server)
+        if index is not None:
+            index.roles.add(role, role_keys(role))
+
+    async def on_server_role_delete(self, role):
+        index = self._built(role.server)
+        if index is not None:
+            index.roles.remove(role.id)
+
+    async def on_server_role_update(self, before, after):
+        await self.on_server_role_create(after)
+
+    async def on_channel_create(self, channel):
+        index = self._built(getattr(channel, 'server', None))
+        if index is not None:
+            index.channels.add(channel, channel_keys(channel))
+
+    async def on_channel_delete(self, channel):
+        index = self._built(getattr(channel, 'server', None))
+        if index is not None:
+            index.channels.remove(channel.id)
+
+    async def on_channel_update(self, before, after):
+        await self.on_channel_create(after)
+
+    async def on_server_remove(self, server):
+        self.servers.pop(server.id, None)
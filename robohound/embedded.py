@@ -0,0 +1,882 @@
+"""
+embedded.py
+
+In-process stand-in for Redis, for single node deployments, tests and
+benchmarks.  EmbeddedDb can be used anywhere a Db can, and keeps its data
+durable with an append-only file of the write commands it has run.
+"""
+import os
+import json
+import time
+import base64
+import bisect
+import asyncio
+import fnmatch
+import aioredis
+from aioredis.util import _NOTSET
+
+from .storage import Db
+
+
+def _encode(value):
+    """
+    Convert a value the way aioredis would before sending it
+    Text is kept as str; bytes that aren't valid UTF-8 are kept as bytes
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        try:
+            return bytes(value).decode('utf-8')
+        except UnicodeDecodeError:
+            return bytes(value)
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, int):
+        return str(value)
+    raise TypeError(f'Argument {value!r} expected to be of bytearray, ' + \
+        'bytes, float, int, or str type')
+
+
+def _decode(value, encoding):
+    """Hand a stored value back the way aioredis would with this encoding"""
+    if value is None:
+        return None
+    if encoding is None:
+        return value.encode('utf-8') if isinstance(value, str) else value
+    if isinstance(value, bytes):
+        return value.decode('utf-8' if encoding is _NOTSET else encoding)
+    return value
+
+
+def _dump_line(op, *args):
+    """One append-only file line; binary values are base64'd"""
+    args = [{'b64': base64.b64encode(a).decode('ascii')}
+            if isinstance(a, bytes) else a for a in args]
+    return json.dumps([op, *args]) + '\n'
+
+
+def _load_line(line):
+    op, *args = json.loads(line)
+    args = [base64.b64decode(a['b64']) if isinstance(a, dict) else a
+            for a in args]
+    return op, args
+
+
+def _flatten(fields):
+    flat = []
+    for field, value in fields.items():
+        flat.extend((field, value))
+    return flat
+
+
+def _int_or_float(score):
+    return int(score) if score == int(score) else score
+
+
+def _member(value):
+    """A sorted set member as bytes, which Redis orders members by"""
+    value = _encode(value)
+    return value.encode('utf-8') if isinstance(value, str) else value
+
+
+class _Top:
+    """Sorts after every member, for bisecting past a score's last member"""
+    def __lt__(self, other):
+        return False
+    
+    def __gt__(self, other):
+        return True
+
+_TOP = _Top()
+
+
+class _ZSet:
+    """
+    Sorted set: member -> score, plus a (score, member) list kept sorted
+    Members are kept as bytes, so text and binary members sort together.
+    """
+    def __init__(self):
+        self.scores = {}
+        self.order = []
+    
+    def __len__(self):
+        return len(self.scores)
+    
+    def add(self, score, member):
+        old = self.scores.get(member)
+        if old is not None:
+            self.order.pop(bisect.bisect_left(self.order, (old, member)))
+        self.scores[member] = score
+        bisect.insort(self.order, (score, member))
+        return old is None
+    
+    def remove(self, member):
+        score = self.scores.pop(member, None)
+        if score is None:
+            return False
+        self.order.pop(bisect.bisect_left(self.order, (score, member)))
+        return True
+    
+    def range_by_score(self, min, max, min_open=False, max_open=False):
+        # (score,) sorts before any (score, member), and (score, _TOP) after
+        if min_open:
+            lo = bisect.bisect_right(self.order, (min, _TOP))
+        else:
+            lo = bisect.bisect_left(self.order, (min,))
+        if max_open:
+            hi = bisect.bisect_left(self.order, (max,))
+        else:
+            hi = bisect.bisect_right(self.order, (max, _TOP))
+        return self.order[lo:hi]
+
+
+class _Stream:
+    """Stream: entry IDs as (ms, seq) tuples in order, and their fields"""
+    def __init__(self):
+        self.ids = []
+        self.fields = []
+        self.last = (0, 0)
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def next_id(self, message_id):
+        if message_id == '*':
+            ms = int(time.time() * 1000)
+            if ms <= self.last[0]:
+                return (self.last[0], self.last[1] + 1)
+            return (ms, 0)
+        entry_id = _parse_id(message_id, 0)
+        if entry_id <= self.last:
+            raise aioredis.ReplyError('ERR The ID specified in XADD is ' + \
+                'equal or smaller than the target stream top item')
+        return entry_id
+    
+    def append(self, entry_id, fields):
+        self.ids.append(entry_id)
+        self.fields.append(fields)
+        self.last = entry_id
+    
+    def trim(self, max_len):
+        dropped = max(len(self.ids) - max_len, 0)
+        del self.ids[:dropped]
+        del self.fields[:dropped]
+        return dropped
+    
+    def range(self, start, stop):
+        lo = bisect.bisect_left(self.ids, start)
+        hi = bisect.bisect_right(self.ids, stop, lo=lo)
+        return list(zip(self.ids[lo:hi], self.fields[lo:hi]))
+
+
+def _parse_id(value, default_seq):
+    """A stream ID as an (ms, seq) tuple; default_seq fills in a bare 'ms'"""
+    ms, _, seq = _encode(value).partition('-')
+    return (int(ms), int(seq) if seq else default_seq)
+
+
+def _format_id(entry_id):
+    return f'{entry_id[0]}-{entry_id[1]}'
+
+
+class EmbeddedRedis:
+    """
+    Implements the subset of the aioredis API that Storage uses
+    None of the commands actually suspend, so each one (and each pipeline)
+    runs atomically with respect to the rest of the bot.
+    """
+    ZSET_EXCLUDE_MIN = aioredis.Redis.ZSET_EXCLUDE_MIN
+    ZSET_EXCLUDE_MAX = aioredis.Redis.ZSET_EXCLUDE_MAX
+    ZSET_EXCLUDE_BOTH = aioredis.Redis.ZSET_EXCLUDE_BOTH
+    
+    def __init__(self, path=None, scripts=None):
+        self.path = path
+        self._data = {}
+        self._expires = {}
+        
+        # Registered scripts (name: Script), run through their emulations
+        self.scripts = scripts if scripts is not None else {}
+        self._loaded = {}
+        
+        self._aof = None
+        self._replaying = False
+        self._rewrite_buffer = None
+    
+    
+    # Persistence
+    
+    async def open(self):
+        """Replay the append-only file, then start appending to it"""
+        if self.path is None:
+            return
+        
+        if os.path.exists(self.path):
+            self._replaying = True
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    for line in f:
+                        if line.strip():
+                            op, args = _load_line(line)
+                            await getattr(self, op)(*args)
+            finally:
+                self._replaying = False
+        
+        self._aof = open(self.path, 'a', encoding='utf-8')
+    
+    def _log(self, op, *args):
+        if self._replaying:
+            return
+        line = _dump_line(op, *args)
+        if self._rewrite_buffer is not None:
+            self._rewrite_buffer.append(line)
+        if self._aof is not None:
+            self._aof.write(line)
+            self._aof.flush()
+    
+    def fsync(self):
+        if self._aof is not None:
+            os.fsync(self._aof.fileno())
+    
+    def _snapshot(self):
+        """The shortest list of commands that rebuilds the current data"""
+        lines = []
+        for key in list(self._data):
+            value = self._get(key)
+            if value is None:
+                continue
+            if isinstance(value, (str, bytes)):
+                lines.append(['set', key, value])
+            elif isinstance(value, list):
+                lines.append(['rpush', key, *value])
+            elif isinstance(value, set):
+                lines.append(['sadd', key, *value])
+            elif isinstance(value, dict):
+                for field, v in value.items():
+                    lines.append(['hset', key, field, v])
+            elif isinstance(value, _ZSet):
+                pairs = []
+                for score, member in value.order:
+                    pairs.extend((score, _encode(member)))
+                lines.append(['zadd', key, *pairs])
+            elif isinstance(value, _Stream):
+                for entry_id, fields in value.range((0, 0), value.last):
+                    lines.append(['_xadd', key, _format_id(entry_id),
+                                  *_flatten(fields)])
+            if key in self._expires:
+                lines.append(['pexpireat', key, self._expires[key]])
+        return ''.join(_dump_line(*l) for l in lines)
+    
+    async def bgsave(self):
+        """Compact the append-only file down to a snapshot of the data"""
+        if self.path is None or self._rewrite_buffer is not None:
+            return True
+        
+        # Writes made while the snapshot is on its way to disk are kept
+        #   aside and appended to the new file afterwards
+        snapshot = self._snapshot()
+        self._rewrite_buffer = []
+        tmp = self.path + '.rewrite'
+        
+        def write():
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+        
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, write)
+            with open(tmp, 'a', encoding='utf-8') as f:
+                f.writelines(self._rewrite_buffer)
+            os.replace(tmp, self.path)
+            self._aof.close()
+            self._aof = open(self.path, 'a', encoding='utf-8')
+        finally:
+            self._rewrite_buffer = None
+        return True
+    
+    def close(self):
+        if self._aof is not None:
+            self.fsync()
+            self._aof.close()
+            self._aof = None
+    
+    
+    # Keys
+    
+    def _get(self, key, type_=None):
+        """Look up a key, dropping it if it has expired"""
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.time() * 1000:
+            del self._data[key]
+            del self._expires[key]
+        
+        value = self._data.get(key)
+        if value is not None and type_ is not None and \
+            not isinstance(value, type_):
+            raise aioredis.ReplyError('WRONGTYPE Operation against a key ' + \
+                'holding the wrong kind of value')
+        return value
+    
+    def _drop_if_empty(self, key):
+        if not self._data.get(key, True):
+            del self._data[key]
+            self._expires.pop(key, None)
+    
+    async def ping(self):
+        return 'PONG'
+    
+    async def publish(self, channel, message):
+        # Nobody else can be listening to an in-process store
+        return 0
+    
+    async def scan(self, cursor=0, match=None, count=None):
+        """
+        Everything comes back in one batch; there's no server to keep
+        responsive between pages
+        """
+        keys = [k for k in list(self._data) if self._get(k) is not None]
+        if match is not None:
+            keys = [k for k in keys if fnmatch.fnmatchcase(k, match)]
+        return 0, keys
+    
+    async def delete(self, key, *keys):
+        deleted = 0
+        for k in (key,) + keys:
+            if self._get(k) is not None:
+                del self._data[k]
+                self._expires.pop(k, None)
+                deleted += 1
+        self._log('delete', key, *keys)
+        return deleted
+    
+    async def pexpireat(self, key, timestamp):
+        if self._get(key) is None:
+            return False
+        self._expires[key] = timestamp
+        self._log('pexpireat', key, timestamp)
+        return True
+    
+    async def expire(self, key, timeout):
+        return await self.pexpireat(key, int((time.time() + timeout) * 1000))
+    
+    async def ttl(self, key):
+        if self._get(key) is None:
+            return -2
+        if key not in self._expires:
+            return -1
+        return int(round(self._expires[key] / 1000 - time.time()))
+    
+    def _sort_lookup(self, pattern, element):
+        """The value a SORT BY/GET pattern points to for element"""
+        if pattern == '#':
+            return element
+        key, arrow, field = pattern.partition('->')
+        key = key.replace('*', element, 1)
+        if arrow:
+            return (self._get(key, dict) or {}).get(field)
+        value = self._get(key)
+        return value if isinstance(value, (str, bytes)) else None
+    
+    async def sort(self, key, *get_patterns, by=None, offset=None, count=None,
+                   asc=None, alpha=False, store=None):
+        value = self._get(key, (list, set, _ZSet))
+        if isinstance(value, _ZSet):
+            items = [_encode(m) for _, m in value.order]
+        else:
+            items = list(value or ())
+        
+        if by != 'nosort':
+            if by is None:
+                weight = lambda e: e
+            else:
+                weight = lambda e: self._sort_lookup(by, e)
+            
+            def sort_key(element):
+                w = weight(element)
+                if alpha:
+                    return w or ''
+                try:
+                    return float(w or 0)
+                except ValueError:
+                    raise aioredis.ReplyError('ERR One or more scores ' + \
+                        "can't be converted into double")
+            items.sort(key=sort_key, reverse=(asc is False))
+        
+        if offset is not None and count is not None:
+            items = items[offset:offset + count]
+        if get_patterns:
+            items = [self._sort_lookup(p, e)
+                     for e in items for p in get_patterns]
+        
+        if store is None:
+            return items
+        await self.delete(store)
+        stored = [i if i is not None else '' for i in items]
+        if stored:
+            await self.rpush(store, *stored)
+        return len(stored)
+    
+    
+    # Strings
+    
+    async def get(self, key, *, encoding=_NOTSET):
+        return _decode(self._get(key, (str, bytes)), encoding)
+    
+    async def set(self, key, value, *, expire=0, pexpire=0, exist=None):
+        exists = self._get(key) is not None
+        if exist is aioredis.Redis.SET_IF_EXIST and not exists or \
+            exist is aioredis.Redis.SET_IF_NOT_EXIST and exists:
+            return False
+        
+        self._data[key] = _encode(value)
+        self._expires.pop(key, None)
+        self._log('set', key, self._data[key])
+        
+        if expire:
+            await self.expire(key, expire)
+        elif pexpire:
+            await self.pexpireat(key, int(time.time() * 1000) + pexpire)
+        return True
+    
+    async def setnx(self, key, value):
+        if self._get(key) is not None:
+            return False
+        return await self.set(key, value)
+    
+    async def incrby(self, key, amount):
+        value = self._get(key, str)
+        try:
+            value = int(value or 0) + amount
+        except ValueError:
+            raise aioredis.ReplyError('ERR value is not an integer or ' + \
+                'out of range')
+        self._data[key] = str(value)
+        self._log('set', key, self._data[key])
+        if key in self._expires:
+            self._log('pexpireat', key, self._expires[key])
+        return value
+    
+    async def incr(self, key):
+        return await self.incrby(key, 1)
+    
+    
+    # Lists
+    
+    def _list(self, key):
+        value = self._get(key, list)
+        if value is None:
+            value = self._data[key] = []
+        return value
+    
+    async def lpush(self, key, value, *values):
+        l = self._list(key)
+        new = [_encode(v) for v in (value,) + values]
+        l[:0] = reversed(new)
+        self._log('lpush', key, *new)
+        return len(l)
+    
+    async def rpush(self, key, value, *values):
+        l = self._list(key)
+        new = [_encode(v) for v in (value,) + values]
+        l.extend(new)
+        self._log('rpush', key, *new)
+        return len(l)
+    
+    async def lpop(self, key):
+        l = self._get(key, list)
+        if not l:
+            return None
+        value = l.pop(0)
+        self._drop_if_empty(key)
+        self._log('lpop', key)
+        return value
+    
+    async def rpop(self, key):
+        l = self._get(key, list)
+        if not l:
+            return None
+        value = l.pop()
+        self._drop_if_empty(key)
+        self._log('rpop', key)
+        return value
+    
+    async def llen(self, key):
+        return len(self._get(key, list) or ())
+    
+    def _slice(self, l, start, stop):
+        """Redis list range (inclusive, negative from the end) as a slice"""
+        if start < 0:
+            start = max(len(l) + start, 0)
+        if stop < 0:
+            stop = len(l) + stop
+        return slice(start, max(stop + 1, start))
+    
+    async def lrange(self, key, start, stop):
+        l = self._get(key, list) or []
+        return l[self._slice(l, start, stop)]
+    
+    async def lrem(self, key, count, value):
+        l = self._get(key, list)
+        if not l:
+            return 0
+        value = _encode(value)
+        
+        indices = [i for i, v in enumerate(l) if v == value]
+        if count > 0:
+            indices = indices[:count]
+        elif count < 0:
+            indices = indices[count:]
+        for i in reversed(indices):
+            del l[i]
+        
+        self._drop_if_empty(key)
+        self._log('lrem', key, count, value)
+        return len(indices)
+    
+    async def lset(self, key, index, value):
+        l = self._get(key, list)
+        if not l or not -len(l) <= index < len(l):
+            raise aioredis.ReplyError('ERR index out of range')
+        l[index] = _encode(value)
+        self._log('lset', key, index, l[index])
+        return True
+    
+    async def ltrim(self, key, start, stop):
+        l = self._get(key, list)
+        if l is not None:
+            l[:] = l[self._slice(l, start, stop)]
+            self._drop_if_empty(key)
+        self._log('ltrim', key, start, stop)
+        return True
+    
+    
+    # Sets
+    
+    async def sadd(self, key, member, *members):
+        s = self._get(key, set)
+        if s is None:
+            s = self._data[key] = set()
+        new = {_encode(m) for m in (member,) + members} - s
+        s |= new
+        self._drop_if_empty(key)
+        if new:
+            self._log('sadd', key, *new)
+        return len(new)
+    
+    async def srem(self, key, member, *members):
+        s = self._get(key, set)
+        if not s:
+            return 0
+        gone = {_encode(m) for m in (member,) + members} & s
+        s -= gone
+        self._drop_if_empty(key)
+        if gone:
+            self._log('srem', key, *gone)
+        return len(gone)
+    
+    async def smembers(self, key):
+        return list(self._get(key, set) or ())
+    
+    
+    # Hashes
+    
+    async def hset(self, key, field, value):
+        h = self._get(key, dict)
+        if h is None:
+            h = self._data[key] = {}
+        field = _encode(field)
+        new = field not in h
+        h[field] = _encode(value)
+        self._log('hset', key, field, h[field])
+        return int(new)
+    
+    async def hget(self, key, field, *, encoding=_NOTSET):
+        value = (self._get(key, dict) or {}).get(_encode(field))
+        return _decode(value, encoding)
+    
+    async def hmget(self, key, field, *fields, encoding=_NOTSET):
+        h = self._get(key, dict) or {}
+        return [_decode(h.get(_encode(f)), encoding)
+                for f in (field,) + fields]
+    
+    async def hdel(self, key, field, *fields):
+        h = self._get(key, dict)
+        if not h:
+            return 0
+        deleted = 0
+        for f in (field,) + fields:
+            if h.pop(_encode(f), None) is not None:
+                deleted += 1
+        self._drop_if_empty(key)
+        self._log('hdel', key, field, *fields)
+        return deleted
+    
+    async def hincrby(self, key, field, increment=1):
+        h = self._get(key, dict)
+        if h is None:
+            h = self._data[key] = {}
+        field = _encode(field)
+        try:
+            value = int(h.get(field, 0)) + increment
+        except ValueError:
+            raise aioredis.ReplyError('ERR hash value is not an integer')
+        h[field] = str(value)
+        self._log('hset', key, field, h[field])
+        return value
+    
+    async def hgetall(self, key, *, encoding=_NOTSET):
+        h = self._get(key, dict) or {}
+        return {_decode(f, encoding): _decode(v, encoding)
+                for f, v in h.items()}
+    
+    async def hlen(self, key):
+        return len(self._get(key, dict) or ())
+    
+    
+    # Sorted sets
+    
+    async def zadd(self, key, score, member, *pairs):
+        z = self._get(key, _ZSet)
+        if z is None:
+            z = self._data[key] = _ZSet()
+        pairs = (score, member) + pairs
+        added = 0
+        for i in range(0, len(pairs), 2):
+            added += z.add(float(pairs[i]), _member(pairs[i + 1]))
+        self._log('zadd', key, *pairs)
+        return added
+    
+    async def zrem(self, key, member, *members):
+        z = self._get(key, _ZSet)
+        if not z:
+            return 0
+        removed = sum(z.remove(_member(m)) for m in (member,) + members)
+        self._drop_if_empty(key)
+        self._log('zrem', key, member, *members)
+        return removed
+    
+    def _exclude(self, exclude):
+        return exclude in (self.ZSET_EXCLUDE_MIN, self.ZSET_EXCLUDE_BOTH), \
+            exclude in (self.ZSET_EXCLUDE_MAX, self.ZSET_EXCLUDE_BOTH)
+    
+    async def zscore(self, key, member):
+        score = (self._get(key, _ZSet) or _ZSet()).scores.get(_member(member))
+        return None if score is None else _int_or_float(score)
+    
+    async def zcard(self, key):
+        return len(self._get(key, _ZSet) or ())
+    
+    async def zcount(self, key, min=float('-inf'), max=float('inf'),
+                     *, exclude=None):
+        z = self._get(key, _ZSet)
+        if not z:
+            return 0
+        return len(z.range_by_score(min, max, *self._exclude(exclude)))
+    
+    async def zrange(self, key, start=0, stop=-1, withscores=False,
+                     encoding=_NOTSET):
+        z = self._get(key, _ZSet)
+        if not z:
+            return []
+        items = z.order[self._slice(z.order, start, stop)]
+        if withscores:
+            return [(_decode(m, encoding), _int_or_float(s))
+                    for s, m in items]
+        return [_decode(m, encoding) for _, m in items]
+    
+    async def zrangebyscore(self, key, min=float('-inf'), max=float('inf'),
+                            withscores=False, offset=None, count=None,
+                            *, exclude=None, encoding=_NOTSET):
+        z = self._get(key, _ZSet)
+        if not z:
+            return []
+        
+        items = z.range_by_score(min, max, *self._exclude(exclude))
+        if offset is not None:
+            # Without a count, everything after offset
+            items = items[offset:None if count is None else offset + count]
+        
+        if withscores:
+            return [(_decode(m, encoding), _int_or_float(s))
+                    for s, m in items]
+        return [_decode(m, encoding) for _, m in items]
+    
+    async def zremrangebyscore(self, key, min=float('-inf'),
+                               max=float('inf'), *, exclude=None):
+        z = self._get(key, _ZSet)
+        if not z:
+            return 0
+        members = [m for _, m in
+                   z.range_by_score(min, max, *self._exclude(exclude))]
+        if not members:
+            return 0
+        return await self.zrem(key, *members)
+    
+    async def zpopmin(self, key, count=None, *, encoding=_NOTSET):
+        z = self._get(key, _ZSet)
+        if not z:
+            return []
+        popped = z.order[:1 if count is None else count]
+        for _, m in popped:
+            z.remove(m)
+        self._drop_if_empty(key)
+        self._log('zrem', key, *(m for _, m in popped))
+        
+        # Redis hands the scores back as strings, unconverted
+        result = []
+        for score, member in popped:
+            result.append(_decode(member, encoding))
+            result.append(_decode(_encode(_int_or_float(score)), encoding))
+        return result
+    
+    
+    # Streams
+    
+    async def _xadd(self, key, entry_id, *flat):
+        """Append an entry with a known ID; what xadd writes to the file"""
+        x = self._get(key, _Stream)
+        if x is None:
+            x = self._data[key] = _Stream()
+        entry_id = x.next_id(entry_id)
+        fields = dict(zip(flat[::2], flat[1::2]))
+        x.append(entry_id, fields)
+        self._log('_xadd', key, _format_id(entry_id), *flat)
+        return _format_id(entry_id)
+    
+    async def xadd(self, stream, fields, message_id=b'*', max_len=None,
+                   exact_len=False):
+        # Trimming is always exact here; it costs nothing extra in memory
+        flat = [_encode(v) for v in _flatten(fields)]
+        entry_id = await self._xadd(stream, _encode(message_id), *flat)
+        if max_len is not None:
+            await self.xtrim(stream, max_len)
+        return entry_id
+    
+    async def xtrim(self, stream, max_len, exact_len=False):
+        x = self._get(stream, _Stream)
+        if x is None:
+            return 0
+        dropped = x.trim(max_len)
+        if dropped:
+            self._log('xtrim', stream, max_len)
+        return dropped
+    
+    async def xrange(self, stream, start='-', stop='+', count=None):
+        x = self._get(stream, _Stream)
+        if x is None:
+            return []
+        start = (0, 0) if start == '-' else _parse_id(start, 0)
+        stop = x.last if stop == '+' else _parse_id(stop, float('inf'))
+        entries = x.range(start, stop)
+        if count is not None:
+            entries = entries[:count]
+        return [(_format_id(i), dict(f)) for i, f in entries]
+    
+    async def xlen(self, stream):
+        return len(self._get(stream, _Stream) or ())
+    
+    
+    # Scripting
+    
+    async def script_load(self, source):
+        for script in self.scripts.values():
+            if script.source == source:
+                if script.emulate is None:
+                    raise aioredis.ReplyError(f'ERR script "{script.name}" ' + \
+                        'has no emulation for the embedded store')
+                self._loaded[script.sha] = script
+                return script.sha
+        raise aioredis.ReplyError('ERR the embedded store only runs ' + \
+            'registered scripts')
+    
+    async def evalsha(self, digest, keys=[], args=[]):
+        script = self._loaded.get(digest)
+        if script is None:
+            raise aioredis.ReplyError('NOSCRIPT No matching script. ' + \
+                'Please use EVAL.')
+        return await script.emulate(self, keys, args)
+    
+    
+    # Batching
+    
+    def pipeline(self):
+        return EmbeddedPipeline(self)
+    
+    def multi_exec(self):
+        return EmbeddedPipeline(self)
+
+
+class EmbeddedPipeline:
+    """
+    Queues commands like an aioredis Pipeline
+    Commands return futures which resolve once execute() has run them
+    """
+    def __init__(self, redis):
+        self._redis = redis
+        self._queue = []
+    
+    def __getattr__(self, name):
+        method = getattr(self._redis, name)
+        
+        def queue(*args, **kwargs):
+            fut = asyncio.get_event_loop().create_future()
+            self._queue.append((fut, method, args, kwargs))
+            return fut
+        return queue
+    
+    async def execute(self, *, return_exceptions=False):
+        results = []
+        for fut, method, args, kwargs in self._queue:
+            try:
+                result = await method(*args, **kwargs)
+            except Exception as e:
+                fut.set_exception(e)
+                result = e
+            else:
+                fut.set_result(result)
+            results.append(result)
+        self._queue = []
+        
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+
+class EmbeddedDb(Db):
+    """
+    A Db backed by an EmbeddedRedis instead of a Redis server
+    path is the append-only file to keep the data in; with no path nothing is
+    written to disk.
+    """
+    # Seconds between fsyncs of the append-only file
+    FSYNC_INTERVAL = 1
+    
+    def __init__(self, path=None, loop=None, log=None):
+        self.path = path
+        super().__init__(path, loop=loop, log=log)
+    
+    async def start(self):
+        redis = EmbeddedRedis(self.path, self.scripts)
+        await redis.open()
+        self.redis = redis
+        
+        self.log.info(f'Embedded storage ready ({self.path or "in memory"})')
+        self._ready.set()
+        await self._monitor()
+    
+    async def _monitor(self):
+        while True:
+            await asyncio.sleep(self.FSYNC_INTERVAL)
+            self.redis.fsync()
+    
+    async def close(self):
+        if self.redis is not None:
+            self.redis.close()
+    
+    def register_cache(self, cache):
+        # Every write goes through this process, so there is nothing to
+        #   listen for; publish_invalidation reaches every cache directly
+        self._caches.add(cache)
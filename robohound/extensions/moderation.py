@@ -1,12 +1,226 @@
-import discord
+import re
+import time
 import asyncio
+import fnmatch
+import datetime
+import discord
 from discord.ext import commands
 
 from robohound.base import Extension
+from robohound.bulk import BulkJob
+from robohound.recent import RecentAuthors
+
+
+class Purge:
+    """
+    Deletes messages as it streams through a channel's history
+    Matches are deleted up to 100 at a time through the bulk delete endpoint
+    while the next page of history is fetched.  Only messages too old for
+    bulk deletes are deleted one by one.  There are no pauses: discord.py
+    waits out each endpoint's rate limit from the response headers.
+    """
+    # Most messages one bulk delete takes
+    BULK_LIMIT = 100
+    
+    # Discord refuses to bulk delete messages older than this
+    BULK_MAX_AGE = datetime.timedelta(days=14)
+    
+    # Most messages looked at, however few of them match
+    SCAN_LIMIT = 10000
+    
+    # Seconds between edits of the progress message
+    PROGRESS_INTERVAL = 2
+    
+    def __init__(self, bot, channel, limit, authors=None, before=None):
+        """
+        limit       Number of matching messages to delete
+        authors     IDs of the members whose messages match, or None to
+                    match everyone's
+        before      Only look at messages before this one
+        """
+        self.bot = bot
+        self.channel = channel
+        self.limit = limit
+        self.authors = authors
+        self.before = before
+        
+        self.scanned = 0
+        self.matched = 0
+        self.deleted = 0
+        self.failed = 0
+        
+        # The bulk delete running while the next page is fetched
+        self._deleting = None
+    
+    def matches(self, message):
+        return self.authors is None or message.author.id in self.authors
+    
+    def status(self):
+        m = f'Deleted {self.deleted} of {self.scanned} messages looked at'
+        if self.failed:
+            m += f' ({self.failed} could not be deleted)'
+        return m
+    
+    async def run(self, progress=None):
+        """
+        Delete up to limit matching messages, newest first
+        progress is a message to keep editing with how far the purge has got
+        """
+        if self.limit < 1:
+            return
+        
+        # Message timestamps are naive UTC
+        cutoff = datetime.datetime.utcnow() - self.BULK_MAX_AGE
+        updated = time.monotonic()
+        batch = []
+        
+        try:
+            async for message in self.bot.logs_from(self.channel,
+                limit=self.SCAN_LIMIT, before=self.before):
+                self.scanned += 1
+                if not self.matches(message):
+                    continue
+                self.matched += 1
+                
+                if message.timestamp < cutoff:
+                    # History is newest first, so the rest is old too
+                    await self._flush(batch)
+                    batch = []
+                    await self._delete([message])
+                else:
+                    batch.append(message)
+                    if len(batch) == self.BULK_LIMIT:
+                        await self._flush(batch)
+                        batch = []
+                
+                if self.matched >= self.limit:
+                    break
+                
+                if progress is not None and \
+                    time.monotonic() - updated >= self.PROGRESS_INTERVAL:
+                    updated = time.monotonic()
+                    progress = await self.bot.edit_message(progress,
+                        f'Purging... {self.status()}')
+            
+            await self._flush(batch)
+            await self._flush([])
+        except Exception:
+            if self._deleting is not None:
+                self._deleting.cancel()
+            raise
+    
+    async def _flush(self, batch):
+        """Wait for the last batch to be deleted, and start on batch"""
+        if self._deleting is not None:
+            deleting, self._deleting = self._deleting, None
+            await deleting
+        if batch:
+            self._deleting = self.bot.loop.create_task(self._delete(batch))
+    
+    async def _delete(self, messages):
+        try:
+            if len(messages) == 1:
+                await self.bot.delete_message(messages[0])
+            else:
+                await self.bot.delete_messages(messages)
+        except discord.Forbidden:
+            raise
+        except discord.HTTPException:
+            self.failed += len(messages)
+        else:
+            self.deleted += len(messages)
+
+
+def permission_bits(**flags):
+    """The value of a discord.Permissions with just flags set"""
+    permissions = discord.Permissions.none()
+    for name, value in flags.items():
+        setattr(permissions, name, value)
+    return permissions.value
 
 
 class Moderation(Extension):
     """moderation commands"""
+    # Actions on more than this many messages or members need confirming
+    CONFIRM_OVER = 10
+    
+    # Members acted on at once by !bulk commands
+    BULK_CONCURRENCY = 4
+    
+    # Channels !lock and !unlock change at once; each channel's permissions
+    #   are rate limited separately
+    LOCK_CONCURRENCY = 8
+    
+    # What !lock takes away, by channel type
+    LOCKED = {
+        discord.ChannelType.text:
+            permission_bits(send_messages=True, add_reactions=True),
+        discord.ChannelType.voice:
+            permission_bits(connect=True, speak=True),
+    }
+    
+    # Members kicked by !grape when it isn't told how many
+    GRAPE_DEFAULT = 5
+    
+    DURATION_UNITS = {
+        's': datetime.timedelta(seconds=1),
+        'm': datetime.timedelta(minutes=1),
+        'h': datetime.timedelta(hours=1),
+        'd': datetime.timedelta(days=1),
+        'w': datetime.timedelta(weeks=1),
+    }
+    DURATION = re.compile(r'(\d+)\s*([smhdw])$')
+    
+    def __init__(self, bot):
+        super().__init__(bot)
+        
+        # The !bulk job running in each server, and the permission needed
+        #   to cancel it, by server ID
+        self.jobs = {}
+        
+        # Who posted in each channel lately, for !grape
+        self.recent = RecentAuthors()
+    
+    async def init_storage(self):
+        await super().init_storage()
+        sizes = await self.storage.hgetall('recent_size')
+        for server_id, size in sizes.items():
+            self.recent.set_size(server_id, int(size))
+    
+    async def on_message(self, message):
+        self.recent.record(message)
+    
+    async def on_channel_delete(self, channel):
+        self.recent.forget_channel(channel)
+    
+    async def on_server_remove(self, server):
+        self.recent.forget_server(server)
+    
+    def duration(self, text):
+        """A timedelta from text like 30s, 5m, 2h, 1d or 1w, or None"""
+        match = self.DURATION.match(text.lower())
+        if not match:
+            return None
+        n, unit = match.groups()
+        return int(n) * self.DURATION_UNITS[unit]
+    
+    def spared(self, ctx):
+        """IDs of members never acted on in bulk: the bot, owner and invoker"""
+        server = ctx.message.server
+        return {server.me.id, server.owner.id, ctx.message.author.id}
+    
+    async def confirm(self, ctx, warning, word):
+        """Ask the author to confirm by sending word within 20 seconds"""
+        reply = await self.bot.say(warning + \
+            f'\nPlease confirm with `{word}` in 20 seconds')
+        confirm = await self.bot.wait_for_message(timeout=20,
+            author=ctx.message.author, channel=ctx.message.channel,
+            content=word)
+        await self.bot.delete_message(reply)
+        if confirm:
+            await self.bot.delete_message(confirm)
+        return bool(confirm)
+    
     @commands.command(pass_context=True,no_pm=True)
     @commands.has_permissions(kick_members=True)
     async def kick(self, ctx,member_name:str):
@@ -16,18 +230,20 @@ class Moderation(Extension):
             await self.bot.kick(member)
         else:
             await self.bot.say("Sorry, couldn't find that member")
+            return
     
         await self.bot.say(f'A OK! {member.name} has been kicked')
     
     @commands.command(pass_context=True,no_pm=True)
     @commands.has_permissions(ban_members=True)
-    async def ban(self, *,member_name:str):
+    async def ban(self, ctx, *,member_name:str):
         """Ban a member"""
         member = self.bot.get_user(ctx, member_name)
         if member:
             await self.bot.ban(member, 0)
         else:
             await self.bot.say("Sorry, couldn't find that member")
+            return
     
         await self.bot.say(f'A OK! {member.name} has been banned')
     
@@ -54,6 +270,7 @@ class Moderation(Extension):
                 member, mute=not member.voice.mute)
         else:
             await self.bot.say("Sorry, couldn't find that member")
+            return
     
         await self.bot.say(f'A OK! {member.name} has been muted')
         
@@ -68,6 +285,7 @@ class Moderation(Extension):
                 member, deafen=not member.voice.deaf)
         else:
             await self.bot.say("Sorry, couldn't find that member")
+            return
     
         await self.bot.say(f'A OK! {member.name} has been muted')
         
@@ -78,13 +296,15 @@ class Moderation(Extension):
         """Add a user to a role"""
         member = self.bot.get_user(ctx, member_name)
         if member:
-            role = self.get_role(ctx, role_name)
+            role = self.bot.get_role(ctx, role_name)
             if role:
                 await self.bot.add_roles(member, role)
             else:
                 await self.bot.say("Sorry, couldn't find that roll")
+                return
         else:
             await self.bot.say("Sorry, couldn't find that member")
+            return
     
         await self.bot.say(f'A OK!  I have added {member.name} to {role.name}')
     
@@ -95,13 +315,15 @@ class Moderation(Extension):
         """Remove a user from a role"""
         member = self.bot.get_user(ctx, member_name)
         if member:
-            role = self.get_role(ctx, role_name)
+            role = self.bot.get_role(ctx, role_name)
             if role:
                 await self.bot.remove_roles(member, role)
             else:
                 await self.bot.say("Sorry, couldn't find that roll")
+                return
         else:
             await self.bot.say("Sorry, couldn't find that member")
+            return
     
         await self.bot.say( \
             f'A OK!  I have removed {member.name} from {role.name}')
@@ -109,75 +331,511 @@ class Moderation(Extension):
     @commands.command(pass_context=True,no_pm=True)
     @commands.has_permissions(manage_messages=True)
     async def purge(self, ctx, *args:str):
-        """Delete lots messages"""
+        """
+        Delete lots messages
+        !purge [number] [members...] deletes the last [number] messages (5
+        by default), or the last [number] from the given members
+        """
         await self.bot.type()
         
         limit = 5
-        check = None
-        m = None
-        go = True
+        if args and args[0].isdecimal():
+            limit = int(args[0])
+            args = args[1:]
         
-        if len(args) == 0:
-            limit = 5
-            m = 'Deleted 5 messages'
-            
-        elif len(args) == 1:
-            arg = args[0]
+        authors = None
+        if args:
+            authors = set()
+            for name in args:
+                member = self.bot.get_user(ctx, name)
+                if member is None:
+                    await self.bot.say(f"I don't know who {name} is")
+                    return
+                authors.add(member.id)
+        
+        if limit > self.CONFIRM_OVER:
+            if not await self.confirm(ctx,
+                'You are about to delete alot of messages.', 'DELETE'):
+                return
+        
+        await self.bot.delete_message(ctx.message)
+        progress = await self.bot.say('Purging...')
+        
+        purge = Purge(self.bot, ctx.message.channel, limit, authors,
+            before=ctx.message)
+        try:
+            await purge.run(progress)
+            m = purge.status()
+            if authors:
+                m += ' from ' + ', '.join(args)
+        except discord.Forbidden:
+            m = "Sorry, I'm not allowed to delete messages here"
+        
+        reply = await self.bot.edit_message(progress, m)
+        await asyncio.sleep(5)
+        await self.bot.delete_message(reply)
+
+    
+    def select(self, ctx, selectors):
+        """
+        The members picked by a !bulk command's selectors
+        Raises ValueError if a selector doesn't make sense
+        """
+        server = ctx.message.server
+        named = None
+        filters = []
+        
+        for selector in selectors:
+            kind, _, value = selector.partition(':')
+            kind = kind.lower()
+            if kind == 'role' and value:
+                role = self.bot.get_role(ctx, value)
+                if role is None:
+                    raise ValueError(f"I don't know the role {value}")
+                filters.append(lambda m, role=role: role in m.roles)
             
-            if arg.isdecimal():
-                limit = int(arg)
-                m = 'Deleted {} messages'.format(arg)
-                
-            else:
-                member = self.bot.get_user(ctx, arg)
-                if member:
-                    limit = 5
-                    check = lambda m: m.author == member
-                    m = f'Deleted 5 messages from {member.name}'
-                else:
-                    go = False
-                    m = f"I don't know what to do with {arg}"
+            elif kind == 'joined' and value:
+                ago = self.duration(value)
+                if ago is None:
+                    raise ValueError(f"I don't understand joined:{value}; " + \
+                        'try something like joined:30m, 2h, 1d or 1w')
+                since = datetime.datetime.utcnow() - ago
+                filters.append(lambda m, since=since:
+                    m.joined_at is not None and m.joined_at >= since)
             
-        else:
-            if args[0].isdecimal():
-                limit = int(args[0])
-                
-                members = list(filter(lambda x: x.name in args[1:] or
-                                           x.mention in args[1:] or
-                                           x.nick in args[1:],
-                                ctx.message.server.members))
-                check = lambda m: m.author in members
-                
-                m = 'Deleted {} messages from {}'.format(args[0], ','.join(args[1:]))
+            elif kind == 'name' and value:
+                pattern = value.casefold()
+                filters.append(lambda m, pattern=pattern: any(
+                    fnmatch.fnmatchcase(n.casefold(), pattern)
+                    for n in (m.name, m.nick) if n))
             
             else:
-                go = False
-                m = 'First argument must specify the number of messages to ' + \
-                    'delete'
-            
-        if go:
-            if limit > 10:
-                warning =  'You are about to delete alot of messages.'
-                warning += '\nPlease confirm with `DELETE` in 20 seconds'
-                reply = await self.bot.say(warning)
-                confirm = await self.bot.wait_for_message(timeout=20,
-                    author=ctx.message.author, channel=ctx.message.channel,
-                    content='DELETE')
-                await self.bot.delete_message(reply)
-                if not confirm:
+                member = self.bot.get_user(ctx, selector)
+                if member is None:
+                    raise ValueError(f"I don't know who {selector} is")
+                if named is None:
+                    named = {}
+                named[member.id] = member
+        
+        members = named.values() if named is not None else server.members
+        
+        spared = self.spared(ctx)
+        return [m for m in members if m.id not in spared and
+                all(f(m) for f in filters)]
+    
+    async def run_bulk(self, ctx, selectors, verb, doing, action, permission):
+        """
+        Run action on every member selectors pick, reporting progress by
+        editing one message
+        verb and doing describe the action, like 'kick' and 'Kicking', and
+        permission is the one it needs, like 'kick_members'
+        """
+        await self.bot.type()
+        if not selectors:
+            await self.bot.say('Which members?  Try `!help bulk`')
+            return
+        
+        try:
+            members = self.select(ctx, selectors)
+        except ValueError as e:
+            await self.bot.say(str(e))
+            return
+        await self.run_job(ctx, members, verb, doing, action, permission)
+    
+    async def run_job(self, ctx, members, verb, doing, action, permission):
+        """Run action on members, like run_bulk does once they're picked"""
+        server = ctx.message.server
+        if server.id in self.jobs:
+            await self.bot.say('There is already a bulk action running ' + \
+                'here.  Use `!bulk cancel` to stop it')
+            return
+        if not members:
+            await self.bot.say('No members match that')
+            return
+        
+        # discord.py rate limits member edits per server, so running more
+        #   than one at a time wouldn't get through them any faster
+        job = BulkJob(action, members, self.BULK_CONCURRENCY,
+            bucket=lambda m: m.server.id, loop=self.bot.loop)
+        
+        # Taken before waiting for confirmation, so a second command can't
+        #   start another job in the meantime
+        self.jobs[server.id] = (job, permission)
+        try:
+            if len(members) > self.CONFIRM_OVER:
+                if not await self.confirm(ctx,
+                    f'You are about to {verb} {len(members)} members.', 'YES'):
                     return
+            await self.watch(job, doing, 'members')
+        finally:
+            if self.jobs.get(server.id, (None,))[0] is job:
+                del self.jobs[server.id]
+        self.log.info(f'Bulk {verb} in {server.id}: {job.summary()}')
+    
+    async def watch(self, job, doing, noun):
+        """Run job, editing its progress and then its summary into a message"""
+        progress = await self.bot.say(f'{doing} {job.total} {noun}...')
+        async def report(job):
+            nonlocal progress
+            progress = await self.bot.edit_message(progress,
+                f'{doing} {job.total} {noun}... {job.status()}')
+        
+        await job.run(report)
+        await self.bot.edit_message(progress,
+            f'{doing} {job.total} {noun}: {job.summary()}')
+    
+    @commands.group(pass_context=True,no_pm=True,invoke_without_command=True)
+    async def bulk(self, ctx):
+        """
+        Moderate lots of members at once
+        Pick members with any mix of
+            names, mentions or IDs  those members
+            role:<role>             members with that role
+            joined:<30m|2h|1d|1w>   members who joined that recently
+            name:<pattern>          members whose name or nick matches a
+                                    pattern like raider*
+        Named members are narrowed down by the other selectors, or if none
+        are named, everyone is.  Examples:
+        > !bulk kick joined:1h name:spam*
+        > !bulk role Member role:Newbie joined:1w
+        """
+        await self.bot.say(f'Try `!help {ctx.command}`')
+    
+    @bulk.command(pass_context=True,no_pm=True)
+    async def cancel(self, ctx):
+        """Stop the bulk action running in this server"""
+        running = self.jobs.get(ctx.message.server.id)
+        if running is None:
+            await self.bot.say('There is no bulk action running here')
+            return
+        
+        # Only someone who could have started the job can stop it
+        job, permission = running
+        allowed = ctx.message.channel.permissions_for(ctx.message.author)
+        if not getattr(allowed, permission):
+            await self.bot.say('Sorry, stopping this bulk action needs ' + \
+                f'the {permission} permission')
+            return
+        job.cancel()
+        await self.bot.say('Stopping once the members in progress are done')
+    
+    @bulk.command(name='kick',pass_context=True,no_pm=True)
+    @commands.has_permissions(kick_members=True)
+    async def bulk_kick(self, ctx, *selectors:str):
+        """Kick lots of members"""
+        await self.run_bulk(ctx, selectors, 'kick', 'Kicking', self.bot.kick,
+            'kick_members')
+    
+    @bulk.command(name='ban',pass_context=True,no_pm=True)
+    @commands.has_permissions(ban_members=True)
+    async def bulk_ban(self, ctx, *selectors:str):
+        """Ban lots of members"""
+        async def ban(member):
+            await self.bot.ban(member, 0)
+        await self.run_bulk(ctx, selectors, 'ban', 'Banning', ban,
+            'ban_members')
+    
+    @bulk.command(name='mute',pass_context=True,no_pm=True)
+    @commands.has_permissions(ban_members=True)
+    async def bulk_mute(self, ctx, *selectors:str):
+        """Mute lots of members"""
+        async def mute(member):
+            await self.bot.server_voice_state(member, mute=True)
+        await self.run_bulk(ctx, selectors, 'mute', 'Muting', mute,
+            'ban_members')
+    
+    @bulk.command(name='unmute',pass_context=True,no_pm=True)
+    @commands.has_permissions(ban_members=True)
+    async def bulk_unmute(self, ctx, *selectors:str):
+        """Unmute lots of members"""
+        async def unmute(member):
+            await self.bot.server_voice_state(member, mute=False)
+        await self.run_bulk(ctx, selectors, 'unmute', 'Unmuting', unmute,
+            'ban_members')
+    
+    @bulk.command(name='deafen',pass_context=True,no_pm=True)
+    @commands.has_permissions(deafen_members=True)
+    async def bulk_deafen(self, ctx, *selectors:str):
+        """Deafen lots of members"""
+        async def deafen(member):
+            await self.bot.server_voice_state(member, deafen=True)
+        await self.run_bulk(ctx, selectors, 'deafen', 'Deafening', deafen,
+            'deafen_members')
+    
+    @bulk.command(name='undeafen',pass_context=True,no_pm=True)
+    @commands.has_permissions(deafen_members=True)
+    async def bulk_undeafen(self, ctx, *selectors:str):
+        """Undeafen lots of members"""
+        async def undeafen(member):
+            await self.bot.server_voice_state(member, deafen=False)
+        await self.run_bulk(ctx, selectors, 'undeafen', 'Undeafening',
+            undeafen, 'deafen_members')
+    
+    @bulk.command(name='role',pass_context=True,no_pm=True)
+    @commands.has_permissions(manage_roles=True)
+    async def bulk_role(self, ctx, role_name:str, *selectors:str):
+        """Add lots of members to a role"""
+        role = self.bot.get_role(ctx, role_name)
+        if role is None:
+            await self.bot.say("Sorry, couldn't find that roll")
+            return
+        async def add(member):
+            if role not in member.roles:
+                await self.bot.add_roles(member, role)
+        await self.run_bulk(ctx, selectors, f'add to {role.name}',
+            f'Adding to {role.name}:', add, 'manage_roles')
+    
+    @bulk.command(name='unrole',pass_context=True,no_pm=True)
+    @commands.has_permissions(manage_roles=True)
+    async def bulk_unrole(self, ctx, role_name:str, *selectors:str):
+        """Remove lots of members from a role"""
+        role = self.bot.get_role(ctx, role_name)
+        if role is None:
+            await self.bot.say("Sorry, couldn't find that roll")
+            return
+        async def remove(member):
+            if role in member.roles:
+                await self.bot.remove_roles(member, role)
+        await self.run_bulk(ctx, selectors, f'remove from {role.name}',
+            f'Removing from {role.name}:', remove, 'manage_roles')
+
+    @commands.group(pass_context=True,no_pm=True,invoke_without_command=True)
+    @commands.has_permissions(kick_members=True)
+    async def grape(self, ctx, amount:str=None):
+        """
+        Kick the last few members who sent messages in this channel
+        amount is how many members (5 if not given), or how far back to
+        look, like 30s, 5m or 1h
+        > !grape 3
+        > !grape 2m
+        """
+        await self.bot.type()
+        channel = ctx.message.channel
+        server = ctx.message.server
+        
+        # Members who are spared or already gone don't count
+        spared = self.spared(ctx)
+        def keep(author_id):
+            return author_id not in spared and \
+                server.get_member(author_id) is not None
+        
+        if amount is None or amount.isdigit():
+            n = int(amount) if amount else self.GRAPE_DEFAULT
+            authors = self.recent.last(channel, n, keep)
+        else:
+            ago = self.duration(amount)
+            if ago is None:
+                await self.bot.say(f"I don't understand {amount}; " + \
+                    'try a number of members, or something like 30s or 5m')
+                return
+            authors = self.recent.since(channel, ago.total_seconds(), keep)
+        
+        members = [server.get_member(a) for a in authors]
+        if not members:
+            await self.bot.say("I haven't seen anyone to kick here")
+            return
+        await self.run_job(ctx, members, 'kick', 'Kicking', self.bot.kick,
+            'kick_members')
+    
+    @grape.command(pass_context=True,no_pm=True)
+    @commands.has_permissions(manage_server=True)
+    async def remember(self, ctx, messages:int=None):
+        """
+        Show or set how many messages per channel !grape remembers
+        Only messages since the bot (or this extension) last started count.
+        """
+        server = ctx.message.server
+        if messages is None:
+            size = self.recent.size(server.id)
+            await self.bot.say(f'I remember the last {size} messages ' + \
+                'in each channel')
+            return
+        
+        size = self.recent.set_size(server.id, messages)
+        await self.storage.hset('recent_size', server.id, size)
+        await self.bot.say(f'I will remember the last {size} messages ' + \
+            'in each channel')
+
+    def lock_changes(self, channel):
+        """
+        The overwrites that lock channel, as a list of ('role' or 'member',
+        ID, (allow, deny) now or None if there's no overwrite,
+        (allow, deny) locked)
+        @everyone is denied the channel's LOCKED permissions, and other roles
+        and members lose them from their overwrites, unless they can manage
+        messages.
+        """
+        locked = self.LOCKED.get(channel.type)
+        if locked is None:
+            return []
+        
+        server = channel.server
+        everyone = server.default_role.id
+        changes = []
+        if not any(o.id == everyone and o.type == 'role'
+                   for o in channel._permission_overwrites):
+            changes.append(('role', everyone, None, (0, locked)))
+        
+        for o in channel._permission_overwrites:
+            before = (o.allow, o.deny)
+            if o.type == 'role' and o.id == everyone:
+                after = (o.allow & ~locked, o.deny | locked)
+            else:
+                if o.type == 'role':
+                    target = discord.utils.get(server.roles, id=o.id)
+                    permissions = target and target.permissions
                 else:
-                    await self.bot.delete_message(confirm)
-                await asyncio.sleep(0.5)
-                
-            await self.bot.delete_message(ctx.message)
-            await asyncio.sleep(0.5)
-            await self.bot.purge_from(
-                ctx.message.channel, limit=limit, check=check)
-                    
-        reply = await self.bot.say(m)
-        await asyncio.sleep(5)
-        await self.bot.delete_message(reply)
+                    # Members who left keep their overwrites if they rejoin
+                    target = server.get_member(o.id)
+                    permissions = target and target.server_permissions
+                if permissions and (permissions.administrator or
+                                    permissions.manage_messages):
+                    continue
+                after = (o.allow & ~locked, o.deny)
+            if after != before:
+                changes.append((o.type, o.id, before, after))
+        return changes
+    
+    async def set_overwrite(self, channel, type, id, pair):
+        """
+        Set a role's or member's (allow, deny) overwrite in channel, or
+        remove it
+        Goes by ID, since members who left can still have overwrites
+        """
+        if type == 'role' and \
+            discord.utils.get(channel.server.roles, id=id) is None:
+            # Deleted roles take their overwrites with them
+            return
+        if pair is None:
+            await self.bot.http.delete_channel_permissions(channel.id, id)
+        else:
+            allow, deny = pair
+            await self.bot.http.edit_channel_permissions(channel.id, id,
+                allow, deny, type)
+    
+    def pick_channels(self, ctx, names, everything):
+        """
+        The channels in names, this channel if there are none, or everything
+        if names is just 'all'
+        Raises ValueError for names that aren't channels
+        """
+        if not names:
+            return [ctx.message.channel]
+        if len(names) == 1 and names[0].lower() == 'all':
+            return list(everything)
+        
+        index = self.bot.directory.server(ctx.message.server)
+        channels = {}
+        for name in names:
+            channel = index.channel(name)
+            if channel is None:
+                raise ValueError(f"I don't know the channel {name}")
+            channels[channel.id] = channel
+        return list(channels.values())
+    
+    @commands.command(pass_context=True,no_pm=True)
+    @commands.has_permissions(manage_roles=True)
+    async def lock(self, ctx, *channels:str):
+        """
+        Lock down channels, so only moderators can post or talk there
+        Locks this channel, the channels named, or every channel with `all`.
+        Roles and members that can manage messages keep any permissions given
+        to them in the channels.  !unlock puts the permissions back exactly as
+        they were.
+        > !lock
+        > !lock #general #memes
+        > !lock all
+        """
+        await self.bot.type()
+        server = ctx.message.server
+        try:
+            channels = self.pick_channels(ctx, channels, server.channels)
+        except ValueError as e:
+            await self.bot.say(str(e))
+            return
+        
+        # Locking a channel twice would overwrite what unlocking restores
+        key = f'locked:{server.id}'
+        ids = [c.id for c in channels]
+        saved = await self.storage.hmget(key, *ids, encoding=None) if ids else []
+        changes = {}
+        for channel, snapshot in zip(channels, saved):
+            if snapshot is None:
+                change = self.lock_changes(channel)
+                if change:
+                    changes[channel.id] = change
+        channels = [c for c in channels if c.id in changes]
+        if not channels:
+            await self.bot.say('Nothing to lock; ' + \
+                'those channels are already locked')
+            return
+        
+        # Save every snapshot in one go before changing anything, so even a
+        #   lock that fails half way can be undone
+        async with self.storage.pipeline() as p:
+            for channel in channels:
+                p.hset_obj(key, channel.id, [[type, id, before]
+                    for type, id, before, _ in changes[channel.id]])
+        
+        async def lock(channel):
+            for type, id, _, after in changes[channel.id]:
+                await self.set_overwrite(channel, type, id, after)
+        
+        # Each channel has its own rate limit bucket for permission edits
+        job = BulkJob(lock, channels, self.LOCK_CONCURRENCY,
+            bucket=lambda c: c.id, loop=self.bot.loop)
+        await self.watch(job, 'Locking', 'channels')
+        self.log.info(f'Locked channels in {server.id}: {job.summary()}')
+    
+    @commands.command(pass_context=True,no_pm=True)
+    @commands.has_permissions(manage_roles=True)
+    async def unlock(self, ctx, *channels:str):
+        """
+        Undo !lock, putting channels' permissions back as they were
+        Unlocks this channel, the channels named, or every locked channel
+        with `all`.
+        """
+        await self.bot.type()
+        server = ctx.message.server
+        key = f'locked:{server.id}'
+        
+        raw = await self.storage.hgetall(key, encoding=None)
+        snapshots = {id.decode() if isinstance(id, bytes) else id:
+                     self.storage.codecs.decode(data)
+                     for id, data in raw.items()}
+        
+        locked = [server.get_channel(id) for id in snapshots]
+        try:
+            channels = self.pick_channels(ctx, channels,
+                [c for c in locked if c is not None])
+        except ValueError as e:
+            await self.bot.say(str(e))
+            return
+        
+        # Forget channels deleted while they were locked
+        gone = [id for id in snapshots if server.get_channel(id) is None]
+        if gone:
+            await self.storage.hdel(key, *gone)
+        
+        channels = [c for c in channels if c.id in snapshots]
+        if not channels:
+            await self.bot.say('Nothing to unlock; ' + \
+                "those channels aren't locked")
+            return
+        
+        restored = []
+        async def unlock(channel):
+            for type, id, before in snapshots[channel.id]:
+                await self.set_overwrite(channel, type, id,
+                    tuple(before) if before is not None else None)
+            restored.append(channel.id)
+        
+        job = BulkJob(unlock, channels, self.LOCK_CONCURRENCY,
+            bucket=lambda c: c.id, loop=self.bot.loop)
+        await self.watch(job, 'Unlocking', 'channels')
+        if restored:
+            await self.storage.hdel(key, *restored)
+        self.log.info(f'Unlocked channels in {server.id}: {job.summary()}')
 
     
 def setup(bot):
@@ -1,7 +1,13 @@
 import re
 import os
+import sys
 import logging
 import json
+import time
+import uuid
+import heapq
+import itertools
+import collections
 import asyncio
 import functools
 import aiofiles
@@ -12,44 +18,343 @@ import atexit
 import discord
 from concurrent.futures import CancelledError
 from discord.ext import commands
-from pytz import timezone
+from discord.ext.commands.view import StringView
+from dateutil import rrule
+from sortedcontainers import SortedKeyList
 
+from robohound import timeparse
 from robohound.base import Extension
+from robohound.codecs import StructCodec
+from robohound.metrics import DispatchStats
+from robohound.utils import paginate
+
+
+# Saved items are stored as the due timestamp, channel, server and author IDs
+#   packed into 32 bytes, followed by the content.  Version 1 had no server.
+SAVED_CODEC_V1 = StructCodec('saved', b's',
+    (('when', 'd'), ('channel', 'S'), ('author', 'S')), tail='content')
+SAVED_CODEC = StructCodec('saved', b's',
+    (('when', 'd'), ('channel', 'S'), ('server', 'S'), ('author', 'S')),
+    tail='content', version=2)
+
+
+# Saved items live in three places in the database:
+#   'items': hash of id: payload
+#   'due': sorted set of ids waiting to fire, scored by due timestamp
+#   'leases': sorted set of ids being run, scored by when the lease runs out,
+#       with the process that holds each lease in the 'leased_by' hash
+# Any number of processes can share them; each due item is leased by exactly
+#   one of them, and goes back on 'due' if that process dies before finishing
+
+
+# Lease up to ARGV[3] items due between ARGV[5] and ARGV[1] to ARGV[4] until
+#   ARGV[2]
+#   KEYS: due, leases, leased_by
+#   Returns the leased ids
+CLAIM_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[5], ARGV[1],
+    'LIMIT', 0, ARGV[3])
+for _, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+    redis.call('ZADD', KEYS[2], ARGV[2], id)
+    redis.call('HSET', KEYS[3], id, ARGV[4])
+end
+return ids
+"""
+
+async def _claim_emulated(redis, keys, args):
+    due, leases, leased_by = keys
+    now, until, count, owner, since = args
+    ids = await redis.zrangebyscore(due, float(since), float(now), offset=0,
+        count=int(count))
+    for id_ in ids:
+        await redis.zrem(due, id_)
+        await redis.zadd(leases, float(until), id_)
+        await redis.hset(leased_by, id_, owner)
+    return ids
+
+
+# Delete leased item ARGV[1], if ARGV[2] still holds the lease
+#   KEYS: leases, leased_by, items
+COMPLETE_SCRIPT = """
+if redis.call('HGET', KEYS[2], ARGV[1]) == ARGV[2] then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+async def _complete_emulated(redis, keys, args):
+    leases, leased_by, items = keys
+    id_, owner = args
+    if await redis.hget(leased_by, id_) == owner:
+        await redis.zrem(leases, id_)
+        await redis.hdel(leased_by, id_)
+        await redis.hdel(items, id_)
+        return 1
+    return 0
+
+
+# Extend ARGV[2]'s leases on items ARGV[3:] until ARGV[1]
+#   KEYS: leases, leased_by
+#   Returns the number of leases extended
+RENEW_SCRIPT = """
+local renewed = 0
+for i = 3, #ARGV do
+    if redis.call('HGET', KEYS[2], ARGV[i]) == ARGV[2] then
+        redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i])
+        renewed = renewed + 1
+    end
+end
+return renewed
+"""
+
+async def _renew_emulated(redis, keys, args):
+    leases, leased_by = keys
+    until, owner, *ids = args
+    renewed = 0
+    for id_ in ids:
+        if await redis.hget(leased_by, id_) == owner:
+            await redis.zadd(leases, float(until), id_)
+            renewed += 1
+    return renewed
+
+
+# Put up to ARGV[2] items whose leases ran out by ARGV[1] back on due
+#   KEYS: leases, leased_by, due
+#   Returns the number of items put back
+REAP_SCRIPT = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+    'LIMIT', 0, ARGV[2])
+for _, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+    redis.call('HDEL', KEYS[2], id)
+    redis.call('ZADD', KEYS[3], ARGV[1], id)
+end
+return #ids
+"""
+
+async def _reap_emulated(redis, keys, args):
+    leases, leased_by, due = keys
+    now, count = args
+    ids = await redis.zrangebyscore(leases, max=float(now), offset=0,
+        count=int(count))
+    for id_ in ids:
+        await redis.zrem(leases, id_)
+        await redis.hdel(leased_by, id_)
+        await redis.zadd(due, float(now), id_)
+    return len(ids)
+
+
+# Put leased item ARGV[1] back on due at ARGV[4] with payload ARGV[3], if
+#   ARGV[2] still holds the lease
+#   KEYS: leases, leased_by, items, due
+RESCHEDULE_SCRIPT = """
+if redis.call('HGET', KEYS[2], ARGV[1]) == ARGV[2] then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+    redis.call('ZADD', KEYS[4], ARGV[4], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+async def _reschedule_emulated(redis, keys, args):
+    leases, leased_by, items, due = keys
+    id_, owner, payload, when = args
+    if await redis.hget(leased_by, id_) == owner:
+        await redis.zrem(leases, id_)
+        await redis.hdel(leased_by, id_)
+        await redis.hset(items, id_, payload)
+        await redis.zadd(due, float(when), id_)
+        return 1
+    return 0
+
+
+# Take waiting item ARGV[1] out of the database, returning 1 only if it
+#   hadn't been leased yet
+#   KEYS: due, items
+CANCEL_SCRIPT = """
+if redis.call('ZREM', KEYS[1], ARGV[1]) == 1 then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    return 1
+end
+return 0
+"""
+
+async def _cancel_emulated(redis, keys, args):
+    if await redis.zrem(keys[0], args[0]):
+        await redis.hdel(keys[1], args[0])
+        return 1
+    return 0
+
+
+# Re-encode items that are still waiting and unchanged since they were read.
+#   ARGV holds (id, payload read, new payload) for each item.
+#   KEYS: due, items
+#   Returns the number of items re-encoded
+UPGRADE_SCRIPT = """
+local upgraded = 0
+for i = 1, #ARGV, 3 do
+    if redis.call('ZSCORE', KEYS[1], ARGV[i]) and
+        redis.call('HGET', KEYS[2], ARGV[i]) == ARGV[i + 1] then
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 2])
+        upgraded = upgraded + 1
+    end
+end
+return upgraded
+"""
+
+async def _upgrade_emulated(redis, keys, args):
+    due, items = keys
+    upgraded = 0
+    for i in range(0, len(args), 3):
+        id_, old, new = args[i:i + 3]
+        if isinstance(old, str):
+            # Redis gets every argument as bytes
+            old = old.encode('utf-8')
+        if await redis.zscore(due, id_) is not None and \
+            await redis.hget(items, id_, encoding=None) == old:
+            await redis.hset(items, id_, new)
+            upgraded += 1
+    return upgraded
+
+
+# Move legacy items off the tail of the old 'saved' list.  ARGV holds
+#   (legacy value, id, payload, timestamp) for each item, starting from the
+#   tail, and each is only moved if it's still at the tail, so processes
+#   migrating at the same time never move an item twice or lose one.
+#   KEYS: saved, items, due
+#   Returns the number of items moved
+MIGRATE_SCRIPT = """
+local moved = 0
+for i = 1, #ARGV, 4 do
+    if redis.call('LINDEX', KEYS[1], -1) ~= ARGV[i] then
+        break
+    end
+    redis.call('RPOP', KEYS[1])
+    redis.call('HSET', KEYS[2], ARGV[i + 1], ARGV[i + 2])
+    redis.call('ZADD', KEYS[3], ARGV[i + 3], ARGV[i + 1])
+    moved = moved + 1
+end
+return moved
+"""
+
+async def _migrate_emulated(redis, keys, args):
+    saved, items, due = keys
+    moved = 0
+    for i in range(0, len(args), 4):
+        data, id_, payload, when = args[i:i + 4]
+        if await redis.lrange(saved, -1, -1) != [data]:
+            break
+        await redis.rpop(saved)
+        await redis.hset(items, id_, payload)
+        await redis.zadd(due, float(when), id_)
+        moved += 1
+    return moved
+
+
+# Parsed rules are shared between recurring items with the same rule text
+_parse_rule = functools.lru_cache(maxsize=1024)(rrule.rrulestr)
+
+
+class Resolver:
+    """
+    Finds the Discord objects saved items refer to by ID
+    Looking a channel up by ID means searching every server, so the most
+    recently used ones are remembered.  Servers and members are already
+    kept in dicts by discord.py.
+    """
+    CACHE_SIZE = 256
+    
+    def __init__(self, bot):
+        self.bot = bot
+        self._channels = collections.OrderedDict()
+    
+    def channel(self, channel_id):
+        channel = self._channels.get(channel_id)
+        if channel is not None:
+            self._channels.move_to_end(channel_id)
+            return channel
+        
+        channel = self.bot.get_channel(channel_id)
+        if channel is not None:
+            self._channels[channel_id] = channel
+            if len(self._channels) > self.CACHE_SIZE:
+                self._channels.popitem(last=False)
+        return channel
+    
+    def server(self, server_id):
+        return self.bot.get_server(server_id) if server_id else None
+    
+    def member(self, server_id, member_id):
+        server = self.server(server_id)
+        return server.get_member(member_id) if server is not None else None
+    
+    def forget(self, channel_id):
+        """Drop a channel that was deleted"""
+        self._channels.pop(channel_id, None)
 
 
 class Saved:
-    """Base class for saved items"""
+    """
+    Base class for saved items
+    Only IDs are kept; the channel, server and author objects are looked up
+    through the Resolver when the item is shown or run.
+    """
+    __slots__ = ('resolver', 'id', 'content', 'timestamp', 'channel_id',
+                 'server_id', 'author_id', '_canceled', '_completed')
+    
+    # Codec the item is stored with; None is the registry's default
+    CODEC = 'saved'
+    
     def __str__(self):
-        return f'{self.author.name} scheduled "{self.content}" for ' + \
+        author = self.author
+        name = author.name if author is not None else 'Someone'
+        return f'{name} scheduled "{self.content}" for ' + \
             f'{self.when:%a, %b %d, %Y at %H:%M:%S %Z}'
         
-    def __init__(self, bot, content, when, channel, author):
-        self.bot = bot
+    def __init__(self, resolver, content, when, channel, author, id=None,
+                 server=None):
+        self.resolver = resolver
         self.content = content
         
+        # Stable identifier used as the item's key in the database
+        self.id = id or uuid.uuid4().hex
+        
         if isinstance(channel, 
             (discord.Channel, discord.PrivateChannel)):
-            self.channel = channel
+            self.channel_id = channel.id
+            server = getattr(channel, 'server', None)
+            self.server_id = server.id if server is not None else None
         elif isinstance(channel, str):
-            self.channel = bot.get_channel(channel)
+            # Lots of items share each channel, server and author, so they
+            #   share one copy of each ID too
+            self.channel_id = sys.intern(channel)
+            if server is None or server == '0':
+                # Records from before the server was saved
+                server = getattr(resolver.channel(channel), 'server', None)
+                server = server.id if server is not None else None
+            self.server_id = server and sys.intern(server)
         else:
             raise TypeError('"channel" must be a discord.Channel, ' + \
                 'discord.PrivateChannel, or str')
             
         if isinstance(when, datetime.datetime):
-            self.when = when
-        elif isinstance(when, float):
-            self.when = datetime.datetime.fromtimestamp(when)
+            self.timestamp = when.timestamp()
+        elif isinstance(when, (int, float)):
+            self.timestamp = float(when)
         else:
             raise TypeError('"when" must be a datetime.datetime, ' + \
                 'or float')
         
-        if isinstance(author, discord.Member):
-            self.author = author
-        elif isinstance(author, discord.User):
-            self.author = self.channel.server.get_member(author.id)
+        if isinstance(author, (discord.Member, discord.User)):
+            self.author_id = author.id
         elif isinstance(author, str):
-            self.author = self.channel.server.get_member(author)
+            self.author_id = sys.intern(author)
         else:
             raise TypeError('"author" must be a discord.Member, ' + \
                 'discord.User, or str')
@@ -57,18 +362,43 @@ class Saved:
         self._canceled = False
         self._completed = False
     
+    @property
+    def bot(self):
+        return self.resolver.bot
+    
+    @property
+    def channel(self):
+        return self.resolver.channel(self.channel_id)
+    
+    @property
+    def server(self):
+        return self.resolver.server(self.server_id)
+    
+    @property
+    def author(self):
+        return self.resolver.member(self.server_id, self.author_id)
+    
+    @property
+    def when(self):
+        """When the item is due, in UTC"""
+        return datetime.datetime.fromtimestamp(self.timestamp, pytz.utc)
+    
+    @when.setter
+    def when(self, when):
+        self.timestamp = when.timestamp()
+    
     def format(self, with_channel=False, with_server=False):
         m = str(self)
         if with_channel:
-            m += f' in {self.channel.mention}'
+            m += f' in <#{self.channel_id}>'
         if with_server:
-            m += f' in `{self.channel.server.name}`'
+            server = self.server
+            m += f' in `{server.name if server else "a private chat"}`'
         return m
     
     @property
     def wait_time(self):
-        now = datetime.datetime.now(tz=self.when.tzinfo)
-        return (self.when - now).total_seconds()
+        return self.timestamp - time.time()
     
     @property
     def overdue(self):
@@ -86,35 +416,30 @@ class Saved:
         return self._canceled
         
     async def execute(self):
-        if not self.overdue and not self.canceled:
-            await asyncio.sleep(self.wait_time)
+        if not self.canceled:
             return 1
         
     def encode(self, more={}):
         """Encode this object into a dict"""
         d = {'content': self.content,
-             'when': self.when.timestamp(),
-             'channel': self.channel.id,
-             'author': self.author.id}
+             'when': self.timestamp,
+             'channel': self.channel_id,
+             'server': self.server_id or '0',
+             'author': self.author_id}
         
         d.update(more)
         
         return d
-    
-    
-    @classmethod
-    def decode(class_, d, bot):
-        when = datetime.datetime.fromtimestamp(d['when'])
-        channel = bot.get_channel(d['channel'])
-        author = bot.get_user_info(d['author'])
-        return class_(bot, d['content'], when, channel, author)
 
 
 
 class SavedMessage(Saved):
     """This object holds a message for the bot to say at a certain time"""
-    def __init__(self, bot, message, when, channel, author):
-        super().__init__(bot, message, when, channel, author)
+    __slots__ = ()
+    
+    def __init__(self, resolver, message, when, channel, author, id=None,
+                 server=None):
+        super().__init__(resolver, message, when, channel, author, id, server)
     
     async def execute(self):
         resp = await super().execute()
@@ -126,33 +451,251 @@ class SavedMessage(Saved):
 
 
 
+# What a scheduled command gets as ctx.message: the parts of a message that
+#   commands look at, without a real message behind it
+CommandMessage = collections.namedtuple('CommandMessage',
+    ('id', 'content', 'channel', 'server', 'author', 'timestamp'))
+
+
+class Invocation:
+    """
+    A command resolved from a saved item's content, ready to run without
+    going back through bot.process_commands
+    chain is the command and the groups above it, from the top level down,
+    and args is the rest of the content, left for the command to parse.
+    """
+    __slots__ = ('chain', 'args')
+    
+    PREFIX = '!'
+    
+    def __init__(self, chain, args):
+        self.chain = chain
+        self.args = args
+    
+    @classmethod
+    def resolve(class_, bot, content):
+        """
+        Find the command content invokes
+        Raises commands.CommandNotFound if there isn't one
+        """
+        view = StringView(content)
+        view.skip_string(class_.PREFIX)
+        
+        chain = []
+        group = bot
+        while isinstance(group, commands.GroupMixin):
+            view.skip_ws()
+            start = view.index
+            word = view.get_word()
+            command = group.commands.get(word)
+            if command is None:
+                view.index = start
+                break
+            chain.append(command)
+            group = command
+        
+        if not chain:
+            raise commands.CommandNotFound(f'Command "{word}" is not found')
+        return class_(tuple(chain), view.read_rest().strip())
+    
+    @property
+    def command(self):
+        return self.chain[-1]
+    
+    def current(self, bot):
+        """False if the command was reloaded since it was resolved"""
+        return bot.get_command(self.command.qualified_name) is self.command
+    
+    def context(self, bot, message):
+        return commands.Context(
+            bot = bot,
+            message = message,
+            view = StringView(self.args),
+            prefix = self.PREFIX,
+            command = self.command,
+            invoked_with = self.command.name,
+        )
+    
+    async def validate(self, bot, message):
+        """
+        Check that message's author could run the command, and that it
+        accepts the arguments.  Raises commands.CommandError if not.
+        """
+        ctx = self.context(bot, message)
+        for command in self.chain:
+            command._verify_checks(ctx)
+        await self.command._parse_arguments(ctx)
+    
+    async def invoke(self, bot, message):
+        """Run the command as message's author"""
+        # bot.say, bot.reply and bot.type look these up in the calling
+        #   frames, as set by bot.process_commands
+        _internal_channel = message.channel
+        _internal_author = message.author
+
+        ctx = self.context(bot, message)
+        try:
+            # Invoking the command directly skips its groups' checks
+            for command in self.chain[:-1]:
+                command._verify_checks(ctx)
+            await self.command.invoke(ctx)
+        except commands.CommandError as e:
+            self.command.dispatch_error(e, ctx)
+            raise
+
+
+
 class SavedCommand(Saved):
     """This object holds a command for the bot to execute at a certain time"""
+    __slots__ = ('invocation',)
     
-    def __init__(self, bot, cmd, when, channel, author):
-        super().__init__(bot, cmd, when, channel, author)
-            
+    def __init__(self, resolver, cmd, when, channel, author, id=None,
+                 server=None, invocation=None):
+        super().__init__(resolver, cmd, when, channel, author, id, server)
+        # Resolved when the item is scheduled, or on first run after loading
+        self.invocation = invocation
     
     async def execute(self):
         resp = await super().execute()
         if resp:
-            m = discord.Message(
+            author = self.author
+            if author is None:
+                author = await self.bot.get_user_info(self.author_id)
+            channel = self.channel
+            await self.bot.send_message(channel, 'Executing ' + \
+                f'``{self.content}`` (schedule by {author.mention})')
+            
+            message = CommandMessage(
+                id = None,
                 content = self.content,
-                channel = self.channel,
-                author = {
-                    'username': self.author.name,
-                    'discriminator': self.author.discriminator,
-                    'id': self.author.id,
-                    'bot': self.bot,
-                },
-                timestamp = datetime.datetime.now().isoformat(),
-                reactions = [],
+                channel = channel,
+                server = getattr(channel, 'server', None),
+                author = author,
+                timestamp = datetime.datetime.utcnow(),
             )
-            await self.bot.send_message(self.channel, 'Executing ' + \
-                f'``{self.content}`` (schedule by {self.author.mention})')
-            await self.bot.process_commands(m)
+            try:
+                if self.invocation is None or \
+                    not self.invocation.current(self.bot):
+                    self.invocation = Invocation.resolve(self.bot,
+                        self.content)
+                await self.invocation.invoke(self.bot, message)
+            except commands.CommandError as e:
+                await self.report(author, e)
             self._completed = True
         return resp
+    
+    async def report(self, author, error):
+        """Tell the author their command failed"""
+        try:
+            await self.bot.send_message(author, 'Your scheduled command ' + \
+                f'``{self.content}`` in <#{self.channel_id}> failed: {error}')
+        except discord.HTTPException:
+            self.bot.log.warning(f'Couldn\'t tell {author.id} that ' + \
+                f'"{self.content}" failed: {error}')
+
+
+
+
+class SavedRecurring(Saved):
+    """
+    This object holds a message or command to run repeatedly
+    rule is an iCalendar RRULE (with its DTSTART) in local time for the
+    timezone tz.  Only the next occurrence is kept, in when, so an item costs
+    the same however many times it runs.
+    """
+    __slots__ = ('rule', 'tz', '_rrule', 'invocation')
+    
+    CODEC = None
+    
+    def __str__(self):
+        author = self.author
+        name = author.name if author is not None else 'Someone'
+        every = self.rule.rpartition('RRULE:')[2]
+        return f'{name} scheduled "{self.content}" ({every}), ' + \
+            f'next on {self.when:%a, %b %d, %Y at %H:%M:%S %Z}'
+    
+    def __init__(self, resolver, content, when, channel, author, rule, tz,
+                 id=None, server=None):
+        super().__init__(resolver, content, when, channel, author, id, server)
+        self.rule = rule
+        self.tz = tz
+        self._rrule = _parse_rule(rule)
+        self.invocation = None
+    
+    @property
+    def when(self):
+        return datetime.datetime.fromtimestamp(self.timestamp,
+            timeparse.timezone(self.tz))
+    
+    @when.setter
+    def when(self, when):
+        self.timestamp = when.timestamp()
+    
+    def next_after(self, after):
+        """The first occurrence after timestamp after, or None if no more"""
+        tz = timeparse.timezone(self.tz)
+        local = datetime.datetime.fromtimestamp(after, tz).replace(tzinfo=None)
+        when = self._rrule.after(local)
+        return None if when is None else tz.localize(when)
+    
+    async def execute(self):
+        resp = await super().execute()
+        if resp:
+            args = (self.resolver, self.content, self.timestamp,
+                self.channel_id, self.author_id, self.id, self.server_id)
+            if self.content.startswith(Invocation.PREFIX):
+                # Keep the resolved command for the next occurrence
+                once = SavedCommand(*args, invocation=self.invocation)
+                await once.execute()
+                self.invocation = once.invocation
+            else:
+                await SavedMessage(*args).execute()
+        return resp
+    
+    def encode(self, more={}):
+        d = {'rule': self.rule, 'tz': self.tz}
+        d.update(more)
+        return super().encode(d)
+
+
+
+
+def _due_order(s):
+    return (s.timestamp, s.id)
+
+
+class SavedIndex:
+    """
+    Saved items grouped by a key, each group kept sorted by due time
+    Adding and removing items is O(log n), and so is finding any page
+    """
+    def __init__(self, key):
+        self.key = key
+        self.groups = {}
+    
+    def add(self, s):
+        k = self.key(s)
+        group = self.groups.get(k)
+        if group is None:
+            group = self.groups[k] = SortedKeyList(key=_due_order)
+        group.add(s)
+    
+    def remove(self, s):
+        k = self.key(s)
+        group = self.groups[k]
+        group.remove(s)
+        if not group:
+            del self.groups[k]
+    
+    def count(self, k):
+        return len(self.groups.get(k, ()))
+    
+    def page(self, k, start, count):
+        """count items for k, starting from the start'th one due"""
+        group = self.groups.get(k)
+        if group is None:
+            return []
+        return list(group.islice(start, start + count))
 
 
 
@@ -176,60 +719,232 @@ class Schedule(Extension):
         discord.ServerRegion.vip_amsterdam: 'Europe/Amsterdam',
     }
     
+    TIMEZONES = {region: timeparse.timezone(name)
+                 for region, name in TZ_CONVERT.items()}
+    
     CMD = re.compile('^!\w+\s+`(?P<content>[^`]+)`\s+(?P<when>(\w|\s)+)$')
     
+    EVERY_CMD = re.compile(
+        '^!\w+\s+every\s+`(?P<content>[^`]+)`\s+(?P<rule>.+)$', re.S)
+    
+    # 'every [n] <unit> [at <time>]', for recurring items
+    EVERY = re.compile('^(?:(?P<interval>\d+)\s+)?(?P<unit>[a-z]+?)s?' + \
+        '(?:\s+at\s+(?P<at>.+))?$', re.I)
+    
+    EVERY_FREQ = {
+        'minute': 'MINUTELY',
+        'hour':   'HOURLY',
+        'day':    'DAILY',
+        'week':   'WEEKLY',
+        'month':  'MONTHLY',
+        'year':   'YEARLY',
+    }
+    
+    EVERY_BYDAY = {
+        'monday':    'MO',
+        'tuesday':   'TU',
+        'wednesday': 'WE',
+        'thursday':  'TH',
+        'friday':    'FR',
+        'saturday':  'SA',
+        'sunday':    'SU',
+        'weekday':   'MO,TU,WE,TH,FR',
+    }
+    
     CONTENT_LIMIT = 960
     
+    # Recurring items can't fire closer together than this many seconds.
+    #   Parsed rules are checked over their first REPEAT_CHECK occurrences,
+    #   since parts like BYSECOND can fire several times a minute whatever
+    #   FREQ says.
+    MIN_REPEAT = 60
+    REPEAT_CHECK = 10
+    
+    # Items per page of a listing
+    PAGE_SIZE = 20
+    
+    # Number of items fetched from the database per round trip
+    LOAD_PAGE = 1000
+    
+    # Only items due within this many seconds are kept in memory
+    LOAD_HORIZON = 7 * 24 * 60 * 60
+    
+    # Seconds a process has to run an item it leased before another process
+    #   may take it over.  Leases on items still being run are renewed every
+    #   POLL_INTERVAL, so this only runs out if the process stops responding.
+    LEASE_TIMEOUT = 60
+    
+    # Seconds between checks of the database for due items that no process
+    #   had in memory, and for leases that ran out
+    POLL_INTERVAL = 5
+    
+    # Items that came due while the bot was down still run when it starts
+    #   up, if they're no more than this many seconds late
+    GRACE_PERIOD = 15 * 60
+    
+    # Number of late items run at once while catching up
+    CATCH_UP_WORKERS = 4
+    
     
     def __init__(self, bot, *args, **kwargs):
+        """
+        horizon     Seconds ahead to keep saved items in memory
+        grace       Seconds late an item can be and still run at startup
+        """
         super().__init__(bot)
         
         self.cal = parsedatetime.Calendar()
         
+        self.horizon = kwargs.get('horizon', self.LOAD_HORIZON)
+        self.grace = max(kwargs.get('grace', self.GRACE_PERIOD),
+            self.LEASE_TIMEOUT)
+        self.storage.codecs.register(SAVED_CODEC_V1)
+        self.storage.codecs.register(SAVED_CODEC)
+        self.resolver = Resolver(bot)
+        self.storage.register_script('schedule.claim', CLAIM_SCRIPT, 
+            _claim_emulated)
+        self.storage.register_script('schedule.complete', COMPLETE_SCRIPT,
+            _complete_emulated)
+        self.storage.register_script('schedule.renew', RENEW_SCRIPT,
+            _renew_emulated)
+        self.storage.register_script('schedule.reap', REAP_SCRIPT,
+            _reap_emulated)
+        self.storage.register_script('schedule.reschedule', 
+            RESCHEDULE_SCRIPT, _reschedule_emulated)
+        self.storage.register_script('schedule.cancel', CANCEL_SCRIPT,
+            _cancel_emulated)
+        self.storage.register_script('schedule.migrate', MIGRATE_SCRIPT,
+            _migrate_emulated)
+        self.storage.register_script('schedule.upgrade', UPGRADE_SCRIPT,
+            _upgrade_emulated)
+        
+        # Identifies this process's leases
+        self.owner = uuid.uuid4().hex
+        
         self.ready = False
         self.bot.loop.create_task(self.load())
         
-        self.indices  = {'author':{}, 'channel':{}, 'server':{}}
-        self._tasks = {}
+        self.indices = {
+            'author':         SavedIndex(lambda s: s.author_id),
+            'channel':        SavedIndex(lambda s: s.channel_id),
+            'server':         SavedIndex(lambda s: s.server_id),
+            'author_channel': SavedIndex(
+                lambda s: (s.author_id, s.channel_id)),
+            'author_server':  SavedIndex(
+                lambda s: (s.author_id, s.server_id)),
+        }
+        
+        # Saved items currently in memory, by id.  Only items due before
+        #   _window_end are loaded; later ones stay in the database until
+        #   the window slides forward.
+        self._items = {}
+        self._window_end = None
+        self._window_more = False
+        
+        # Min-heap of (timestamp, tie-breaker, Saved) waiting to be fired by
+        #   the dispatcher.  Canceled items are left in place and skipped
+        #   when they reach the top.
+        self._queue = []
+        self._queue_canceled = 0
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher = self.bot.loop.create_task(self.dispatch())
+        
+        # Items the dispatcher found due, by id, waiting to be leased.  The
+        #   claimer only starts once load() is done, and leaves items due
+        #   before _claim_since to the catch-up workers.
+        self._due = {}
+        self._claim = asyncio.Event()
+        self._claimer = None
+        self._claim_since = float('-inf')
+        self._catch_up = None
+        
+        # Items this process has leased and not yet finished, by id
+        self._in_flight = {}
+        
+        self.stats = DispatchStats(self.__class__.__name__)
+        self.bot.metrics.append(self.stats)
+    
+    async def on_channel_delete(self, channel):
+        self.resolver.forget(channel.id)
+    
+    def __unload(self):
+        self._dispatcher.cancel()
+        if self._claimer is not None:
+            self._claimer.cancel()
+        if self._catch_up is not None:
+            self._catch_up.cancel()
+        self.bot.metrics.remove(self.stats)
     
     
     def parse(self, server, message):
         """Parse a time string like 'tomorrow at 3PM' into a datetime"""
-        tz = timezone(self.TZ_CONVERT[server.region])
-        dt, _ = self.cal.parseDT(datetimeString=message)
-        return dt.astimezone(tz)
+        dt = timeparse.parse(message, self.cal)
+        return dt.astimezone(self.TIMEZONES[server.region])
+    
+    def parse_rule(self, server, message):
+        """
+        Parse a repeat like 'monday at 9AM', '2 hours' or a raw RRULE like
+        'FREQ=MONTHLY;BYMONTHDAY=1' into (rule, timezone name)
+        Raises ValueError if it can't be understood
+        """
+        tz_name = self.TZ_CONVERT[server.region]
+        start = datetime.datetime.now(self.TIMEZONES[server.region])
+        message = message.strip()
+        
+        if message.upper().startswith(('RRULE:', 'FREQ=')):
+            rule = message.upper()
+            if not rule.startswith('RRULE:'):
+                rule = 'RRULE:' + rule
+        else:
+            m = self.EVERY.match(message)
+            unit = m and m['unit'].lower()
+            interval = int(m['interval'] or 1) if m else 0
+            if unit in self.EVERY_FREQ:
+                rule = f'RRULE:FREQ={self.EVERY_FREQ[unit]};' + \
+                    f'INTERVAL={interval}'
+            elif unit in self.EVERY_BYDAY:
+                rule = f'RRULE:FREQ=WEEKLY;INTERVAL={interval};' + \
+                    f'BYDAY={self.EVERY_BYDAY[unit]}'
+            else:
+                raise ValueError(f'Unknown repeat "{message}"')
+            if interval < 1:
+                raise ValueError('The interval must be at least 1')
+            if m['at']:
+                start = self.parse(server, m['at'])
+        
+        rule = f'DTSTART:{start:%Y%m%dT%H%M00}\n{rule}'
+        times = list(itertools.islice(_parse_rule(rule), self.REPEAT_CHECK))
+        if any((b - a).total_seconds() < self.MIN_REPEAT
+               for a, b in zip(times, times[1:])):
+            raise ValueError("Can't repeat more than once a minute")
+        return rule, tz_name
         
         
     async def load(self):
-        """Load commands from a file"""
+        """
+        Load saved items from the database
+        Only items due within the horizon are loaded, a page at a time.  The
+        extension is ready as soon as the first page is in.
+        """
         await self.bot.wait_until_ready()
+        await self.storage.ready()
+        await self._db_migrate_legacy()
         
-        failed = {}
-        total_items = await self.storage.llen('saved')
-        self.log.info(f'Loading saved items ({total_items})')
-        while total_items > 0:
-            total_items -= 1
-            
-            data = await self.storage.rpop('saved')
-            cur = self.decode_saved(**json.loads(data))
-            
-            if cur.overdue:
-                if cur.channel in failed:
-                    failed[cur.channel] += 1
-                else:
-                    failed[cur.channel] = 1
-                self.log.debug(f'Ignored overdue item "{cur.content}"')
-            else:
-                self.bot.loop.create_task(self.add_saved(cur,save_db=False))
-        
+        now = time.time()
+        self._window_end = now + self.horizon
+        self._wakeup.set()
+        loaded = await self._load_window(now, self._window_end)
         self.ready = True
+        self.log.info(f'Loaded {loaded} saved items due within the horizon')
         
-        for ch in failed:
-            await self.bot.send_message(
-                ch,
-                'Apologies, but I had some downtime, and missed ' + \
-                '{} scheduled actions!'.format(failed[ch]),
-            )
+        # Items overdue by less than the grace period still get run, late
+        failed = await self._db_drop_overdue(now - self.grace)
+        self._claim_since = now
+        self._claimer = self.bot.loop.create_task(self.claim_loop())
+        self._catch_up = self.bot.loop.create_task(self.catch_up(now))
+        
+        await self._notify_missed(failed)
         
         if self.bot.debug:
             # We'll need to re-save the db after weeding out overdue actions
@@ -241,106 +956,556 @@ class Schedule(Extension):
             self.bot.loop.create_task(post_load_db_save())
     
     
-    def decode_saved(self,content,when,channel,author):
+    async def _load_pages(self, lo, hi):
+        """
+        Fetch saved items due between lo and hi (inclusive) from the database
+        Yields lists of (id, score, payload), one page at a time
+        """
+        offset = 0
+        while True:
+            page = await self.storage.zrangebyscore('due', lo, hi,
+                withscores=True, offset=offset, count=self.LOAD_PAGE)
+            if not page:
+                return
+            
+            ids = [id_ for id_, _ in page]
+            payloads = await self.storage.hmget('items', *ids, encoding=None)
+            yield [(id_, score, data)
+                   for (id_, score), data in zip(page, payloads)]
+            
+            if len(page) < self.LOAD_PAGE:
+                return
+            
+            # Continue from the last score seen, skipping the items at that
+            #   score we already have
+            last = page[-1][1]
+            ties = sum(1 for _, score in page if score == last)
+            if last == lo:
+                offset += ties
+            else:
+                lo, offset = last, ties
+    
+    async def _load_window(self, lo, hi):
+        """Load the saved items due between lo and hi into memory"""
+        loaded = 0
+        async for page in self._load_pages(lo, hi):
+            stale = []
+            for id_, _, data in page:
+                if id_ in self._items:
+                    continue
+                if data is None:
+                    self.log.warning(f'Saved item {id_} has no payload')
+                    await self.storage.zrem('due', id_)
+                    continue
+                
+                d = self.storage.codecs.decode(data)
+                s = self.decode_saved(id=id_, **d)
+                self._admit(s)
+                loaded += 1
+                
+                if not self.storage.codecs.is_current(data, s.CODEC):
+                    stale += (s.id, data,
+                        self.storage.codecs.encode(s.encode(), s.CODEC))
+            self.ready = True
+            
+            # Re-encode items written by older versions as we come across
+            #   them, unless another process ran, changed or canceled them
+            #   since they were read
+            if stale:
+                await self.storage.run_script('schedule.upgrade',
+                    keys=('due', 'items'), args=stale)
+        
+        later = await self.storage.zrangebyscore('due', hi, 
+            offset=0, count=1, exclude=self.storage.ZSET_EXCLUDE_MIN)
+        self._window_more = bool(later)
+        return loaded
+    
+    async def _slide_window(self, lo, hi):
+        """Load what the window covers after moving forward from lo to hi"""
+        loaded = await self._load_window(lo, hi)
+        self.log.debug(f'Window moved forward, loaded {loaded} saved items')
+    
+    async def _db_drop_overdue(self, before):
         """
-        Makes a new saved item
-        This coroutine will not complete until the saved item has been executed
+        Remove items that came due while the bot was down
+        Recurring items skip ahead to their next occurrence instead.
+        Returns a dict of channel: number of items dropped
         """
-        if content.startswith('!'):
+        failed = {}
+        while True:
+            # Every page gets deleted, so always start from the top
+            ids = await self.storage.zrangebyscore('due', max=before,
+                offset=0, count=self.LOAD_PAGE,
+                exclude=self.storage.ZSET_EXCLUDE_MAX)
+            if not ids:
+                break
+            
+            payloads = await self.storage.hmget_obj('items', *ids)
+            recurring = []
+            for id_, d in zip(ids, payloads):
+                if d is not None:
+                    cur = self.decode_saved(id=id_, **d)
+                    channel = cur.channel
+                    if channel is not None:
+                        failed[channel] = failed.get(channel, 0) + 1
+                    self.log.debug(f'Ignored overdue item "{cur.content}"')
+                    
+                    if isinstance(cur, SavedRecurring):
+                        when = cur.next_after(time.time())
+                        if when is not None:
+                            cur.when = when
+                            recurring.append(cur)
+            
+            async with self.storage.multi() as tr:
+                tr.zrem('due', *ids)
+                tr.hdel('items', *ids)
+                for cur in recurring:
+                    tr.hset_obj('items', cur.id, cur.encode(), cur.CODEC)
+                    tr.zadd('due', cur.timestamp, cur.id)
+            
+            for cur in recurring:
+                if cur.timestamp <= self._window_end:
+                    self._admit(cur)
+            
+            # Recurring items skipped ahead rather than being dropped
+            self.stats.missed += len(ids) - len(recurring)
+            if len(ids) < self.LOAD_PAGE:
+                break
+        return failed
+    
+    async def _notify_missed(self, failed):
+        """Apologise in every channel that missed items, all at once"""
+        async def notify(channel, count):
+            try:
+                await self.bot.send_message(
+                    channel,
+                    'Apologies, but I had some downtime, and missed ' + \
+                    f'{count} scheduled actions!',
+                )
+            except discord.HTTPException:
+                self.log.warning(f'Couldn\'t tell {channel.id} about ' + \
+                    f'{count} missed items')
+        
+        await asyncio.gather(*(notify(ch, n) for ch, n in failed.items()))
+    
+    def _window_note(self):
+        """Footer for listings when some items are past the loaded window"""
+        if not self._window_more:
+            return ''
+        end = datetime.datetime.fromtimestamp(self._window_end, pytz.utc)
+        return f'\n*Only showing actions due before {end:%a, %b %d, %Y %Z}*'
+    
+    def decode_saved(self,content,when,channel,author,id=None,server=None,
+                     rule=None,tz=None):
+        """Makes a new saved item of the right type for its content"""
+        if rule is not None:
+            return SavedRecurring(self.resolver, content, when, channel,
+                author, rule, tz, id, server)
+        if content.startswith(Invocation.PREFIX):
             t = SavedCommand
         else:
             t = SavedMessage
         
         return t(
-            self.bot,
+            self.resolver,
             content,
             when,
             channel,
             author,
+            id,
+            server,
         )
     
+    async def resolve_command(self, ctx, content):
+        """
+        Resolve the command content invokes, and check that whoever sent
+        ctx.message may run it with those arguments, so that mistakes show up
+        now rather than when it fires
+        Returns an Invocation, or None if content isn't a command.  Raises
+        commands.CommandError if it can't be run.
+        """
+        if not content.startswith(Invocation.PREFIX):
+            return None
+        invocation = Invocation.resolve(self.bot, content)
+        await invocation.validate(self.bot, ctx.message)
+        return invocation
+    
     def _indices_add(self, s):
         """Add a Saved object to the search indicies"""
         self.log.debug(f'Adding item "{s.content}" to the indicies')
-        if s.author.id in self.indices['author']:
-            self.indices['author'][s.author.id].append(s)
-        else:
-            self.indices['author'][s.author.id] = [s,]
-
-        if s.channel.id in self.indices['channel']:
-            self.indices['channel'][s.channel.id].append(s)
-        else:
-            self.indices['channel'][s.channel.id] = [s,]
-            
-        if s.channel.server.id in self.indices['server']:
-            self.indices['server'][s.channel.server.id].append(s)
-        else:
-            self.indices['server'][s.channel.server.id] = [s,]
+        for index in self.indices.values():
+            index.add(s)
             
     def _indices_remove(self, s):
         """Remove a Saved object from the search indicies"""
         self.log.debug(f'Removing item "{s.content}" from the indicies')
-        self.indices['author'][s.author.id].remove(s)
-        self.indices['channel'][s.channel.id].remove(s)
-        self.indices['server'][s.channel.server.id].remove(s)
+        for index in self.indices.values():
+            index.remove(s)
+    
+    async def _say_page(self, ctx, index, key, page, fmt):
+        """Send a page of the items in one of the indices"""
+        index = self.indices[index]
+        page = max(page, 1)
+        items = index.page(key, (page - 1) * self.PAGE_SIZE, self.PAGE_SIZE)
+        if not items:
+            await self.bot.say('No scheduled items',delete_after=6)
+            return
+        
+        pages = -(-index.count(key) // self.PAGE_SIZE)
+        footer = f'\n*Page {page} of {pages}*'
+        if page < pages:
+            footer += f' (`!{ctx.command.qualified_name} {page + 1}` ' + \
+                'for more)'
+        footer += self._window_note()
+        
+        for m in paginate((fmt(i) for i in items), footer):
+            await self.bot.say(m)
+    
+    async def _db_migrate_legacy(self):
+        """Move items from the old 'saved' list into the hash/sorted set"""
+        total_items = await self.storage.llen('saved')
+        if total_items:
+            self.log.info(f'Migrating {total_items} legacy saved items')
+        
+        # Other processes may be migrating too, so each page is re-read from
+        #   whatever is left and only moved while it's still there
+        while True:
+            page = await self.storage.lrange('saved', -self.LOAD_PAGE, -1)
+            if not page:
+                break
+            
+            args = []
+            for data in reversed(page):
+                if data is None:
+                    continue
+                s = self.decode_saved(**json.loads(data))
+                args += (data, s.id,
+                    self.storage.codecs.encode(s.encode(), 'saved'),
+                    s.timestamp)
+            await self.storage.run_script('schedule.migrate',
+                keys=('saved', 'items', 'due'), args=args)
     
-    async def _db_add_saved_item(self, s, save_db=True):
+    async def _db_add_saved_item(self, s, bgsave=True):
         """
         Save a Saved object the database
-        Note that this method will not check to see if the item is already on
-        the database, so it will create duplicates
+        The payload is stored in the 'items' hash under the item's id, and the
+        id is added to the 'due' sorted set scored by its timestamp.  Saving
+        the same item twice just overwrites it.
         """
         self.log.debug(f'Saving item "{s.content}" to the database')
-        data = json.dumps(s.encode())
         
         # Put the saved item into the database in case the bot dies
-        await self.storage.lpush('saved', data)
-        if self.bot.debug and save_db:
+        async with self.storage.multi() as tr:
+            tr.hset_obj('items', s.id, s.encode(), s.CODEC)
+            tr.zadd('due', s.timestamp, s.id)
+        if self.bot.debug and bgsave:
             await self.storage.bgsave()
         self.log.info(f'Added saved item "{s.content}"')
         
         
-    async def _db_remove_saved_item(self, s):
-        """Remove a Saved object from the database"""
+    async def _db_cancel_saved_item(self, s):
+        """
+        Remove a Saved object from the database
+        Returns True if this call removed it, and False if it was already gone
+        or leased (eg it's firing in some process right now)
+        """
         self.log.debug(f'Removing item "{s.content}" from the database')
-        data = json.dumps(s.encode())
         
-        responce = await self.storage.lrem('saved', 1, data)
+        responce = await self.storage.run_script(
+            'schedule.cancel', keys=('due', 'items'), args=(s.id,))
         
         if responce:
             self.log.info(f'Removed "{s.content}" from database')
         else:
-            e = f'Failed to remove "{s.content}" from database: ' + \
-                'no such entry'
-            self.log.warning(e)
-            raise Exception(e)
+            self.log.warning(f'Failed to remove "{s.content}" from ' + \
+                'database: no such entry')
+        return bool(responce)
+    
+    async def _db_lease_due(self, now, since=float('-inf'), count=None):
+        """
+        Lease up to count items due between since and now to this process,
+        returning their ids
+        """
+        return await self.storage.run_script('schedule.claim',
+            keys=('due', 'leases', 'leased_by'),
+            args=(now, time.time() + self.LEASE_TIMEOUT,
+                  count or self.LOAD_PAGE, self.owner, since))
+    
+    async def _db_complete_saved_item(self, s):
+        """Delete an item this process leased, once it has run"""
+        done = await self.storage.run_script('schedule.complete',
+            keys=('leases', 'leased_by', 'items'), args=(s.id, self.owner))
+        if not done:
+            self.log.warning(f'Lease on "{s.content}" ran out before it ' + \
+                'finished; it may run again elsewhere')
+        return bool(done)
+    
+    async def _db_renew_leases(self):
+        """Extend the leases on items this process is still running"""
+        ids = [*self._in_flight]
+        until = time.time() + self.LEASE_TIMEOUT
+        renewed = 0
+        for i in range(0, len(ids), self.LOAD_PAGE):
+            renewed += await self.storage.run_script('schedule.renew',
+                keys=('leases', 'leased_by'),
+                args=(until, self.owner, *ids[i:i + self.LOAD_PAGE]))
+        if renewed < len(ids):
+            self.log.warning(f'Lost the leases on {len(ids) - renewed} ' + \
+                'items before they finished; they may run again elsewhere')
+        return renewed
+    
+    async def _db_reap_leases(self, now):
+        """Put items whose leases ran out back on the due set"""
+        total = 0
+        while True:
+            reaped = await self.storage.run_script('schedule.reap',
+                keys=('leases', 'leased_by', 'due'),
+                args=(now, self.LOAD_PAGE))
+            total += reaped
+            if reaped < self.LOAD_PAGE:
+                break
+        if total:
+            self.log.warning(f'Took over {total} items from processes ' + \
+                'that stopped responding')
+        return total
         
     
-    async def _execute(self, s):
-        self.log.debug(f'Executing item "{s.content}"')
+    def _queue_push(self, s):
+        """Put a Saved object on the dispatch queue"""
+        heapq.heappush(self._queue, 
+            (s.timestamp, next(self._counter), s))
+        
+        # Only bother the dispatcher if its next deadline just moved up
+        if self._queue[0][2] is s:
+            self._wakeup.set()
+    
+    def _queue_compact(self):
+        """Drop canceled items once they make up half the queue"""
+        if self._queue_canceled * 2 > len(self._queue):
+            self._queue = [i for i in self._queue if not i[2].canceled]
+            heapq.heapify(self._queue)
+            self._queue_canceled = 0
+    
+    async def dispatch(self):
+        """
+        Fire saved items as they come due
+        One coroutine sleeps until the earliest deadline on the queue, so
+        the number of pending items doesn't cost any extra tasks or timers
+        """
+        while True:
+            while self._queue and self._queue[0][2].canceled:
+                heapq.heappop(self._queue)
+                self._queue_canceled -= 1
+            
+            deadlines = []
+            if self._queue:
+                deadlines.append(self._queue[0][0])
+            if self._window_end is not None:
+                # Slide the window once half of it has gone by
+                deadlines.append(self._window_end - self.horizon / 2)
+            
+            if deadlines:
+                timeout = max(min(deadlines) - time.time(), 0)
+            else:
+                timeout = None
+            
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            
+            now = time.time()
+            while self._queue and self._queue[0][0] <= now:
+                ts, _, s = heapq.heappop(self._queue)
+                if s.canceled:
+                    self._queue_canceled -= 1
+                elif ts != s.timestamp:
+                    # A recurring item that has since moved on
+                    continue
+                else:
+                    self._forget(s)
+                    self._due[s.id] = s
+                    self._claim.set()
+            
+            if self._window_end is not None and \
+                self._window_end - self.horizon / 2 <= now:
+                lo = self._window_end
+                self._window_end = now + self.horizon
+                self.bot.loop.create_task(
+                    self._slide_window(lo, self._window_end))
+    
+    async def claim_loop(self):
+        """
+        Lease due items from the database and run them
+        Runs whenever the dispatcher finds something due, and every
+        POLL_INTERVAL regardless, to pick up items this process never had in
+        memory (added by another process, or taken over from a dead one)
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._claim.wait(), self.POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._claim.clear()
+            
+            try:
+                # Renewing first keeps slow items from being reaped, eg when
+                #   a backlog is held up by Discord's rate limits
+                await self._db_renew_leases()
+                now = time.time()
+                await self._db_reap_leases(now)
+                await self._claim_due(now)
+            except CancelledError:
+                raise
+            except Exception:
+                self.log.exception('Failed to claim due items')
+    
+    async def _claim_due(self, now):
+        """Lease everything due by now, and start running it"""
+        while True:
+            ids = await self._db_lease_due(now, self._claim_since)
+            for s in await self._leased_items(ids):
+                self.bot.loop.create_task(self._execute(s))
+            if len(ids) < self.LOAD_PAGE:
+                break
+        
+        # Anything else that was due by now went to another process
+        for id_, s in [*self._due.items()]:
+            if s.timestamp <= now:
+                del self._due[id_]
+    
+    async def _leased_items(self, ids):
+        """The Saved objects for ids this process just leased"""
+        if not ids:
+            return []
+        
+        items = []
+        payloads = await self.storage.hmget('items', *ids, encoding=None)
+        for id_, data in zip(ids, payloads):
+            s = self._due.pop(id_, None) or self._items.get(id_)
+            if s is None and data is not None:
+                d = self.storage.codecs.decode(data)
+                s = self.decode_saved(id=id_, **d)
+            if s is None:
+                self.log.warning(f'Saved item {id_} has no payload')
+                continue
+            self._forget(s)
+            self._in_flight[id_] = s
+            items.append(s)
+        return items
+    
+    async def catch_up(self, before):
+        """
+        Run the items that came due during downtime, up to before
+        A few workers each lease one item at a time, so a long backlog
+        neither floods Discord nor holds leases it can't get to in time
+        """
+        async def worker():
+            while True:
+                ids = await self._db_lease_due(before, count=1)
+                if not ids:
+                    return
+                for s in await self._leased_items(ids):
+                    await self._execute(s, caught_up=True)
+        
         try:
-            result = await s.execute()
+            await asyncio.gather(*(worker()
+                for _ in range(self.CATCH_UP_WORKERS)))
+        except CancelledError:
+            raise
+        except Exception:
+            self.log.exception('Failed to catch up on overdue items')
+        
+        if self.stats.caught_up:
+            self.log.info(f'Caught up on {self.stats.caught_up} overdue items')
+        
+        # Anything left over is fair game for the claimer again, eg items a
+        #   dead process leased and never finished
+        self._claim_since = float('-inf')
+        self._claim.set()
+    
+    async def _execute(self, s, caught_up=False):
+        """
+        Run an item leased by this process, then delete it, or put it back
+        for its next occurrence if it's recurring
+        """
+        try:
+            if not s.canceled:
+                self.log.debug(f'Executing item "{s.content}"')
+                self.stats.observe(time.time() - s.timestamp, caught_up)
+                await s.execute()
         finally:
-            #remove the item after 
-            self._indices_remove(s)
-            await self._db_remove_saved_item(s)
+            try:
+                if isinstance(s, SavedRecurring) and not s.canceled:
+                    await self._reschedule(s)
+                else:
+                    await self._db_complete_saved_item(s)
+            finally:
+                self._in_flight.pop(s.id, None)
+    
+    async def _reschedule(self, s):
+        """Move a recurring item on to its next occurrence"""
+        when = s.next_after(max(time.time(), s.timestamp))
+        if when is None:
+            self.log.info(f'Recurring item "{s.content}" has finished')
+            await self._db_complete_saved_item(s)
+            return
         
+        s.when = when
+        payload = self.storage.codecs.encode(s.encode(), s.CODEC)
+        kept = await self.storage.run_script('schedule.reschedule',
+            keys=('leases', 'leased_by', 'items', 'due'),
+            args=(s.id, self.owner, payload, s.timestamp))
+        if not kept:
+            self.log.warning(f'Lease on "{s.content}" ran out before it ' + \
+                'finished; it may run again elsewhere')
+        elif not s.canceled and s.timestamp <= self._window_end:
+            self._admit(s)
+    
+    def _forget(self, s):
+        """Drop a saved item from memory, if it's there"""
+        if self._items.pop(s.id, None) is not None:
+            self._indices_remove(s)
+    
+    def _admit(self, s):
+        """Bring a saved item into memory and queue it for the dispatcher"""
+        # The window can load an item while add_saved is still saving it
+        if s.id in self._items:
+            return
+        self._items[s.id] = s
+        self._indices_add(s)
+        self._queue_push(s)
     
     async def add_saved(self, s, save_db=True):
         """
-        Makes a new saved item
-        This coroutine will not complete until the saved item has been executed
+        Makes a new saved item and queues it for the dispatcher
+        Items due after the in-memory window are only saved to the database,
+        and get picked up when the window reaches them
         """
         self.log.debug(f'Adding new item: "{s.content}"')
-        await self._db_add_saved_item(s, save_db)
-        self._indices_add(s)
+        if save_db:
+            await self._db_add_saved_item(s)
         
-        self._tasks[s] = \
-            self.bot.loop.create_task(self._execute(s))
+        if self._window_end is None or \
+            s.timestamp <= self._window_end:
+            self._admit(s)
+        else:
+            self._window_more = True
     
     
     def _cancel_saved(self, s):
-        self._tasks[s].cancel()
+        """Cancel a saved item before it fires"""
+        if s.canceled:
+            return
+        s.cancel()
+        self._queue_canceled += 1
+        self._queue_compact()
+        
+        # If it's already waiting to be leased it stays in _due, so that the
+        #   claimer still sees it's canceled if it wins the race
+        self._forget(s)
+        self.bot.loop.create_task(self._db_cancel_saved_item(s))
         
     
     @commands.group(pass_context=True,invoke_without_command=True)
@@ -378,18 +1543,26 @@ class Schedule(Extension):
             content = data['content']
             when = self.parse(ctx.message.server, data['when'])
             
+            try:
+                invocation = await self.resolve_command(ctx, content)
+            except commands.CommandError as e:
+                await self.bot.say(f"I can't schedule `{content}`: {e}")
+                return
+            
             saved_item = self.decode_saved(
                 content = content,
                 when = when,
                 channel = ctx.message.channel,
                 author = ctx.message.author,
             )
+            if invocation is not None:
+                saved_item.invocation = invocation
             
             self.bot.loop.create_task(self.add_saved(saved_item))
             
             await self.bot.say(
                 f'I will excute `{content}` on ' + \
-                f'{when:%a, %b %d, %Y at %H:%M:%S}', delete_after=6)
+                f'{when:%a, %b %d, %Y at %H:%M:%S %Z}', delete_after=6)
             
         else:
             await self.bot.say("I don't understand.")
@@ -399,6 +1572,72 @@ class Schedule(Extension):
             await self.bot.say(f'Try `!help {ctx.command}`')
         
         
+    @schedule.command(pass_context=True)
+    async def every(self, ctx, content:str, rule:str):
+        """
+        Schedule an action to run repeatedly
+        Works like !schedule, but with how often to repeat instead of a time:
+        [n] minutes/hours/days/weeks/months/years, a day of the week, or
+        weekday, optionally followed by "at <time>".  An iCalendar RRULE
+        works too.  Examples:
+        > !schedule every `Standup time!` monday at 9AM
+        > !schedule every `!coin` 2 hours
+        > !schedule every `Payday` FREQ=MONTHLY;BYMONTHDAY=1,15
+        """
+        await self.bot.type()
+        
+        if not self.ready:
+            mention = ctx.message.author.mention
+            await self.bot.say(
+                f"Sorry, {mention}, I'm a bit out-of-sorts right now.\n" + \
+                'Try again later')
+            return
+        
+        if len(content) > self.CONTENT_LIMIT:
+            mention = ctx.message.author.mention
+            await self.bot.say(f"Sorry {mention}, that's too long to remember.")
+            return
+        
+        data = self.EVERY_CMD.match(ctx.message.content)
+        try:
+            if not data:
+                raise ValueError('Bad format')
+            rule, tz = self.parse_rule(ctx.message.server, data['rule'])
+        except ValueError:
+            await self.bot.say("I don't understand.")
+            await self.bot.say('Make sure your command looks ' + \
+                f'like this:\n``!{ctx.command} `[some command]` ' + \
+                f'[how often]``')
+            await self.bot.say(f'Try `!help {ctx.command}`')
+            return
+        
+        try:
+            invocation = await self.resolve_command(ctx, data['content'])
+        except commands.CommandError as e:
+            await self.bot.say(f"I can't schedule `{data['content']}`: {e}")
+            return
+        
+        saved_item = self.decode_saved(
+            content = data['content'],
+            when = datetime.datetime.now(),
+            channel = ctx.message.channel,
+            author = ctx.message.author,
+            rule = rule,
+            tz = tz,
+        )
+        saved_item.invocation = invocation
+        when = saved_item.next_after(time.time())
+        if when is None:
+            await self.bot.say('That never happens!')
+            return
+        saved_item.when = when
+        
+        self.bot.loop.create_task(self.add_saved(saved_item))
+        
+        await self.bot.say(
+            f'I will excute `{saved_item.content}` repeatedly, starting ' + \
+            f'{saved_item.when:%a, %b %d, %Y at %H:%M:%S %Z}', delete_after=6)
+        
     @schedule.command(pass_context=True)
     async def delete(self, ctx):
         """Delete an upcoming scheduled action made by you"""
@@ -414,45 +1653,27 @@ class Schedule(Extension):
     
     
     @list.command(pass_context=True)
-    async def channel(self, ctx):
+    async def channel(self, ctx, page:int=1):
         """List all upcoming scheduled actions you've made in this channel"""
         self.bot.type()
-        by_author = set(self.indices['author'].get(ctx.message.author.id, []))
-        by_channel = set(self.indices['channel'].get(ctx.message.channel.id,[]))
-        items = list(by_author & by_channel)
-        items.sort(key=lambda s: s.when.timestamp())
-        if items:
-            m = '\n'.join(str(i) for i in items)
-            await self.bot.say(m)
-        else:
-            await self.bot.say('No scheduled items',delete_after=6)
-        
+        key = (ctx.message.author.id, ctx.message.channel.id)
+        await self._say_page(ctx, 'author_channel', key, page, str)
+
     @list.command(pass_context=True)
-    async def server(self, ctx):
+    async def server(self, ctx, page:int=1):
         """List all upcoming scheduled actions you've made in this server"""
         self.bot.type()
-        by_author = set(self.indices['author'].get(ctx.message.author.id, []))
-        by_server = set(self.indices['server'].get(ctx.message.server.id,[]))
-        items = list(by_author & by_server)
-        items.sort(key=lambda s: s.when.timestamp())
-        if items:
-            m = '\n'.join(i.format(True) for i in items)
-            await self.bot.say(m)
-        else:
-            await self.bot.say('No scheduled items',delete_after=6)
-        
+        key = (ctx.message.author.id, ctx.message.server.id)
+        await self._say_page(ctx, 'author_server', key, page,
+            lambda i: i.format(True))
+
     @list.command(pass_context=True)
-    async def all(self, ctx):
+    async def all(self, ctx, page:int=1):
         """List all upcoming scheduled actions you've made anywhere"""
         self.bot.type()
-        items = self.indices['author'].get(ctx.message.author.id, [])
-        items.sort(key=lambda s: s.when.timestamp())
-        if items:
-            m = '\n'.join(i.format(True, True) for i in items)
-            await self.bot.say(m)
-        else:
-            await self.bot.say('No scheduled items',delete_after=6)
-        
+        await self._say_page(ctx, 'author', ctx.message.author.id, page,
+            lambda i: i.format(True, True))
+
     @schedule.group(pass_context=True)
     async def admin(self, ctx):
         """Commands for server admins to manage scheduled actions"""
@@ -475,29 +1696,19 @@ class Schedule(Extension):
             await self.bot.say(f'Available sub-commands: `{sub_commands}`')
     
     @list.command(pass_context=True)
-    async def channel(self, ctx):
+    async def channel(self, ctx, page:int=1):
         """List all upcoming scheduled actions made in this channel"""
         self.bot.type()
-        items = self.indices['channel'].get(ctx.message.channel.id, [])
-        items.sort(key=lambda s: s.when.timestamp())
-        if items:
-            m = '\n'.join(i.format(True) for i in items)
-            await self.bot.say(m)
-        else:
-            await self.bot.say('No scheduled items',delete_after=6)
-            
+        await self._say_page(ctx, 'channel', ctx.message.channel.id, page,
+            lambda i: i.format(True))
+
     @list.command(pass_context=True)
-    async def server(self, ctx):
+    async def server(self, ctx, page:int=1):
         """List all upcoming scheduled actions made in this server"""
         self.bot.type()
-        items = self.indices['server'].get(ctx.message.server.id, [])
-        items.sort(key=lambda s: s.when.timestamp())
-        if items:
-            m = '\n'.join(i.format(True) for i in items)
-            await self.bot.say(m)
-        else:
-            await self.bot.say('No scheduled items',delete_after=6)
-        
+        await self._say_page(ctx, 'server', ctx.message.server.id, page,
+            lambda i: i.format(True))
+
     #@admin.command(pass_context=True)
     #async def delete_all(self, ctx):
         #"""Delete all upcoming scheduled actions made in this server"""
@@ -540,7 +1751,7 @@ class Schedule(Extension):
     
 
 def setup(bot):
-    bot.add_cog(Schedule(bot))
+    bot.add_cog(Schedule(bot, **bot.config.get('Schedule', {})))
 
 
 
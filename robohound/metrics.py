@@ -0,0 +1,273 @@
+"""
+metrics.py
+
+Counters and latency histograms for the bot's internals, and a small HTTP
+endpoint that serves them in the Prometheus text format
+"""
+import re
+import time
+import inspect
+import collections
+from aiohttp import web
+
+
+class Histogram:
+    """
+    Latency histogram with exponentially growing buckets
+    Bucket bounds are in seconds; the last bucket catches everything else.
+    """
+    BOUNDS = tuple(0.00005 * 2 ** i for i in range(18))
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            i = len(self.bounds)
+        self.buckets[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """Estimate the q-th quantile (0-1), interpolating within a bucket"""
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            if n and seen + n >= rank:
+                lo = self.bounds[i - 1] if i else 0.0
+                hi = self.bounds[i] if i < len(self.bounds) else lo * 2
+                return lo + (hi - lo) * (rank - seen) / n
+            seen += n
+        return self.bounds[-1]
+
+    def prometheus(self, name, labels):
+        """Lines for this histogram in the Prometheus text format"""
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.bounds + (float('inf'),), self.buckets):
+            cumulative += n
+            le = '+Inf' if bound == float('inf') else f'{bound:g}'
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class CommandStats:
+    __slots__ = ('count', 'errors', 'latency')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+
+class StorageStats:
+    """
+    Per-namespace, per-command counts, errors and latencies of Storage calls,
+    plus the keys (and key patterns) they hit most often
+    """
+    # Stop tracking the long tail of keys once there are this many
+    MAX_KEYS = 10000
+
+    # IDs in keys are folded into '*' to get patterns like 'Schedule:author:*'
+    ID = re.compile(r'[0-9a-f]{32}|\d+')
+
+    def __init__(self):
+        self.commands = collections.defaultdict(CommandStats)
+        self.keys = collections.Counter()
+        self.patterns = collections.Counter()
+        self.started = time.time()
+
+    def record(self, namespace, command, key, latency, error=False):
+        stats = self.commands[(namespace, command)]
+        stats.count += 1
+        if error:
+            stats.errors += 1
+        if latency is not None:
+            stats.latency.observe(latency)
+
+        if key is not None:
+            self.keys[key] += 1
+            self.patterns[self.ID.sub('*', key)] += 1
+            if len(self.keys) > self.MAX_KEYS:
+                self.keys = collections.Counter(
+                    dict(self.keys.most_common(self.MAX_KEYS // 2)))
+
+    def bind(self, redis, namespace, pipelined=False):
+        """Wrap a connection so the commands sent through it are recorded"""
+        return _Recorder(redis, self, namespace, pipelined)
+
+    def by_namespace(self):
+        """{namespace: CommandStats} merged over all commands"""
+        merged = {}
+        for (namespace, _), stats in self.commands.items():
+            m = merged.setdefault(namespace, CommandStats())
+            m.count += stats.count
+            m.errors += stats.errors
+            for i, n in enumerate(stats.latency.buckets):
+                m.latency.buckets[i] += n
+            m.latency.count += stats.latency.count
+            m.latency.sum += stats.latency.sum
+        return merged
+
+    def export(self):
+        """Everything as plain data, eg for JSON"""
+        return {
+            'since': self.started,
+            'commands': [{
+                'namespace': namespace,
+                'command': command,
+                'count': stats.count,
+                'errors': stats.errors,
+                'p50': stats.latency.percentile(0.5),
+                'p99': stats.latency.percentile(0.99),
+                'buckets': dict(zip(
+                    stats.latency.bounds + (float('inf'),),
+                    stats.latency.buckets)),
+            } for (namespace, command), stats in self.commands.items()],
+            'keys': dict(self.keys.most_common(100)),
+            'patterns': dict(self.patterns.most_common(100)),
+        }
+
+    def prometheus(self):
+        """Everything in the Prometheus text format"""
+        lines = [
+            '# TYPE robohound_storage_commands_total counter',
+            '# TYPE robohound_storage_errors_total counter',
+            '# TYPE robohound_storage_latency_seconds histogram',
+        ]
+        for (namespace, command), stats in sorted(self.commands.items()):
+            labels = f'namespace="{namespace}",command="{command}"'
+            lines.append(
+                f'robohound_storage_commands_total{{{labels}}} {stats.count}')
+            lines.append(
+                f'robohound_storage_errors_total{{{labels}}} {stats.errors}')
+            lines.extend(stats.latency.prometheus(
+                'robohound_storage_latency_seconds', labels))
+        return '\n'.join(lines) + '\n'
+
+
+class DispatchStats:
+    """
+    How late scheduled items fire compared to when they were due, plus how
+    many were caught up late after downtime, and how many were missed
+    """
+    # Lag is usually milliseconds, but catching up can take minutes
+    BOUNDS = tuple(0.001 * 2 ** i for i in range(22))
+
+    def __init__(self, name):
+        self.name = name
+        self.lag = Histogram(self.BOUNDS)
+        self.caught_up = 0
+        self.missed = 0
+
+    def observe(self, lag, caught_up=False):
+        self.lag.observe(max(lag, 0.0))
+        if caught_up:
+            self.caught_up += 1
+
+    def export(self):
+        """Everything as plain data, eg for JSON"""
+        return {
+            'fired': self.lag.count,
+            'caught_up': self.caught_up,
+            'missed': self.missed,
+            'p50': self.lag.percentile(0.5),
+            'p99': self.lag.percentile(0.99),
+        }
+
+    def prometheus(self):
+        """Everything in the Prometheus text format"""
+        labels = f'extension="{self.name}"'
+        lines = [
+            '# TYPE robohound_dispatch_caught_up_total counter',
+            '# TYPE robohound_dispatch_missed_total counter',
+            '# TYPE robohound_dispatch_lag_seconds histogram',
+            f'robohound_dispatch_caught_up_total{{{labels}}} {self.caught_up}',
+            f'robohound_dispatch_missed_total{{{labels}}} {self.missed}',
+        ]
+        lines.extend(self.lag.prometheus('robohound_dispatch_lag_seconds',
+                                         labels))
+        return '\n'.join(lines) + '\n'
+
+
+def _key(command, args, kwargs):
+    """The key a command acts on, or its first key if it has several"""
+    if command in ('eval', 'evalsha'):
+        # The first argument is the script or its SHA; keys are passed apart
+        keys = kwargs.get('keys', args[1] if len(args) > 1 else ())
+        key = keys[0] if keys else None
+    else:
+        key = args[0] if args else None
+    return key if isinstance(key, str) else None
+
+
+class _Recorder:
+    """Stands in for a connection, timing every command sent through it"""
+    __slots__ = ('_redis', '_stats', '_namespace', '_pipelined')
+
+    def __init__(self, redis, stats, namespace, pipelined):
+        self._redis = redis
+        self._stats = stats
+        self._namespace = namespace
+        self._pipelined = pipelined
+
+    def __getattr__(self, name):
+        attr = getattr(self._redis, name)
+        if not callable(attr):
+            return attr
+
+        stats = self._stats
+        namespace = self._namespace
+        pipelined = self._pipelined
+
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            result = attr(*args, **kwargs)
+            if not inspect.isawaitable(result):
+                return result
+
+            key = _key(name, args, kwargs)
+
+            # Queued commands only finish when the pipeline does, so they
+            #   are counted here and timed as part of the pipeline
+            if pipelined:
+                stats.record(namespace, name, key, None)
+                return result
+
+            async def timed():
+                try:
+                    value = await result
+                except Exception:
+                    stats.record(namespace, name, key,
+                                 time.perf_counter() - start, True)
+                    raise
+                stats.record(namespace, name, key, time.perf_counter() - start)
+                return value
+            return timed()
+        return call
+
+
+async def serve(sources, host='0.0.0.0', port=9100, loop=None):
+    """
+    Serve /metrics for scraping
+    sources is a list of objects with a prometheus() method; it's read on
+    every scrape, so sources can be added and removed while serving
+    """
+    async def metrics(request):
+        body = ''.join(s.prometheus() for s in sources)
+        return web.Response(text=body)
+
+    app = web.Application(loop=loop)
+    app.router.add_route('GET', '/metrics', metrics)
+    return await app.loop.create_server(app.make_handler(), host, port)
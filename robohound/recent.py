@@ -0,0 +1,121 @@
+"""
+recent.py
+
+Who posted in each channel lately, kept in memory from the bot's messages so
+moderation commands can answer without fetching history from Discord
+"""
+import time
+import itertools
+import collections
+
+
+class RecentMessages:
+    """
+    Ring buffer of the latest (author ID, message ID, time) in one channel
+    Times are when the bot saw the message, from time.time().
+    """
+    __slots__ = ('entries',)
+
+    def __init__(self, size):
+        self.entries = collections.deque(maxlen=size)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, author_id, message_id, timestamp):
+        self.entries.append((author_id, message_id, timestamp))
+
+    def resize(self, size):
+        """Keep at most size entries, dropping the oldest if need be"""
+        if size != self.entries.maxlen:
+            self.entries = collections.deque(self.entries, maxlen=size)
+
+    def authors(self, since=None):
+        """
+        Yield distinct author IDs, newest first
+        Stops at the first message from before since, if given.
+        """
+        seen = set()
+        for author_id, _, timestamp in reversed(self.entries):
+            if since is not None and timestamp < since:
+                return
+            if author_id not in seen:
+                seen.add(author_id)
+                yield author_id
+
+
+class RecentAuthors:
+    """
+    RecentMessages for every server channel the bot sees messages in
+    Each server can set how many messages its channels remember; memory for
+    a server is capped at that times its number of channels.
+    """
+    DEFAULT_SIZE = 200
+    MAX_SIZE = 5000
+
+    def __init__(self, size=DEFAULT_SIZE):
+        self.default_size = size
+        # server ID: messages remembered per channel, if not the default
+        self.sizes = {}
+        # server ID: {channel ID: RecentMessages}
+        self.servers = {}
+
+    def size(self, server_id):
+        return self.sizes.get(server_id, self.default_size)
+
+    def set_size(self, server_id, size):
+        """Change how many messages each of a server's channels remembers"""
+        size = max(1, min(size, self.MAX_SIZE))
+        if size == self.default_size:
+            self.sizes.pop(server_id, None)
+        else:
+            self.sizes[server_id] = size
+        for recent in self.servers.get(server_id, {}).values():
+            recent.resize(size)
+        return size
+
+    def record(self, message):
+        """Remember message, unless it's a private message"""
+        server = message.server
+        if server is None:
+            return
+        channels = self.servers.get(server.id)
+        if channels is None:
+            channels = self.servers[server.id] = {}
+        recent = channels.get(message.channel.id)
+        if recent is None:
+            recent = channels[message.channel.id] = \
+                RecentMessages(self.size(server.id))
+        recent.add(message.author.id, message.id, time.time())
+
+    def channel(self, channel):
+        """The RecentMessages for channel, if anything was posted there"""
+        server = getattr(channel, 'server', None)
+        if server is None:
+            return None
+        return self.servers.get(server.id, {}).get(channel.id)
+
+    def last(self, channel, n, keep=None):
+        """
+        The last n distinct authors in channel, newest first
+        If keep is given, only authors it returns true for are counted.
+        """
+        recent = self.channel(channel)
+        if recent is None:
+            return []
+        return list(itertools.islice(filter(keep, recent.authors()), n))
+
+    def since(self, channel, seconds, keep=None):
+        """The distinct authors in channel in the last seconds, like last"""
+        recent = self.channel(channel)
+        if recent is None:
+            return []
+        return list(filter(keep, recent.authors(since=time.time() - seconds)))
+
+    def forget_channel(self, channel):
+        server = getattr(channel, 'server', None)
+        if server is not None:
+            self.servers.get(server.id, {}).pop(channel.id, None)
+
+    def forget_server(self, server):
+        self.servers.pop(server.id, None)
@@ -4,131 +4,666 @@ storage.py
 Interface class between the bot/plugins and the database
 Mostly stolen from mee6
 """
+import os
+import json
+import time
+import hashlib
 import asyncio
+import logging
+import weakref
+import collections
 import aioredis
+from aioredis.util import _NOTSET
+from aioredis.pubsub import Receiver
+
+from .codecs import Codecs
+from .metrics import StorageStats
 
 class Db:
-    def __init__(self, address, loop=None):
+    """
+    Owns the pool of connections to Redis
+    Namespaces can be handed out straight away, but commands only work once
+    ready() has returned
+    """
+    # Seconds between PINGs while connected, and how long one may take
+    HEALTH_CHECK_INTERVAL = 30
+    HEALTH_CHECK_TIMEOUT = 5
+    
+    # Limits on the delay between (re)connection attempts, in seconds
+    BACKOFF_MIN = 0.5
+    BACKOFF_MAX = 30
+    
+    # Pub/sub channel CachedStorage uses to tell other processes about writes
+    INVALIDATE_CHANNEL = 'RoboHound:invalidate'
+    KEYSPACE_PATTERN = '__keyspace@*__:*'
+    
+    def __init__(self, address, loop=None, minsize=1, maxsize=10, log=None,
+                 keyspace_notifications=False):
+        """
+        keyspace_notifications  Also invalidate caches from Redis keyspace
+                                notifications, which catches writes made
+                                outside of CachedStorage.  The server must
+                                have notify-keyspace-events set (eg to 'KA').
+        """
         self._loop = loop or asyncio.get_event_loop()
-        self._loop.create_task(self.start(address))
+        self.log = log or logging.getLogger('discord.RoboHound.storage')
+        
+        self.address = address
+        self.minsize = minsize
+        self.maxsize = maxsize
+        
+        self.redis = None
+        self._ready = asyncio.Event()
+        self._loop.create_task(self.start())
+        
+        # Identifies this process's own invalidation messages
+        self._token = f'{os.getpid()}-{id(self):x}'
+        self.keyspace_notifications = keyspace_notifications
+        self._caches = weakref.WeakSet()
+        self._invalidation_task = None
+        
+        self.codecs = Codecs()
+        self.stats = StorageStats()
+        self.scripts = {}
+    
+    @property
+    def db(self):
+        return self
     
-    async def start(self, address):
-        self.redis = await aioredis.create_redis(
-            address, loop=self._loop, encoding='utf-8')
+    async def ready(self):
+        """Wait until there is a working connection to Redis"""
+        await self._ready.wait()
+    
+    async def start(self):
+        """Connect to Redis, retrying with backoff, then keep an eye on it"""
+        delay = self.BACKOFF_MIN
+        while self.redis is None:
+            try:
+                self.redis = await aioredis.create_redis_pool(
+                    self.address, minsize=self.minsize, maxsize=self.maxsize,
+                    loop=self._loop, encoding='utf-8')
+            except (OSError, aioredis.RedisError) as e:
+                self.log.warning(f"Couldn't connect to Redis ({e}), " + \
+                    f'retrying in {delay}s')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.BACKOFF_MAX)
+        
+        self.log.info(f'Connected to Redis at {self.address} ' + \
+            f'(pool of {self.minsize}-{self.maxsize})')
+        self._ready.set()
+        await self._monitor()
+    
+    async def _monitor(self):
+        """
+        PING Redis periodically
+        While it's unreachable ready() blocks, and the pool replaces its dead
+        connections as soon as a PING gets through again
+        """
+        delay = self.BACKOFF_MIN
+        while True:
+            if self._ready.is_set():
+                await asyncio.sleep(self.HEALTH_CHECK_INTERVAL)
+            else:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.BACKOFF_MAX)
+            
+            try:
+                await asyncio.wait_for(
+                    self.redis.ping(), self.HEALTH_CHECK_TIMEOUT)
+            except (OSError, asyncio.TimeoutError, aioredis.RedisError) as e:
+                if self._ready.is_set():
+                    self.log.warning(f'Lost connection to Redis ({e})')
+                    self._ready.clear()
+                continue
+            
+            if not self._ready.is_set():
+                self.log.info('Reconnected to Redis')
+                self._ready.set()
+                delay = self.BACKOFF_MIN
+    
+    async def close(self):
+        if self.redis is not None:
+            self.redis.close()
+            await self.redis.wait_closed()
     
     def get_namespace(self, n, sep=':'):
-        return Storage(n + sep, self.redis, self)
+        return Storage(n + sep, None, self)
+    
+    def register_script(self, name, source, emulate=None):
+        """
+        Make a Lua script available to Storage.run_script under name
+        emulate is an optional coroutine function (redis, keys, args) doing
+        the same thing, for backends that can't run Lua
+        """
+        script = Script(name, source, emulate)
+        self.scripts[name] = script
+        return script
+    
+    def register_cache(self, cache):
+        """Start sending invalidations for other processes' writes to cache"""
+        self._caches.add(cache)
+        if self._invalidation_task is None:
+            self._invalidation_task = \
+                self._loop.create_task(self._listen_invalidations())
+    
+    def publish_invalidation(self, key, *keys, source=None):
+        """
+        Tell every other cache, in this process (except source, which made
+        the change) and others, that these (full) keys changed
+        """
+        for k in (key,) + keys:
+            self._invalidate(k, source)
+        message = json.dumps([self._token, key, *keys])
+        return self.redis.publish(self.INVALIDATE_CHANNEL, message)
+    
+    def _invalidate(self, key, source=None):
+        for cache in self._caches:
+            if cache is not source and key.startswith(cache.namespace):
+                cache.invalidate(key[len(cache.namespace):])
+    
+    async def _listen_invalidations(self):
+        """Drop cached keys that were changed by other processes"""
+        while True:
+            await self.ready()
+            receiver = Receiver(on_close=lambda *args: receiver.stop())
+            try:
+                await self.redis.subscribe(
+                    receiver.channel(self.INVALIDATE_CHANNEL))
+                if self.keyspace_notifications:
+                    await self.redis.psubscribe(
+                        receiver.pattern(self.KEYSPACE_PATTERN))
+                
+                async for channel, message in receiver.iter(encoding='utf-8'):
+                    if channel.is_pattern:
+                        name, _ = message
+                        self._invalidate(name.decode().split('__:', 1)[1])
+                    else:
+                        token, *keys = json.loads(message)
+                        if token != self._token:
+                            for key in keys:
+                                self._invalidate(key)
+                
+            except (OSError, aioredis.RedisError) as e:
+                self.log.warning(f'Cache invalidation listener failed ({e})')
+            
+            # Anything could have changed while we weren't listening
+            for cache in self._caches:
+                cache.clear()
+            await asyncio.sleep(self.BACKOFF_MIN)
         
         
 class Storage():
-    """Adds a prefix to Redis"""
+    """
+    Adds a prefix to Redis
+    Every command returns an awaitable rather than being a coroutine itself,
+    so the same methods queue commands when used on a Pipeline
+    """
+    ZSET_EXCLUDE_MIN = aioredis.Redis.ZSET_EXCLUDE_MIN
+    ZSET_EXCLUDE_MAX = aioredis.Redis.ZSET_EXCLUDE_MAX
+    ZSET_EXCLUDE_BOTH = aioredis.Redis.ZSET_EXCLUDE_BOTH
+    
     def __getitem__(self, key):
         return self.get_namespace(key)
     
     def __init__(self, namespace, redis, parent):
         self.namespace = namespace
-        self.redis = redis
+        self._redis = redis
         self.parent = parent
+        self._pipelined = getattr(parent, '_pipelined', False)
+    
+    @property
+    def connection(self):
+        """The connection (or pipeline) commands go to"""
+        if self._redis is not None:
+            return self._redis
+        if isinstance(self.parent, Storage):
+            return self.parent.connection
+        return self.parent.redis
+    
+    @property
+    def redis(self):
+        """The connection, with every command recorded in the Db's stats"""
+        return self.db.stats.bind(
+            self.connection, self.namespace, self._pipelined)
+    
+    @property
+    def db(self):
+        """The Db this namespace belongs to"""
+        return self.parent.db
+    
+    @property
+    def codecs(self):
+        """Codec registry used by the *_obj methods"""
+        return self.db.codecs
+    
+    def ready(self):
+        """Wait until the database is ready for commands"""
+        return self.parent.ready()
         
     def get_namespace(self, n, sep=':'):
         new_n = f'{self.namespace}{n}{sep}'
-        return Storage(new_n, self.redis, self)
+        return Storage(new_n, self._redis, self)
+    
+    def pipeline(self):
+        """Batch commands in this namespace into a single write"""
+        return Pipeline(self.namespace, self.connection, self)
+    
+    def multi(self):
+        """Like pipeline, but the commands run as one MULTI/EXEC transaction"""
+        return Pipeline(self.namespace, self.connection, self, transaction=True)
+    
+    def register_script(self, name, source, emulate=None):
+        return self.db.register_script(name, source, emulate)
     
-    async def bgsave(self):
-        return await self.redis.bgsave()
+    async def run_script(self, name, keys=(), args=()):
+        """
+        Run a registered script atomically, in one round trip
+        keys are prefixed with the namespace.  The script is sent by its
+        SHA1, and only loaded into Redis when Redis doesn't know it yet.
+        """
+        script = self.db.scripts[name]
+        keys = [self.namespace + k for k in keys]
+        args = list(args)
+        try:
+            return await self.redis.evalsha(script.sha, keys, args)
+        except aioredis.ReplyError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
         
-    async def keys(self, pattern):
-        p = self.namespace + pattern
-        return await self.redis.keys(p)
+        await self.connection.script_load(script.source)
+        return await self.redis.evalsha(script.sha, keys, args)
+    
+    def cached(self, maxsize=1024, ttl=60):
+        """Wrap this namespace in a read-through CachedStorage"""
+        return CachedStorage(self, maxsize, ttl)
+    
+    def bgsave(self):
+        return self.redis.bgsave()
         
-    async def set(self, key, value, expire=0):
+    async def scan_iter(self, pattern='*', count=None):
+        """
+        Iterate over the keys in this namespace that match pattern
+        Walks the keyspace with SCAN, so Redis is never blocked the way KEYS
+        blocks it.  Keys are yielded without the namespace prefix, and may
+        repeat if the keyspace changes mid-scan.
+        """
+        match = self.namespace + pattern
+        cursor = 0
+        while True:
+            cursor, keys = await self.redis.scan(
+                cursor, match=match, count=count)
+            for key in keys:
+                yield key[len(self.namespace):]
+            if not cursor:
+                return
+        
+    def set(self, key, value, expire=0):
         key = self.namespace + key
-        return await self.redis.set(
+        return self.redis.set(
             key,
             value,
             expire=expire
         )
 
-    async def get(self, key):
+    def get(self, key, encoding=_NOTSET):
         key = self.namespace + key
-        return await self.redis.get(key)
+        return self.redis.get(key, encoding=encoding)
 
-    async def smembers(self, key):
+    def smembers(self, key):
         key = self.namespace + key
-        return await self.redis.smembers(key)
+        return self.redis.smembers(key)
 
-    async def srem(self, key, value):
+    def srem(self, key, value):
         key = self.namespace + key
-        return await self.redis.srem(key, value)
+        return self.redis.srem(key, value)
 
-    async def sadd(self, key, member, *members):
+    def sadd(self, key, member, *members):
         key = self.namespace + key
-        return await self.redis.sadd(key, member, *members)
+        return self.redis.sadd(key, member, *members)
 
-    async def delete(self, key, *keys):
+    def delete(self, key, *keys):
         key = self.namespace + key
-        return await self.redis.delete(key, *keys)
+        keys = [self.namespace + k for k in keys]
+        return self.redis.delete(key, *keys)
 
-    async def sort(self, key, *get_patterns, by=None, offset=None, count=None,
+    def sort(self, key, *get_patterns, by=None, offset=None, count=None,
                    asc=None, alpha=False, store=None):
+        """
+        SORT, with every key it touches in this namespace
+        by and get_patterns are key patterns like 'weight_*', except for the
+        special 'nosort' and '#' which are passed through unchanged.
+        """
         key = self.namespace + key
-        if by:
+        if by is not None and by != 'nosort':
             by = self.namespace + by
-        return await self.redis.sort(key, *get_patterns, by=by, offset=offset,
-                                     count=None, asc=None, alpha=False,
-                                     store=None)
+        get_patterns = [p if p == '#' else self.namespace + p
+                        for p in get_patterns]
+        if store is not None:
+            store = self.namespace + store
+        return self.redis.sort(key, *get_patterns, by=by, offset=offset,
+                                     count=count, asc=asc, alpha=alpha,
+                                     store=store)
 
-    async def ttl(self, key):
+    def ttl(self, key):
         key = self.namespace + key
-        return await self.redis.ttl(key)
+        return self.redis.ttl(key)
 
-    async def expire(self, key, timeout):
+    def expire(self, key, timeout):
         key = self.namespace + key
-        return await self.redis.expire(key, timeout)
+        return self.redis.expire(key, timeout)
 
-    async def incr(self, key):
+    def incr(self, key):
         key = self.namespace + key
-        return await self.redis.incr(key)
+        return self.redis.incr(key)
 
-    async def incrby(self, key, amount):
+    def incrby(self, key, amount):
         key = self.namespace + key
-        return await self.redis.incrby(key, amount)
+        return self.redis.incrby(key, amount)
 
-    async def setnx(self, key, value):
+    def setnx(self, key, value):
         key = self.namespace + key
-        return await self.redis.setnx(key, value)
+        return self.redis.setnx(key, value)
 
-    async def lpush(self, key, value, *values):
+    def lpush(self, key, value, *values):
         key = self.namespace + key
-        return await self.redis.lpush(key, value, *values)
+        return self.redis.lpush(key, value, *values)
 
-    async def lpop(self, key, *values):
+    def lpop(self, key, *values):
         key = self.namespace + key
-        return await self.redis.lpop(key, *values)
+        return self.redis.lpop(key, *values)
 
-    async def llen(self, key):
+    def llen(self, key):
         key = self.namespace + key
-        return await self.redis.llen(key)
+        return self.redis.llen(key)
         
-    async def lrange(self, key, start, stop):
+    def lrange(self, key, start, stop):
+        key = self.namespace + key
+        return self.redis.lrange(key, start, stop)
+
+    def lrem(self, key, count, value):
+        key = self.namespace + key
+        return self.redis.lrem(key, count, value)
+
+    def lset(self, key, index, value):
+        key = self.namespace + key
+        return self.redis.lset(key, index, value)
+
+    def ltrim(self, key, start, stop):
+        key = self.namespace + key
+        return self.redis.ltrim(key, start, stop)
+
+    def rpush(self, key, value, *values):
         key = self.namespace + key
-        return await self.redis.lrange(key, start, stop)
+        return self.redis.rpush(key, value, *values)        
 
-    async def lrem(self, key, count, value):
+    def rpop(self, key, *values):
         key = self.namespace + key
-        return await self.redis.lrem(key, count, value)
+        return self.redis.rpop(key, *values)
 
-    async def lset(self, key, index, value):
+    def hset(self, key, field, value):
         key = self.namespace + key
-        return await self.redis.lset(key, index, value)
+        return self.redis.hset(key, field, value)
 
-    async def ltrim(self, start, stop):
-        return await self.redis.ltrim(start, stop)
+    def hget(self, key, field, encoding=_NOTSET):
+        key = self.namespace + key
+        return self.redis.hget(key, field, encoding=encoding)
+
+    def hmget(self, key, field, *fields, encoding=_NOTSET):
+        key = self.namespace + key
+        return self.redis.hmget(key, field, *fields, encoding=encoding)
+
+    def hdel(self, key, field, *fields):
+        key = self.namespace + key
+        return self.redis.hdel(key, field, *fields)
+
+    def hincrby(self, key, field, increment=1):
+        key = self.namespace + key
+        return self.redis.hincrby(key, field, increment)
+
+    def hgetall(self, key, encoding=_NOTSET):
+        key = self.namespace + key
+        return self.redis.hgetall(key, encoding=encoding)
+
+    def hlen(self, key):
+        key = self.namespace + key
+        return self.redis.hlen(key)
+
+    def zadd(self, key, score, member, *pairs):
+        key = self.namespace + key
+        return self.redis.zadd(key, score, member, *pairs)
 
-    async def rpush(self, key, value, *values):
+    def zrem(self, key, member, *members):
         key = self.namespace + key
-        return await self.redis.rpush(key, value, *values)        
+        return self.redis.zrem(key, member, *members)
 
-    async def rpop(self, key, *values):
+    def zscore(self, key, member):
         key = self.namespace + key
-        return await self.redis.rpop(key, *values)
+        return self.redis.zscore(key, member)
+
+    def zcard(self, key):
+        key = self.namespace + key
+        return self.redis.zcard(key)
+
+    def zcount(self, key, min=float('-inf'), max=float('inf'), exclude=None):
+        key = self.namespace + key
+        return self.redis.zcount(key, min, max, exclude=exclude)
+
+    def zrange(self, key, start=0, stop=-1, withscores=False,
+                     encoding=_NOTSET):
+        key = self.namespace + key
+        return self.redis.zrange(key, start, stop, withscores=withscores,
+                                       encoding=encoding)
+
+    def zrangebyscore(self, key, min=float('-inf'), max=float('inf'),
+                            withscores=False, offset=None, count=None,
+                            exclude=None, encoding=_NOTSET):
+        key = self.namespace + key
+        return self.redis.zrangebyscore(key, min, max,
+                                              withscores=withscores,
+                                              offset=offset, count=count,
+                                              exclude=exclude,
+                                              encoding=encoding)
+
+    def zremrangebyscore(self, key, min=float('-inf'), max=float('inf'),
+                               exclude=None):
+        key = self.namespace + key
+        return self.redis.zremrangebyscore(key, min, max, exclude=exclude)
+
+    def zpopmin(self, key, count=None, encoding=_NOTSET):
+        """
+        Remove and return the members with the lowest scores, as a flat
+        [member, score, member, score...] list
+        """
+        key = self.namespace + key
+        return self.redis.zpopmin(key, count, encoding=encoding)
+
+    def xadd(self, key, fields, max_len=None, exact_len=False):
+        """
+        Append fields (a dict) to a stream, returning the new entry's ID
+        With max_len the stream is capped to about that many entries (exactly
+        with exact_len, which costs Redis more), oldest dropped first.
+        """
+        key = self.namespace + key
+        return self.redis.xadd(key, fields, max_len=max_len,
+                                     exact_len=exact_len)
+
+    def xrange(self, key, start='-', stop='+', count=None):
+        """Stream entries from start to stop, as [(id, fields)...]"""
+        key = self.namespace + key
+        return self.redis.xrange(key, start, stop, count=count)
+
+    def xlen(self, key):
+        key = self.namespace + key
+        return self.redis.xlen(key)
+
+    def set_obj(self, key, obj, codec=None, expire=0):
+        """Store obj under key, encoded with the named codec"""
+        return self.set(key, self.codecs.encode(obj, codec), expire=expire)
+
+    async def get_obj(self, key):
+        """Fetch and decode a value stored with set_obj"""
+        return self.codecs.decode(await self.get(key, encoding=None))
+
+    def hset_obj(self, key, field, obj, codec=None):
+        return self.hset(key, field, self.codecs.encode(obj, codec))
+
+    async def hget_obj(self, key, field):
+        return self.codecs.decode(await self.hget(key, field, encoding=None))
+
+    async def hmget_obj(self, key, field, *fields):
+        values = await self.hmget(key, field, *fields, encoding=None)
+        return [self.codecs.decode(v) for v in values]
+
+
+class Script:
+    """A Lua script, with an optional Python stand-in for the same operation"""
+    def __init__(self, name, source, emulate=None):
+        self.name = name
+        self.source = source
+        self.sha = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        self.emulate = emulate
+
+
+class Pipeline(Storage):
+    """
+    Queues namespaced commands and sends them to Redis in one write
+    Use it as an async context manager:
+    
+    >>> async with storage.pipeline() as p:
+    ...     p.set('a', 1)
+    ...     p.incr('b')
+    >>> p.results
+    [True, 1]
+    
+    Don't await commands inside the block, they only complete once it exits.
+    Namespaces taken from a pipeline queue onto the same pipeline.  The
+    get_obj style helpers need a round trip each, so aren't usable here.
+    """
+    def __init__(self, namespace, redis, parent, transaction=False):
+        if transaction:
+            pipe = redis.multi_exec()
+        else:
+            pipe = redis.pipeline()
+        super().__init__(namespace, pipe, parent)
+        self._pipelined = True
+        self._command = 'multi' if transaction else 'pipeline'
+        self.results = None
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.execute()
+    
+    async def execute(self, return_exceptions=False):
+        """Send the queued commands, returning their results in order"""
+        start = time.perf_counter()
+        try:
+            self.results = await self.connection.execute(
+                return_exceptions=return_exceptions)
+        except Exception:
+            self.db.stats.record(self.namespace, self._command, None,
+                                 time.perf_counter() - start, True)
+            raise
+        self.db.stats.record(self.namespace, self._command, None,
+                             time.perf_counter() - start)
+        return self.results
+
+
+class CachedStorage:
+    """
+    Read-through LRU cache in front of a Storage namespace
+    get() is answered from memory while an entry is younger than ttl seconds;
+    set() and delete() write through to Redis and tell other processes to
+    drop the key.  Every other command goes straight to the wrapped Storage,
+    uncached, so only use those for keys that aren't read through the cache
+    (or turn on keyspace notifications on the Db).
+    """
+    def __init__(self, storage, maxsize=1024, ttl=60):
+        self.storage = storage
+        self.namespace = storage.namespace
+        self.maxsize = maxsize
+        self.ttl = ttl
+        
+        # key: (value, expiry), least recently used first
+        self._entries = collections.OrderedDict()
+        
+        # Bumped on every invalidation, so a read that raced one isn't cached
+        self._generation = 0
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        
+        storage.db.register_cache(self)
+    
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def stats(self):
+        """Counters for sizing the cache"""
+        return {
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+    
+    def _store(self, key, value, ttl):
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def invalidate(self, key):
+        """Drop key from the cache"""
+        self._generation += 1
+        if self._entries.pop(key, None) is not None:
+            self.invalidations += 1
+    
+    def clear(self):
+        self._generation += 1
+        self._entries.clear()
+    
+    async def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        
+        self.misses += 1
+        generation = self._generation
+        value = await self.storage.get(key)
+        if generation == self._generation:
+            self._store(key, value, self.ttl)
+        return value
+    
+    async def set(self, key, value, expire=0):
+        result = await self.storage.set(key, value, expire=expire)
+        self.invalidate(key)
+        
+        # Only cache values Redis would hand back unchanged
+        if isinstance(value, str):
+            ttl = min(expire, self.ttl) if expire else self.ttl
+            self._store(key, value, ttl)
+        
+        await self.storage.db.publish_invalidation(self.namespace + key,
+            source=self)
+        return result
+    
+    async def delete(self, key, *keys):
+        result = await self.storage.delete(key, *keys)
+        for k in (key,) + keys:
+            self.invalidate(k)
+        await self.storage.db.publish_invalidation(
+            *(self.namespace + k for k in (key,) + keys), source=self)
+        return result
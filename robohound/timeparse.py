@@ -0,0 +1,151 @@
+"""
+timeparse.py
+
+Fast parsing of the time expressions people usually give !schedule
+
+Inputs are normalised (lower case, single spaces, numbers replaced by '#')
+into a template like 'tomorrow at # pm', and each template is compiled once
+into a plan that just needs the numbers filled in.  Templates that aren't one
+of the common forms below fall back to parsedatetime, and give the same
+results it would:
+
+    in 2 hours [and 30 minutes]     90 minutes from now
+    [today|tomorrow] at 7:30 PM     [on] monday [at 9AM]
+    at 19:00     7pm     noon     tonight     tomorrow
+"""
+import re
+import datetime
+import functools
+
+import parsedatetime
+import pytz
+
+
+# pytz.timezone, without repeating the zone lookup for names seen before
+timezone = functools.lru_cache(maxsize=None)(pytz.timezone)
+
+
+UNITS = {
+    'second': datetime.timedelta(seconds=1),
+    'minute': datetime.timedelta(minutes=1),
+    'hour':   datetime.timedelta(hours=1),
+    'day':    datetime.timedelta(days=1),
+    'week':   datetime.timedelta(weeks=1),
+}
+
+WEEKDAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday',
+            'saturday', 'sunday')
+
+# parsedatetime's times for bare days, and for 'tonight'
+DAY_START = datetime.time(9)
+TONIGHT = datetime.time(21)
+
+_NUMBER = re.compile(r'\d+')
+
+_TERM = '(?:#|an?) (?:' + '|'.join(UNITS) + ')s?'
+_TERMS = f'(?P<terms>{_TERM}(?:(?:,| and|, and) {_TERM})*)'
+_TIME = r'(?P<time>#(?::#)? ?[ap]m|#:#|noon)'
+
+_IN = re.compile(f'^in {_TERMS}$')
+_FROM_NOW = re.compile(f'^{_TERMS} from now$')
+_TERM_PARTS = re.compile('(#|an?) (' + '|'.join(UNITS) + ')')
+_DAY = re.compile('^(?:(?P<day>today|tomorrow)|(?:on )?(?P<weekday>' + \
+    '|'.join(WEEKDAYS) + f'))(?: at {_TIME})?$')
+_AT = re.compile(f'^(?:at )?{_TIME}$')
+
+
+def _time_of(spec, numbers):
+    """(hour, minute) from a time template and its numbers"""
+    if spec == 'noon':
+        return 12, 0
+
+    hour = next(numbers)
+    minute = next(numbers) if ':' in spec else 0
+    if spec.endswith(('am', 'pm')):
+        if not 1 <= hour <= 12:
+            raise ValueError(f'Hour {hour} out of range')
+        hour = hour % 12 + (12 if spec.endswith('pm') else 0)
+    elif not 0 <= hour <= 23:
+        raise ValueError(f'Hour {hour} out of range')
+    if not 0 <= minute <= 59:
+        raise ValueError(f'Minute {minute} out of range')
+    return hour, minute
+
+
+@functools.lru_cache(maxsize=1024)
+def compile_template(template):
+    """
+    A function(numbers, now) giving the time for inputs matching template,
+    or None if the template isn't one of the fast path's forms
+    """
+    m = _IN.match(template) or _FROM_NOW.match(template)
+    if m:
+        terms = _TERM_PARTS.findall(m['terms'])
+
+        def relative(numbers, now):
+            numbers = iter(numbers)
+            return now + sum((UNITS[unit] * (next(numbers) if n == '#' else 1)
+                              for n, unit in terms), datetime.timedelta())
+        return relative
+
+    m = _DAY.match(template) or _AT.match(template)
+    if m:
+        groups = m.groupdict()
+        day, weekday = groups.get('day'), groups.get('weekday')
+        spec = m['time']
+
+        def absolute(numbers, now):
+            date = now.date()
+            if day == 'tomorrow':
+                date += UNITS['day']
+            elif weekday is not None:
+                ahead = (WEEKDAYS.index(weekday) - date.weekday()) % 7
+                if not ahead:
+                    # Whether that's today or next week depends on the time;
+                    #   leave it to parsedatetime
+                    return None
+                date += UNITS['day'] * ahead
+
+            if spec is not None:
+                time = datetime.time(*_time_of(spec, iter(numbers)))
+            elif day is not None:
+                time = DAY_START
+            else:
+                time = now.time()
+            return datetime.datetime.combine(date, time)
+        return absolute
+
+    if template == 'tonight':
+        return lambda numbers, now: datetime.datetime.combine(now, TONIGHT)
+
+    return None
+
+
+def normalise(text):
+    """(template, numbers) for text"""
+    text = ' '.join(text.lower().split())
+    return _NUMBER.sub('#', text), [int(n) for n in _NUMBER.findall(text)]
+
+
+def parse(text, cal=None, now=None):
+    """
+    Parse a time expression into a naive datetime in the local time
+    cal is the parsedatetime.Calendar to fall back on
+    """
+    if now is None:
+        now = datetime.datetime.now().replace(microsecond=0)
+
+    template, numbers = normalise(text)
+    plan = compile_template(template)
+    if plan is not None:
+        try:
+            dt = plan(numbers, now)
+        except ValueError:
+            dt = None
+        if dt is not None:
+            return dt
+
+    if cal is None:
+        cal = parsedatetime.Calendar()
+    dt, _ = cal.parseDT(datetimeString=text, sourceTime=now)
+    return dt
@@ -5,6 +5,9 @@ Utility functions and the bot'd utility mixin class
 """
 import logging
 from math import floor
+import aiohttp
+import async_timeout
+import discord
 from discord.ext.commands import check
 
 logger = logging.getLogger('discord.RoboHound.utils')
@@ -13,23 +16,23 @@ logger.setLevel(logging.DEBUG)
 class UtilityMixin:
     """Utility methods for the bot"""
     
-    def get_user(self, ctx, member_name):
-        """Find a user by name, mention, or id in context"""
-        return discord.utils.find(
-            lambda x: member_name in (x.name,x.mention,x.nick,x.id),
-            ctx.message.server.members)
+    def get_user(self, ctx, member_name, prefix=False):
+        """
+        Find a user by name, nick, mention, or id in context
+        prefix also accepts the start of a name, if only one user's name
+        starts with it; only use it for lookups that don't act on the user
+        """
+        return self.directory.server(ctx.message.server).member(member_name,
+            prefix)
             
-    def get_role(self, ctx, role_name):
+    def get_role(self, ctx, role_name, prefix=False):
         """Find a role by name, mention, or id in context"""
-        return discord.utils.find(
-            lambda x: role_name in (x.name,x.mention,x.id),
-            ctx.message.server.members)
+        return self.directory.server(ctx.message.server).role(role_name, prefix)
     
-    def get_channel(self, ctx, channel_name):
+    def get_channel(self, ctx, channel_name, prefix=False):
         """Find a channel by name, metion, or id in context"""
-        return discord.utils.find(
-            lambda x: channel_name in (x.name,x.mention,x.id),
-            ctx.message.server.channels)
+        return self.directory.server(ctx.message.server).channel(channel_name,
+            prefix)
     
     
     async def bot_owner_get(self, message, check=None, timeout=None):
@@ -77,6 +80,28 @@ async def fetch(url):
                 return await response.text()
         
 
+def paginate(lines, footer='', limit=2000):
+    """
+    Join lines into as few messages as fit under limit characters each
+    footer is added to the last message
+    """
+    messages = []
+    m = ''
+    for line in lines:
+        if m and len(m) + len(line) + 1 > limit:
+            messages.append(m)
+            m = ''
+        m += f'\n{line}' if m else line
+    
+    if len(m) + len(footer) > limit:
+        messages.append(m)
+        m = footer.lstrip('\n')
+    else:
+        m += footer
+    messages.append(m)
+    return messages
+        
+
 def format_timedelta(td, time_format):
     """
     Format a datetime.timedelta into an human-readable string
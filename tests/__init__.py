@@ -0,0 +1,21 @@
+import asyncio
+import unittest
+
+
+class AsyncTestCase(unittest.TestCase):
+    """Gives each test its own event loop, and cleans up what's left on it"""
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        pending = asyncio.Task.all_tasks(self.loop)
+        for task in pending:
+            task.cancel()
+        if pending:
+            self.loop.run_until_complete(
+                asyncio.gather(*pending, return_exceptions=True))
+        self.loop.close()
+
+    def wait(self, coro):
+        return self.loop.run_until_complete(coro)
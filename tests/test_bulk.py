@@ -0,0 +1,192 @@
+"""
+Bulk jobs, and the moderation commands that run them one server at a time
+"""
+import asyncio
+import logging
+import unittest
+from types import SimpleNamespace
+
+from robohound.bulk import BulkJob
+from robohound.extensions.moderation import Moderation
+
+from tests import AsyncTestCase
+
+
+class BulkJobTest(AsyncTestCase):
+    def test_runs_every_item_once(self):
+        done = []
+        async def action(item):
+            await asyncio.sleep(0.001)
+            done.append(item)
+
+        job = BulkJob(action, range(20), concurrency=4, loop=self.loop)
+        self.wait(job.run())
+        self.assertEqual(sorted(done), list(range(20)))
+        self.assertEqual(job.status(), '20 of 20 done')
+
+    def test_one_action_per_bucket_at_once(self):
+        running = {}
+        most = {}
+        async def action(item):
+            bucket = item % 2
+            running[bucket] = running.get(bucket, 0) + 1
+            most[bucket] = max(most.get(bucket, 0), running[bucket])
+            await asyncio.sleep(0.001)
+            running[bucket] -= 1
+
+        job = BulkJob(action, range(12), concurrency=4,
+                      bucket=lambda item: item % 2, loop=self.loop)
+        self.wait(job.run())
+        self.assertEqual(most, {0: 1, 1: 1})
+        self.assertEqual(job.succeeded, 12)
+
+    def test_failures_are_counted(self):
+        async def action(item):
+            if item % 3 == 0:
+                raise ValueError('Missing permissions')
+            if item == 4:
+                raise KeyError
+
+        job = BulkJob(action, range(9), loop=self.loop)
+        self.wait(job.run())
+        self.assertEqual(job.status(), '9 of 9 done, 4 failed')
+        self.assertEqual(job.summary(), '9 of 9 done, 4 failed\n'
+            'Missing permissions (3)\nKeyError (1)')
+
+    def test_cancel(self):
+        done = []
+        async def action(item):
+            done.append(item)
+            if item == 1:
+                job.cancel()
+            await asyncio.sleep(0.001)
+
+        job = BulkJob(action, range(20), concurrency=2, loop=self.loop)
+        self.wait(job.run())
+        # The items already running finish, but no more are started
+        self.assertEqual(done, [0, 1])
+        self.assertTrue(job.summary().endswith('(canceled)'))
+
+    def test_progress(self):
+        reports = []
+        async def progress(job):
+            reports.append(job.finished)
+        async def action(item):
+            await asyncio.sleep(0.03)
+
+        job = BulkJob(action, range(4), concurrency=1, loop=self.loop)
+        job.PROGRESS_INTERVAL = 0.05
+        self.wait(job.run(progress))
+        self.assertTrue(reports)
+        self.assertLess(reports[-1], 4)
+
+
+class FakeBot:
+    """Just enough of a bot for Moderation.run_job, with confirmation held
+    up until confirmed is set"""
+    def __init__(self, loop):
+        self.loop = loop
+        self.said = []
+        self.confirmed = asyncio.Event(loop=loop)
+
+    async def say(self, message):
+        self.said.append(message)
+        return message
+
+    async def edit_message(self, old, message):
+        self.said.append(message)
+        return message
+
+    async def wait_for_message(self, **kwargs):
+        await self.confirmed.wait()
+        return SimpleNamespace(content=kwargs['content'])
+
+    async def delete_message(self, message):
+        pass
+
+
+class RunJobTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.bot = FakeBot(self.loop)
+        self.mod = Moderation.__new__(Moderation)
+        self.mod.bot = self.bot
+        self.mod.jobs = {}
+        self.mod.log = logging.getLogger('test')
+
+        server = SimpleNamespace(id='1')
+        self.allowed = SimpleNamespace(kick_members=True)
+        channel = SimpleNamespace(permissions_for=lambda m: self.allowed)
+        self.ctx = SimpleNamespace(message=SimpleNamespace(server=server,
+            channel=channel, author=SimpleNamespace(id='2')))
+        self.members = [SimpleNamespace(id=str(i), server=server)
+                        for i in range(Moderation.CONFIRM_OVER + 5)]
+        self.kicked = []
+
+    async def kick(self, member):
+        await asyncio.sleep(0.001)
+        self.kicked.append(member.id)
+
+    def run_job(self):
+        return self.mod.run_job(self.ctx, self.members, 'kick', 'Kicking',
+                                self.kick, 'kick_members')
+
+    def cancel(self):
+        return Moderation.cancel.callback(self.mod, self.ctx)
+
+    def test_one_job_per_server(self):
+        async def run():
+            first = self.loop.create_task(self.run_job())
+            # Let it get as far as waiting for confirmation
+            await asyncio.sleep(0.01)
+            await self.run_job()
+            self.assertTrue(self.bot.said[-1].startswith(
+                'There is already a bulk action running here'))
+
+            self.bot.confirmed.set()
+            await first
+            self.assertEqual(self.mod.jobs, {})
+
+            # Once it's done, another can run
+            await self.run_job()
+
+        self.wait(run())
+        self.assertEqual(len(self.kicked), 2 * len(self.members))
+        self.assertEqual(self.mod.jobs, {})
+
+    def test_slot_freed_when_not_confirmed(self):
+        async def unconfirmed(**kwargs):
+            return None
+        self.bot.wait_for_message = unconfirmed
+
+        self.wait(self.run_job())
+        self.assertEqual(self.mod.jobs, {})
+        self.assertEqual(self.kicked, [])
+
+    def test_cancel_needs_the_permission(self):
+        async def run():
+            job = self.loop.create_task(self.run_job())
+            await asyncio.sleep(0.01)
+
+            self.allowed.kick_members = False
+            await self.cancel()
+            self.assertEqual(self.bot.said[-1], 'Sorry, stopping this bulk '
+                'action needs the kick_members permission')
+            self.assertFalse(self.mod.jobs['1'][0].canceled)
+
+            self.allowed.kick_members = True
+            await self.cancel()
+            self.assertTrue(self.mod.jobs['1'][0].canceled)
+            self.bot.confirmed.set()
+            await job
+
+            await self.cancel()
+            self.assertEqual(self.bot.said[-1],
+                             'There is no bulk action running here')
+
+        self.wait(run())
+        self.assertEqual(self.kicked, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
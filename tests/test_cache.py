@@ -0,0 +1,131 @@
+"""
+CachedStorage in front of the embedded storage
+"""
+import time
+import asyncio
+import logging
+import unittest
+
+from robohound.embedded import EmbeddedDb
+
+from tests import AsyncTestCase
+
+
+class CachedStorageTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = EmbeddedDb(loop=self.loop, log=logging.getLogger('test'))
+        self.storage = self.db.get_namespace('Test')
+        self.cache = self.storage.cached(maxsize=3, ttl=60)
+        self.wait(self.storage.ready())
+
+    def tearDown(self):
+        self.wait(self.db.close())
+        super().tearDown()
+
+    def counts(self, cache=None):
+        stats = (cache or self.cache).stats()
+        return stats['hits'], stats['misses'], stats['evictions']
+
+    def test_hits_and_misses(self):
+        self.wait(self.storage.set('a', 'one'))
+        self.assertEqual(self.wait(self.cache.get('a')), 'one')
+        self.assertEqual(self.wait(self.cache.get('a')), 'one')
+        self.assertIsNone(self.wait(self.cache.get('missing')))
+        self.assertIsNone(self.wait(self.cache.get('missing')))
+        self.assertEqual(self.counts(), (2, 2, 0))
+
+    def test_least_recently_used_are_evicted(self):
+        for key in 'abcd':
+            self.wait(self.storage.set(key, key))
+        for key in 'abc':
+            self.wait(self.cache.get(key))
+        # a is now the most recently used, so b goes when d comes in
+        self.wait(self.cache.get('a'))
+        self.wait(self.cache.get('d'))
+        self.assertEqual(len(self.cache), 3)
+        self.assertEqual(self.counts(), (1, 4, 1))
+
+        self.wait(self.cache.get('a'))
+        self.wait(self.cache.get('b'))
+        self.assertEqual(self.counts(), (2, 5, 2))
+
+    def test_entries_expire(self):
+        self.cache.ttl = 0.05
+        self.wait(self.storage.set('a', 'one'))
+        self.wait(self.cache.get('a'))
+        self.wait(self.storage.set('a', 'two'))
+        self.assertEqual(self.wait(self.cache.get('a')), 'one')
+
+        self.wait(asyncio.sleep(0.1))
+        self.assertEqual(self.wait(self.cache.get('a')), 'two')
+        self.assertEqual(self.counts(), (1, 2, 0))
+
+    def test_writes_go_through(self):
+        self.wait(self.cache.set('a', 'one'))
+        self.assertEqual(self.wait(self.storage.get('a')), 'one')
+        self.assertEqual(self.wait(self.cache.get('a')), 'one')
+        self.assertEqual(self.counts(), (1, 0, 0))
+
+        # Values expiring in Redis don't outlive their expiry in the cache
+        self.wait(self.cache.set('b', 'two', expire=1))
+        self.assertLessEqual(self.cache._entries['b'][1] - time.monotonic(),
+                             1.01)
+
+        self.wait(self.cache.delete('a', 'b'))
+        self.assertIsNone(self.wait(self.storage.get('a')))
+        self.assertIsNone(self.wait(self.cache.get('a')))
+        self.assertIsNone(self.wait(self.cache.get('b')))
+
+    def test_writes_through_other_caches_invalidate(self):
+        other = self.db.get_namespace('Test').cached()
+        self.wait(self.cache.set('a', 'one'))
+        self.wait(self.cache.set('b', 'two'))
+        self.assertEqual(self.wait(other.get('a')), 'one')
+
+        self.wait(other.set('a', 'changed'))
+        self.wait(other.delete('b'))
+        self.assertEqual(self.wait(self.cache.get('a')), 'changed')
+        self.assertIsNone(self.wait(self.cache.get('b')))
+        self.assertEqual(self.cache.stats()['invalidations'], 2)
+
+        # Caches of other namespaces are left alone
+        unrelated = self.db.get_namespace('Other').cached()
+        self.wait(unrelated.set('a', 'unrelated'))
+        self.assertEqual(self.wait(self.cache.get('a')), 'changed')
+
+    def test_invalidations_from_other_processes(self):
+        self.wait(self.cache.set('a', 'one'))
+        self.wait(self.storage.set('a', 'changed'))
+        self.db._invalidate('Test:a')
+        self.assertEqual(self.wait(self.cache.get('a')), 'changed')
+
+    def test_reads_racing_invalidations_arent_cached(self):
+        self.wait(self.storage.set('a', 'one'))
+        get = self.storage.get
+        reading = asyncio.Event(loop=self.loop)
+        written = asyncio.Event(loop=self.loop)
+
+        async def slow_get(key, **kwargs):
+            value = await get(key, **kwargs)
+            reading.set()
+            await written.wait()
+            return value
+        self.storage.get = slow_get
+
+        async def race():
+            read = self.loop.create_task(self.cache.get('a'))
+            await reading.wait()
+            # Another process changes a while the read is on its way back
+            await self.storage.set('a', 'two')
+            self.db._invalidate('Test:a')
+            written.set()
+            return await read
+
+        self.assertEqual(self.wait(race()), 'one')
+        self.storage.get = get
+        self.assertEqual(self.wait(self.cache.get('a')), 'two')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+The codec registry, and storing objects through it
+"""
+import logging
+import unittest
+
+from robohound import codecs
+from robohound.codecs import Codecs, CodecError, StructCodec
+from robohound.embedded import EmbeddedDb
+
+from tests import AsyncTestCase
+
+
+def reminder(version=1):
+    return StructCodec('reminder', b'R',
+                       [('channel', 'S'), ('timestamp', 'd')],
+                       tail='text', version=version)
+
+
+class CodecsTest(unittest.TestCase):
+    def setUp(self):
+        self.codecs = Codecs()
+
+    def test_json_round_trip(self):
+        obj = {'a': [1, 2], 'b': 'text'}
+        data = self.codecs.encode(obj)
+        self.assertEqual(data[:2], b'J\x01')
+        self.assertEqual(self.codecs.decode(data), obj)
+        self.assertEqual(self.codecs.decode(data.decode('utf-8')), obj)
+
+    @unittest.skipIf(codecs.msgpack is None, 'msgpack is not installed')
+    def test_msgpack_round_trip(self):
+        obj = {'a': [1, 2], 'b': 'text'}
+        data = self.codecs.encode(obj, 'msgpack')
+        self.assertEqual(data[:2], b'M\x01')
+        self.assertEqual(self.codecs.decode(data), obj)
+
+    def test_struct_round_trip(self):
+        self.codecs.register(reminder())
+        obj = {'channel': '123456789012345678', 'timestamp': 1.5,
+               'text': 'ünïcode, and no length limit ' * 10}
+        self.assertEqual(self.codecs.decode(
+            self.codecs.encode(obj, 'reminder')), obj)
+
+    def test_legacy_json(self):
+        self.assertEqual(self.codecs.decode('{"a": 1}'), {'a': 1})
+        self.assertEqual(self.codecs.decode(b'{"a": 1}'), {'a': 1})
+        self.assertIsNone(self.codecs.decode(None))
+
+    def test_versions(self):
+        self.codecs.register(reminder(1))
+        old = self.codecs.encode({'channel': '1', 'timestamp': 2.0,
+                                  'text': 'x'}, 'reminder')
+        self.codecs.register(reminder(2))
+        # Registering an older version again doesn't make it current
+        self.codecs.register(reminder(1))
+
+        self.assertFalse(self.codecs.is_current(old, 'reminder'))
+        self.assertEqual(self.codecs.decode(old)['text'], 'x')
+        new = self.codecs.encode(self.codecs.decode(old), 'reminder')
+        self.assertEqual(new[:2], b'R\x02')
+        self.assertTrue(self.codecs.is_current(new, 'reminder'))
+
+    def test_errors(self):
+        with self.assertRaises(CodecError):
+            self.codecs.encode({}, 'nope')
+        with self.assertRaises(CodecError):
+            self.codecs.decode(b'Z\x01{}')
+        with self.assertRaises(CodecError):
+            self.codecs.register(StructCodec('bad', b'{', []))
+
+
+class StorageObjectTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = EmbeddedDb(loop=self.loop, log=logging.getLogger('test'))
+        self.db.codecs.register(reminder())
+        self.storage = self.db.get_namespace('Test')
+        self.wait(self.storage.ready())
+
+    def tearDown(self):
+        self.wait(self.db.close())
+        super().tearDown()
+
+    def test_objects_round_trip(self):
+        obj = {'channel': '42', 'timestamp': 3.0, 'text': 'hi'}
+        self.wait(self.storage.set_obj('one', obj, 'reminder'))
+        self.assertEqual(self.wait(self.storage.get_obj('one')), obj)
+        self.assertIsNone(self.wait(self.storage.get_obj('missing')))
+
+        self.wait(self.storage.hset_obj('many', 'a', obj, 'reminder'))
+        self.wait(self.storage.hset_obj('many', 'b', [1, 2]))
+        self.assertEqual(self.wait(self.storage.hget_obj('many', 'a')), obj)
+        self.assertEqual(self.wait(self.storage.hmget_obj('many', 'b', 'c')),
+                         [[1, 2], None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+"""
+Looking members, roles and channels up through the directory indices
+"""
+import unittest
+from types import SimpleNamespace
+
+from robohound.directory import Lookup, Directory, member_keys
+
+from tests import AsyncTestCase
+
+
+def member(id, name, nick=None, discriminator='0001', server=None):
+    return SimpleNamespace(id=id, name=name, nick=nick,
+                           discriminator=discriminator, server=server)
+
+
+class LookupTest(unittest.TestCase):
+    def setUp(self):
+        self.lookup = Lookup(prefix=True)
+        self.ronald = member('100', 'Ronald')
+        self.ronnie = member('200', 'ronnie', nick='Ron')
+        self.digits = member('300', '200')
+        for m in (self.ronald, self.ronnie, self.digits):
+            self.lookup.add(m, member_keys(m))
+
+    def test_exact_names_whatever_their_case(self):
+        self.assertIs(self.lookup.get('RONALD'), self.ronald)
+        self.assertIs(self.lookup.get(' ron '), self.ronnie)
+        self.assertIs(self.lookup.get('ronnie#0001'), self.ronnie)
+
+    def test_prefixes_only_when_asked(self):
+        self.assertIsNone(self.lookup.get('ronn'))
+        self.assertIs(self.lookup.get('ronn', prefix=True), self.ronnie)
+        self.assertIs(self.lookup.get('rona', prefix=True), self.ronald)
+
+    def test_ambiguous_prefixes(self):
+        self.assertIsNone(self.lookup.get('ro', prefix=True))
+        # A name matching exactly beats the prefixes it shares
+        self.assertIs(self.lookup.get('ron', prefix=True), self.ronnie)
+
+    def test_no_prefix_index(self):
+        lookup = Lookup()
+        lookup.add(self.ronald, member_keys(self.ronald))
+        self.assertIsNone(lookup.get('rona', prefix=True))
+        self.assertIs(lookup.get('ronald'), self.ronald)
+
+    def test_ids_and_mentions(self):
+        self.assertIs(self.lookup.get('100'), self.ronald)
+        # IDs win over names that look like them
+        self.assertIs(self.lookup.get('200'), self.ronnie)
+        self.assertIs(self.lookup.get('<@!200>'), self.ronnie)
+        self.assertIs(self.lookup.get('<@300>'), self.digits)
+        self.assertIsNone(self.lookup.get('<@400>'))
+
+    def test_shared_names(self):
+        other = member('400', 'Ronald')
+        self.lookup.add(other, member_keys(other))
+        self.assertIs(self.lookup.get('ronald'), self.ronald)
+
+        self.lookup.remove(self.ronald.id)
+        self.assertIs(self.lookup.get('ronald'), other)
+        self.assertEqual(self.lookup.shadowed, {})
+        self.assertIsNone(self.lookup.get('100'))
+
+    def test_readding_drops_old_names(self):
+        renamed = member('100', 'Donald')
+        self.lookup.add(renamed, member_keys(renamed))
+        self.assertIsNone(self.lookup.get('ronald'))
+        self.assertIsNone(self.lookup.get('rona', prefix=True))
+        self.assertIs(self.lookup.get('donald'), renamed)
+        self.assertEqual(len(self.lookup), 3)
+
+
+class DirectoryTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.server = SimpleNamespace(id='1', members=[], roles=[],
+                                      channels=[])
+        self.ronald = member('100', 'Ronald', server=self.server)
+        self.server.members.append(self.ronald)
+        self.directory = Directory()
+        self.index = self.directory.server(self.server)
+
+    def update(self, before, after):
+        self.wait(self.directory.on_member_update(before, after))
+
+    def test_nick_changes_are_indexed(self):
+        after = member('100', 'Ronald', nick='Ron', server=self.server)
+        self.update(self.ronald, after)
+        self.assertIs(self.index.member('ron'), after)
+        self.assertIs(self.index.member('ronald'), after)
+
+    def test_presence_changes_are_ignored(self):
+        after = member('100', 'Ronald', server=self.server)
+        after.status = 'idle'
+        self.update(self.ronald, after)
+        self.assertIs(self.index.member('ronald'), self.ronald)
+
+    def test_members_joining_and_leaving(self):
+        ronnie = member('200', 'ronnie', server=self.server)
+        self.server.members.append(ronnie)
+        self.wait(self.directory.on_member_join(ronnie))
+        self.assertIs(self.directory.server(self.server), self.index)
+        self.assertIs(self.index.member('ronnie'), ronnie)
+
+        self.server.members.remove(ronnie)
+        self.wait(self.directory.on_member_remove(ronnie))
+        self.assertIsNone(self.index.member('ronnie'))
+
+    def test_rebuilt_when_stale(self):
+        # Members loaded in bulk don't raise any events
+        self.server.members.append(member('200', 'ronnie',
+                                          server=self.server))
+        index = self.directory.server(self.server)
+        self.assertIsNot(index, self.index)
+        self.assertEqual(index.member('ronnie').id, '200')
+
+
+if __name__ == '__main__':
+    unittest.main()
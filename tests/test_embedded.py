@@ -0,0 +1,147 @@
+"""
+The embedded store's append-only file: replaying it, and compacting it
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from robohound.embedded import EmbeddedRedis
+
+from tests import AsyncTestCase
+
+
+# Not valid UTF-8, so kept as bytes
+BINARY = b'\xff\x00\xfe'
+
+
+class AppendOnlyFileTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'data.aof')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        super().tearDown()
+
+    def open(self):
+        redis = EmbeddedRedis(self.path)
+        self.wait(redis.open())
+        return redis
+
+    def reopen(self, redis):
+        redis.close()
+        return self.open()
+
+    async def populate(self, redis):
+        await redis.set('text', 'hello')
+        await redis.set('binary', BINARY)
+        await redis.set('counter', 1)
+        await redis.incrby('counter', 41)
+        await redis.set('gone', 'soon')
+        await redis.delete('gone')
+        await redis.set('expiring', 'later')
+        await redis.expire('expiring', 3600)
+
+        await redis.hset('hash', 'a', 'one')
+        await redis.hset('hash', 'b', BINARY)
+        await redis.hset('hash', BINARY, 'binary field')
+        await redis.hset('hash', 'c', 'dropped')
+        await redis.hdel('hash', 'c')
+        await redis.hincrby('hash', 'n', 3)
+
+        await redis.rpush('list', 'a', 'b', BINARY, 'c')
+        await redis.lpop('list')
+        await redis.lset('list', 0, 'B')
+        await redis.sadd('set', 'x', 'y', BINARY)
+        await redis.srem('set', 'y')
+
+        await redis.zadd('zset', 3, 'c', 1, 'a', 2, BINARY, 2, 'b')
+        await redis.zadd('zset', 0.5, 'c')
+        await redis.zrem('zset', 'a')
+
+        await redis.xadd('stream', {'n': '1'}, message_id='1-0')
+        await redis.xadd('stream', {'n': '2', 'data': BINARY},
+                         message_id='2-0')
+        await redis.xadd('stream', {'n': '3'}, message_id='3-0')
+        await redis.xtrim('stream', 2)
+
+    async def state(self, redis):
+        """Everything in redis, read back through its commands"""
+        state = {}
+        _, keys = await redis.scan()
+        for key in sorted(keys):
+            value = redis._get(key)
+            if isinstance(value, (str, bytes)):
+                state[key] = await redis.get(key, encoding=None)
+            elif isinstance(value, list):
+                state[key] = await redis.lrange(key, 0, -1)
+            elif isinstance(value, set):
+                state[key] = sorted(map(str, await redis.smembers(key)))
+            elif isinstance(value, dict):
+                state[key] = await redis.hgetall(key, encoding=None)
+            elif key == 'stream':
+                state[key] = await redis.xrange(key)
+            else:
+                state[key] = await redis.zrange(key, withscores=True,
+                                                encoding=None)
+        state['ttl'] = await redis.ttl('expiring')
+        return state
+
+    def test_replay(self):
+        redis = self.open()
+        self.wait(self.populate(redis))
+        before = self.wait(self.state(redis))
+
+        redis = self.reopen(redis)
+        after = self.wait(self.state(redis))
+        self.assertEqual(after, before)
+        self.assertEqual(after['binary'], BINARY)
+        self.assertEqual(after['counter'], b'42')
+        self.assertNotIn('gone', after)
+        self.assertGreater(after['ttl'], 3500)
+        self.assertEqual(after['zset'],
+                         [(b'c', 0.5), (b'b', 2), (BINARY, 2)])
+        self.assertEqual(after['stream'], [('2-0', {'n': '2', 'data': BINARY}),
+                                           ('3-0', {'n': '3'})])
+        redis.close()
+
+    def test_expired_keys_stay_gone(self):
+        redis = self.open()
+        self.wait(redis.set('a', 'one', pexpire=1))
+        time.sleep(0.01)
+        redis = self.reopen(redis)
+        self.assertIsNone(self.wait(redis.get('a')))
+        redis.close()
+
+    def test_bgsave_compacts(self):
+        redis = self.open()
+        self.wait(self.populate(redis))
+        for i in range(100):
+            self.wait(redis.set('text', f'hello {i}'))
+        self.wait(redis.set('text', 'hello'))
+        before = self.wait(self.state(redis))
+        size = os.path.getsize(self.path)
+
+        self.wait(redis.bgsave())
+        self.assertLess(os.path.getsize(self.path), size / 2)
+        self.assertEqual(self.wait(self.state(redis)), before)
+
+        # Writes after compacting are appended to the new file
+        self.wait(redis.hset('hash', 'after', 'compaction'))
+        before['hash'][b'after'] = b'compaction'
+        redis = self.reopen(redis)
+        after = self.wait(self.state(redis))
+        self.assertEqual(after, before)
+
+        # And compacting again changes nothing
+        self.wait(redis.bgsave())
+        redis = self.reopen(redis)
+        self.assertEqual(self.wait(self.state(redis)), before)
+        redis.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
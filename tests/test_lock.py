@@ -0,0 +1,175 @@
+"""
+Locking channels down and putting their permissions back from the snapshots
+"""
+import asyncio
+import logging
+import unittest
+from types import SimpleNamespace
+
+import discord
+from discord.channel import Overwrites
+
+from robohound.directory import Directory
+from robohound.embedded import EmbeddedDb
+from robohound.extensions.moderation import Moderation, permission_bits
+
+from tests import AsyncTestCase
+
+
+SEND = permission_bits(send_messages=True)
+READ = permission_bits(read_messages=True)
+REACT = permission_bits(add_reactions=True)
+SPEAK = permission_bits(speak=True)
+MODERATOR = permission_bits(manage_messages=True)
+
+
+class FakeHttp:
+    """Applies overwrite edits to the fake channels"""
+    def __init__(self, channels):
+        self.channels = channels
+        self.calls = 0
+
+    def overwrites(self, channel_id, target_id):
+        channel = self.channels[channel_id]
+        channel._permission_overwrites = [o for o in
+            channel._permission_overwrites if o.id != target_id]
+        return channel._permission_overwrites
+
+    async def edit_channel_permissions(self, channel_id, target_id, allow,
+                                       deny, type):
+        self.calls += 1
+        await asyncio.sleep(0)
+        self.overwrites(channel_id, target_id).append(
+            Overwrites(id=target_id, type=type, allow=allow, deny=deny))
+
+    async def delete_channel_permissions(self, channel_id, target_id):
+        self.calls += 1
+        self.overwrites(channel_id, target_id)
+
+
+class FakeBot:
+    def __init__(self, loop, storage, channels):
+        self.loop = loop
+        self.log = logging.getLogger('test')
+        self.storage = storage
+        self.http = FakeHttp(channels)
+        self.directory = Directory()
+        self.said = []
+
+    async def type(self):
+        pass
+
+    async def say(self, message):
+        self.said.append(message)
+        return message
+
+    async def edit_message(self, old, message):
+        self.said.append(message)
+        return message
+
+
+class LockTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        moderator = SimpleNamespace(id='50',
+            server_permissions=discord.Permissions(MODERATOR))
+        self.server = server = SimpleNamespace(id='1', members=[],
+            get_member={moderator.id: moderator}.get)
+        everyone = discord.Role(id='1', name='@everyone', server=server,
+                                permissions=SEND)
+        mods = discord.Role(id='2', name='mods', server=server,
+                            permissions=MODERATOR)
+        vip = discord.Role(id='3', name='vip', server=server, permissions=0)
+        server.roles = [everyone, mods, vip]
+        server.default_role = everyone
+
+        self.channels = {}
+        self.general = self.channel('10', 'general', discord.ChannelType.text)
+        self.vip = self.channel('11', 'vip', discord.ChannelType.text,
+            ('1', 'role', 0, READ), ('2', 'role', SEND, 0),
+            ('3', 'role', READ | SEND, 0),
+            # A member who left, and a moderator
+            ('40', 'member', READ | SEND, 0), ('50', 'member', SEND, 0))
+        self.voice = self.channel('12', 'voice', discord.ChannelType.voice,
+            ('1', 'role', SPEAK | REACT, SEND))
+        server.channels = list(self.channels.values())
+        server.get_channel = self.channels.get
+        self.original = self.overwrites()
+
+        self.db = EmbeddedDb(loop=self.loop, log=logging.getLogger('test'))
+        self.bot = FakeBot(self.loop, self.db.get_namespace(''),
+                           self.channels)
+        self.mod = Moderation(self.bot)
+        self.wait(self.mod.storage.ready())
+
+    def tearDown(self):
+        self.wait(self.db.close())
+        super().tearDown()
+
+    def channel(self, id, name, type, *overwrites):
+        channel = self.channels[id] = SimpleNamespace(id=id, name=name,
+            server=self.server, type=type, _permission_overwrites=[
+                Overwrites(id=o, type=t, allow=a, deny=d)
+                for o, t, a, d in overwrites])
+        return channel
+
+    def overwrites(self):
+        return {c.id: sorted(c._permission_overwrites)
+                for c in self.channels.values()}
+
+    def command(self, command, *channels):
+        ctx = SimpleNamespace(message=SimpleNamespace(server=self.server,
+                                                      channel=self.general))
+        self.wait(command.callback(self.mod, ctx, *channels))
+
+    def test_lock_and_unlock_all(self):
+        self.command(Moderation.lock, 'all')
+        overwrites = self.overwrites()
+        self.assertEqual(overwrites['10'], [
+            Overwrites(id='1', type='role', allow=0,
+                       deny=Moderation.LOCKED[discord.ChannelType.text])])
+        vip = {o.id: o for o in overwrites['11']}
+        self.assertTrue(vip['1'].deny & SEND)
+        self.assertEqual(vip['3'].allow, READ)
+        self.assertEqual(vip['40'].allow, READ)
+        # Moderators keep what they had
+        self.assertEqual(vip['2'].allow, SEND)
+        self.assertEqual(vip['50'].allow, SEND)
+        voice = overwrites['12'][0]
+        self.assertEqual(voice.allow, REACT)
+        self.assertTrue(voice.deny & SPEAK)
+
+        self.command(Moderation.unlock, 'all')
+        self.assertEqual(self.overwrites(), self.original)
+        self.assertEqual(self.wait(self.mod.storage.hgetall('locked:1')), {})
+
+    def test_locking_twice_keeps_the_first_snapshot(self):
+        self.command(Moderation.lock)
+        calls = self.bot.http.calls
+        self.command(Moderation.lock)
+        self.assertEqual(self.bot.http.calls, calls)
+        self.assertTrue(self.bot.said[-1].startswith('Nothing to lock'))
+
+        self.command(Moderation.unlock)
+        self.assertEqual(self.overwrites(), self.original)
+
+    def test_unlock_some(self):
+        self.command(Moderation.lock, 'all')
+        self.command(Moderation.unlock, 'vip')
+        self.assertEqual(self.overwrites()['11'], self.original['11'])
+        self.assertNotEqual(self.overwrites()['10'], self.original['10'])
+        self.assertEqual(sorted(self.wait(
+            self.mod.storage.hgetall('locked:1'))), ['10', '12'])
+
+        self.command(Moderation.unlock, 'vip')
+        self.assertTrue(self.bot.said[-1].startswith('Nothing to unlock'))
+
+    def test_deleted_channels_are_forgotten(self):
+        self.command(Moderation.lock, 'all')
+        del self.channels['12']
+        self.command(Moderation.unlock, 'all')
+        self.assertEqual(self.wait(self.mod.storage.hgetall('locked:1')), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+"""
+Purging messages: bulk deletes for recent messages, one at a time for old
+ones, and how far back a purge looks
+"""
+import datetime
+import unittest
+from types import SimpleNamespace
+
+import discord
+
+from robohound.extensions.moderation import Purge
+
+from tests import AsyncTestCase
+
+
+def error(kind):
+    return kind(SimpleNamespace(status=403, reason='Nope'), 'Nope')
+
+
+class FakeBot:
+    """Channel history and the deletes made from it"""
+    def __init__(self, loop, history):
+        self.loop = loop
+        # Newest first, like Discord hands it back
+        self.history = history
+        self.scan_limits = []
+        self.bulk = []
+        self.single = []
+        self.fail = None
+
+    async def logs_from(self, channel, limit=100, before=None):
+        self.scan_limits.append(limit)
+        for message in self.history[:limit]:
+            yield message
+
+    async def delete_messages(self, messages):
+        if self.fail is not None:
+            raise self.fail
+        assert 2 <= len(messages) <= Purge.BULK_LIMIT
+        self.bulk.append([m.id for m in messages])
+
+    async def delete_message(self, message):
+        if self.fail is not None:
+            raise self.fail
+        self.single.append(message.id)
+
+    async def edit_message(self, old, content):
+        return content
+
+
+class PurgeTest(AsyncTestCase):
+    def history(self, recent=0, old=0, author='a'):
+        """recent messages from the last day, then old ones from 20 days ago"""
+        now = datetime.datetime.utcnow()
+        messages = []
+        for i in range(recent + old):
+            age = datetime.timedelta(days=1 if i < recent else 20, seconds=i)
+            messages.append(SimpleNamespace(id=str(len(messages)),
+                author=SimpleNamespace(id=author), timestamp=now - age))
+        return messages
+
+    def purge(self, history, limit, authors=None):
+        self.bot = FakeBot(self.loop, history)
+        purge = Purge(self.bot, SimpleNamespace(id='1'), limit, authors)
+        self.wait(purge.run())
+        return purge
+
+    def test_recent_messages_in_batches(self):
+        purge = self.purge(self.history(recent=250), 1000)
+        self.assertEqual([len(b) for b in self.bot.bulk], [100, 100, 50])
+        self.assertEqual(sum(self.bot.bulk, []),
+                         [str(i) for i in range(250)])
+        self.assertEqual(self.bot.single, [])
+        self.assertEqual(purge.deleted, 250)
+        self.assertEqual(purge.status(),
+                         'Deleted 250 of 250 messages looked at')
+
+    def test_old_messages_one_at_a_time(self):
+        purge = self.purge(self.history(recent=120, old=3), 1000)
+        self.assertEqual([len(b) for b in self.bot.bulk], [100, 20])
+        self.assertEqual(self.bot.single, ['120', '121', '122'])
+        self.assertEqual(purge.deleted, 123)
+
+    def test_a_single_recent_message(self):
+        # Bulk deletes need at least two messages
+        self.purge(self.history(recent=1), 10)
+        self.assertEqual((self.bot.bulk, self.bot.single), ([], ['0']))
+
+    def test_limit_counts_matching_messages(self):
+        history = self.history(recent=30, author='a')
+        for i, message in enumerate(history):
+            if i % 3:
+                message.author.id = 'b'
+        purge = self.purge(history, 5, authors={'a'})
+        self.assertEqual(sum(self.bot.bulk, []),
+                         ['0', '3', '6', '9', '12'])
+        self.assertEqual(purge.scanned, 13)
+        self.assertEqual(purge.matched, 5)
+
+    def test_scan_limit(self):
+        history = self.history(recent=Purge.SCAN_LIMIT + 50, author='b')
+        history[-1].author.id = 'a'
+        purge = self.purge(history, 10, authors={'a'})
+        self.assertEqual(self.bot.scan_limits, [Purge.SCAN_LIMIT])
+        self.assertEqual(purge.scanned, Purge.SCAN_LIMIT)
+        self.assertEqual(purge.deleted, 0)
+        self.assertEqual((self.bot.bulk, self.bot.single), ([], []))
+
+    def test_failures(self):
+        self.bot = FakeBot(self.loop, self.history(recent=150, old=2))
+        self.bot.fail = error(discord.NotFound)
+        purge = Purge(self.bot, SimpleNamespace(id='1'), 1000)
+        self.wait(purge.run())
+        self.assertEqual((purge.deleted, purge.failed), (0, 152))
+        self.assertTrue(purge.status().endswith(
+            '(152 could not be deleted)'))
+
+        # Not being allowed to delete anything stops the purge
+        self.bot = FakeBot(self.loop, self.history(recent=150))
+        self.bot.fail = error(discord.Forbidden)
+        purge = Purge(self.bot, SimpleNamespace(id='1'), 1000)
+        with self.assertRaises(discord.Forbidden):
+            self.wait(purge.run())
+
+
+if __name__ == '__main__':
+    unittest.main()
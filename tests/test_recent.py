@@ -0,0 +1,122 @@
+"""
+Remembering who posted recently in each channel
+"""
+import unittest
+from unittest import mock
+from types import SimpleNamespace
+
+from robohound.recent import RecentAuthors, RecentMessages
+
+
+class RecentAuthorsTest(unittest.TestCase):
+    def setUp(self):
+        self.recent = RecentAuthors(size=5)
+        self.servers = [SimpleNamespace(id=str(i)) for i in range(2)]
+        self.channels = [SimpleNamespace(id=f'{s.id}{c}', server=s)
+                         for s in self.servers for c in range(2)]
+        self.now = 1000.0
+        self.ids = 0
+
+    def post(self, channel, author, at=None):
+        self.ids += 1
+        message = SimpleNamespace(id=str(self.ids), server=channel.server,
+            channel=channel, author=SimpleNamespace(id=author))
+        with mock.patch('time.time', return_value=at or self.now):
+            self.recent.record(message)
+
+    def last(self, channel, n=10, keep=None):
+        return self.recent.last(channel, n, keep)
+
+    def test_last_distinct_authors(self):
+        channel = self.channels[0]
+        for author in 'abacb':
+            self.post(channel, author)
+        self.assertEqual(self.last(channel), ['b', 'c', 'a'])
+        self.assertEqual(self.last(channel, 2), ['b', 'c'])
+        self.assertEqual(self.last(channel, keep=lambda a: a != 'c'),
+                         ['b', 'a'])
+        self.assertEqual(self.last(self.channels[1]), [])
+
+    def test_private_messages_are_ignored(self):
+        channel = SimpleNamespace(id='dm', server=None)
+        self.post(channel, 'a')
+        self.assertEqual(self.recent.servers, {})
+        self.assertEqual(self.last(channel), [])
+
+    def test_sizes(self):
+        one, other = self.channels[0], self.channels[2]
+        for author in 'abcdefg':
+            self.post(one, author)
+            self.post(other, author)
+        # Only the last 5 messages are kept
+        self.assertEqual(self.last(one), ['g', 'f', 'e', 'd', 'c'])
+
+        # Shrinking a server's size drops the oldest messages there only
+        self.assertEqual(self.recent.set_size(one.server.id, 2), 2)
+        self.assertEqual(self.last(one), ['g', 'f'])
+        self.assertEqual(len(self.last(other)), 5)
+
+        # New channels in the server get its size too
+        self.post(self.channels[1], 'a')
+        self.assertEqual(
+            self.recent.channel(self.channels[1]).entries.maxlen, 2)
+
+        # Going back to the default forgets the server's own size
+        self.recent.set_size(one.server.id, 5)
+        self.assertEqual(self.recent.sizes, {})
+        self.assertEqual(self.recent.size(one.server.id), 5)
+
+    def test_sizes_are_clamped(self):
+        server = self.servers[0].id
+        self.assertEqual(self.recent.set_size(server, 10 ** 9),
+                         RecentAuthors.MAX_SIZE)
+        self.assertEqual(self.recent.size(server), RecentAuthors.MAX_SIZE)
+        self.assertEqual(self.recent.set_size(server, 0), 1)
+        self.assertEqual(self.recent.set_size(server, -5), 1)
+
+    def test_since(self):
+        channel = self.channels[0]
+        self.post(channel, 'a', at=self.now - 100)
+        self.post(channel, 'b', at=self.now - 50)
+        self.post(channel, 'c', at=self.now - 10)
+        self.post(channel, 'b', at=self.now - 5)
+
+        def since(seconds, keep=None):
+            with mock.patch('time.time', return_value=self.now):
+                return self.recent.since(channel, seconds, keep)
+        self.assertEqual(since(20), ['b', 'c'])
+        self.assertEqual(since(60), ['b', 'c'])
+        self.assertEqual(since(60, keep=lambda a: a != 'b'), ['c'])
+        self.assertEqual(since(1000), ['b', 'c', 'a'])
+        self.assertEqual(since(1), [])
+
+    def test_forget(self):
+        for channel in self.channels:
+            self.post(channel, 'a')
+        self.recent.forget_channel(self.channels[0])
+        self.assertEqual(self.last(self.channels[0]), [])
+        self.assertEqual(self.last(self.channels[1]), ['a'])
+
+        self.recent.forget_server(self.servers[0])
+        self.assertNotIn(self.servers[0].id, self.recent.servers)
+        self.assertEqual(self.last(self.channels[2]), ['a'])
+
+        # Forgetting what was never seen is fine
+        self.recent.forget_channel(SimpleNamespace(id='dm', server=None))
+        self.recent.forget_server(self.servers[0])
+
+
+class RecentMessagesTest(unittest.TestCase):
+    def test_resize_keeps_the_newest(self):
+        recent = RecentMessages(4)
+        for i in range(4):
+            recent.add(str(i), str(i), i)
+        recent.resize(2)
+        self.assertEqual(list(recent.authors()), ['3', '2'])
+        recent.resize(3)
+        recent.add('4', '4', 4)
+        self.assertEqual(list(recent.authors()), ['4', '3', '2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,255 @@
+"""
+Loading, indexing and parsing in the schedule extension, with a stand-in bot
+on top of the embedded storage
+"""
+import json
+import asyncio
+import datetime
+import time
+import logging
+import unittest
+from types import SimpleNamespace
+
+import discord
+from dateutil import rrule
+
+from robohound.embedded import EmbeddedDb
+from robohound.extensions.schedule import Schedule, SavedIndex, \
+    SAVED_CODEC_V1
+
+from benchmarks.schedule import FakeBot, random_item, wait_loaded
+from tests import AsyncTestCase
+
+
+class ScheduleTestCase(AsyncTestCase):
+    # Settings for the Schedule under test
+    LOAD_PAGE = 50
+
+    def setUp(self):
+        super().setUp()
+        self.db = EmbeddedDb(loop=self.loop, log=logging.getLogger('test'))
+        self.bot = FakeBot(self.loop, self.db.get_namespace(''))
+        self.storage = self.bot.storage.get_namespace('Schedule')
+        self.wait(self.storage.ready())
+        self.sched = None
+
+    def tearDown(self):
+        if self.sched is not None:
+            self.sched._Schedule__unload()
+        self.wait(self.db.close())
+        super().tearDown()
+
+    def start(self):
+        """Start a Schedule and wait for it to load"""
+        # Storage is namespaced by class name, so no subclassing; loading
+        #   only starts once the loop runs
+        self.sched = Schedule(self.bot)
+        self.sched.LOAD_PAGE = self.LOAD_PAGE
+        self.wait(wait_loaded(self.sched))
+        return self.sched
+
+    def channel(self):
+        return next(iter(self.bot.channels.values()))
+
+    def author(self):
+        return self.bot.authors[0]
+
+
+class MigrationTest(ScheduleTestCase):
+    def test_legacy_items_are_moved(self):
+        channel = self.channel()
+        # Spread over more than one page, and due beyond the horizon, so they
+        #   stay in the database
+        base = time.time() + 2 * Schedule.LOAD_HORIZON
+        legacy = [json.dumps({'content': f'reminder {i}', 'when': base + i,
+            'channel': channel.id, 'author': self.author().id})
+            for i in range(2 * self.LOAD_PAGE + 10)]
+        self.wait(self.storage.rpush('saved', *legacy))
+
+        self.start()
+        self.assertEqual(self.wait(self.storage.llen('saved')), 0)
+        self.assertEqual(self.wait(self.storage.hlen('items')), len(legacy))
+        self.assertEqual(self.wait(self.storage.zcard('due')), len(legacy))
+
+        due = self.wait(self.storage.zrange('due', 0, 0, withscores=True))
+        self.assertEqual(due[0][1], base)
+        item = self.sched.decode_saved(id=due[0][0],
+            **self.wait(self.storage.hget_obj('items', due[0][0])))
+        self.assertEqual(item.content, 'reminder 0')
+        self.assertEqual(item.server_id, channel.server.id)
+
+
+class LoadTest(ScheduleTestCase):
+    def test_old_versions_are_reencoded(self):
+        channel = self.channel()
+        self.db.codecs.register(SAVED_CODEC_V1)
+        now = time.time()
+        for i in range(3):
+            self.wait(self.storage.hset_obj('items', str(i),
+                {'content': f'reminder {i}', 'when': now + 60 + i,
+                 'channel': channel.id, 'author': self.author().id},
+                'saved'))
+            self.wait(self.storage.zadd('due', now + 60 + i, str(i)))
+        old = self.wait(self.storage.hget('items', '0', encoding=None))
+        self.assertEqual(old[:2], b's\x01')
+
+        sched = self.start()
+        self.assertEqual(sorted(sched._items), ['0', '1', '2'])
+        self.assertEqual(sched._items['0'].server_id, channel.server.id)
+        for data in self.wait(self.storage.hmget('items', '0', '1', '2',
+                                                 encoding=None)):
+            self.assertTrue(self.db.codecs.is_current(data, 'saved'))
+        self.assertEqual(self.wait(self.storage.hget_obj('items', '0'))
+                         ['server'], channel.server.id)
+
+    def test_overdue_items(self):
+        channel = self.channel()
+        late = time.time() - 2 * Schedule.GRACE_PERIOD
+        item = {'when': late, 'channel': channel.id,
+                'author': self.author().id, 'server': channel.server.id}
+        start = datetime.datetime.utcfromtimestamp(late)
+        rule = f'DTSTART:{start:%Y%m%dT%H%M00}\nRRULE:FREQ=HOURLY'
+        items = {'once': dict(item, content='once'),
+                 'twice': dict(item, content='twice'),
+                 'hourly': dict(item, content='hourly', rule=rule,
+                                tz='UTC')}
+        for id_, d in items.items():
+            self.wait(self.storage.hset_obj('items', id_, d))
+            self.wait(self.storage.zadd('due', late, id_))
+
+        sched = self.start()
+        # The recurring item moves on to its next occurrence, rather than
+        #   being dropped and counted as missed
+        self.assertEqual(sched.stats.missed, 2)
+        self.assertEqual(self.wait(self.storage.zrange('due')), ['hourly'])
+        self.assertEqual(sorted(self.wait(self.storage.hgetall('items'))),
+                         ['hourly'])
+        self.assertGreater(sched._items['hourly'].timestamp, time.time())
+
+    def test_pages_of_tied_scores(self):
+        sched = self.start()
+        later = time.time() + 2 * Schedule.LOAD_HORIZON
+        # More than a page of ties at the start of the range, and again in
+        #   the middle of it, with a page boundary inside each run of ties
+        scores = [later] * 120 + [later + 1] * 7 + [later + 2] * 130 + \
+            [later + 3] * 3
+        for i, score in enumerate(scores):
+            self.wait(self.storage.zadd('due', score, f'item {i:03}'))
+
+        async def load(lo, hi):
+            return [id_ for page in [p async for p in sched._load_pages(
+                lo, hi)] for id_, _, _ in page]
+
+        ids = self.wait(load(later, later + 3))
+        self.assertEqual(sorted(ids), [f'item {i:03}' for i in range(260)])
+        self.assertEqual(len(ids), 260)
+        self.assertEqual(len(self.wait(load(later + 2, later + 2))), 130)
+        self.assertEqual(self.wait(load(later + 4, later + 5)), [])
+
+
+class SavedIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = SavedIndex(lambda s: s.author_id)
+
+    def item(self, id, timestamp, author='a'):
+        s = SimpleNamespace(id=id, timestamp=timestamp, author_id=author)
+        self.index.add(s)
+        return s
+
+    def ids(self, key, start=0, count=10):
+        return [s.id for s in self.index.page(key, start, count)]
+
+    def test_due_order(self):
+        self.item('c', 30)
+        self.item('b', 10)
+        self.item('z', 20)
+        # Ties are broken by id
+        self.item('a', 20)
+        self.item('x', 5, author='other')
+        self.assertEqual(self.ids('a'), ['b', 'a', 'z', 'c'])
+        self.assertEqual(self.ids('other'), ['x'])
+        self.assertEqual(self.index.count('a'), 4)
+
+    def test_pages(self):
+        for i in range(7):
+            self.item(str(i), i)
+        self.assertEqual(self.ids('a', 0, 3), ['0', '1', '2'])
+        self.assertEqual(self.ids('a', 3, 3), ['3', '4', '5'])
+        self.assertEqual(self.ids('a', 6, 3), ['6'])
+        self.assertEqual(self.ids('a', 7, 3), [])
+        self.assertEqual(self.ids('nobody'), [])
+        self.assertEqual(self.index.count('nobody'), 0)
+
+    def test_remove(self):
+        first = self.item('1', 10)
+        same_time = self.item('2', 10)
+        self.index.remove(first)
+        self.assertEqual(self.ids('a'), ['2'])
+        self.index.remove(same_time)
+        self.assertEqual(self.index.groups, {})
+
+
+class IndexedItemsTest(ScheduleTestCase):
+    def indexed(self, sched, s):
+        return [name for name, index in sched.indices.items()
+                if s in index.page(index.key(s), 0, index.count(index.key(s)))]
+
+    def test_canceled_and_completed_items_leave_the_indices(self):
+        sched = self.start()
+        fired = []
+        self.bot.on_send = lambda content, when: fired.append(content)
+
+        soon = random_item(sched, self.bot, time.time() + 0.05)
+        later = random_item(sched, self.bot, time.time() + 3600)
+        for s in (soon, later):
+            self.wait(sched.add_saved(s))
+            self.assertEqual(self.indexed(sched, s), list(sched.indices))
+
+        sched._cancel_saved(later)
+        self.assertEqual(self.indexed(sched, later), [])
+
+        async def fire():
+            while not fired:
+                await asyncio.sleep(0.01)
+        self.wait(asyncio.wait_for(fire(), 2))
+        self.assertEqual(fired, [soon.content])
+        self.assertEqual(self.indexed(sched, soon), [])
+        self.assertTrue(all(not index.groups
+                            for index in sched.indices.values()))
+
+
+class ParseRuleTest(unittest.TestCase):
+    def setUp(self):
+        self.sched = Schedule.__new__(Schedule)
+        self.server = SimpleNamespace(region=discord.ServerRegion.us_east)
+
+    def parse(self, message):
+        return self.sched.parse_rule(self.server, message)
+
+    def test_repeats(self):
+        rule, tz = self.parse('2 hours')
+        self.assertEqual(tz, 'US/Eastern')
+        self.assertTrue(rule.endswith('\nRRULE:FREQ=HOURLY;INTERVAL=2'))
+        rule, _ = self.parse('freq=monthly;bymonthday=1')
+        self.assertTrue(rule.endswith('\nRRULE:FREQ=MONTHLY;BYMONTHDAY=1'))
+        rule, _ = self.parse('FREQ=MINUTELY')
+        times = list(rrule.rrulestr(rule, forceset=False)[:2])
+        self.assertEqual((times[1] - times[0]).total_seconds(), 60)
+
+    def test_once_a_minute_at_most(self):
+        for message in ('FREQ=SECONDLY', 'RRULE:FREQ=SECONDLY;INTERVAL=30',
+                        'FREQ=MINUTELY;BYSECOND=0,10,20,30,40,50',
+                        'FREQ=HOURLY;BYMINUTE=5;BYSECOND=0,30'):
+            with self.assertRaisesRegex(ValueError, 'once a minute'):
+                self.parse(message)
+        # Once a minute, just not on the minute, is fine
+        self.parse('FREQ=MINUTELY;BYSECOND=30')
+
+    def test_bad_repeats(self):
+        for message in ('fortnightly', '0 days', 'FREQ=SOMETIMES'):
+            with self.assertRaises(ValueError):
+                self.parse(message)
+
+
+if __name__ == '__main__':
+    unittest.main()
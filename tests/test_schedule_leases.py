@@ -0,0 +1,188 @@
+"""
+Lease scripts of the schedule extension, run through their emulations
+against the embedded storage, and lease renewal in a running Schedule
+"""
+import time
+import asyncio
+import logging
+import unittest
+
+from robohound.embedded import EmbeddedDb
+from robohound.extensions import schedule
+from robohound.extensions.schedule import Schedule
+
+from tests import AsyncTestCase
+
+
+SCRIPTS = {
+    'claim': (schedule.CLAIM_SCRIPT, schedule._claim_emulated),
+    'complete': (schedule.COMPLETE_SCRIPT, schedule._complete_emulated),
+    'renew': (schedule.RENEW_SCRIPT, schedule._renew_emulated),
+    'reap': (schedule.REAP_SCRIPT, schedule._reap_emulated),
+    'reschedule': (schedule.RESCHEDULE_SCRIPT, schedule._reschedule_emulated),
+    'cancel': (schedule.CANCEL_SCRIPT, schedule._cancel_emulated),
+    'migrate': (schedule.MIGRATE_SCRIPT, schedule._migrate_emulated),
+    'upgrade': (schedule.UPGRADE_SCRIPT, schedule._upgrade_emulated),
+}
+
+
+class LeaseScriptTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.db = EmbeddedDb(loop=self.loop, log=logging.getLogger('test'))
+        self.storage = self.db.get_namespace('Schedule')
+        for name, (source, emulate) in SCRIPTS.items():
+            self.storage.register_script(name, source, emulate)
+        self.wait(self.storage.ready())
+
+        # a and b are due by 50, c isn't
+        for id_, when in (('a', 10), ('b', 20), ('c', 100)):
+            self.wait(self.storage.zadd('due', when, id_))
+            self.wait(self.storage.hset('items', id_, f'payload {id_}'))
+
+    def tearDown(self):
+        self.wait(self.db.close())
+        super().tearDown()
+
+    def script(self, name, keys, *args):
+        return self.wait(self.storage.run_script(name, keys=keys, args=args))
+
+    def claim(self, now, until, owner, count=10, since='-inf'):
+        return self.script('claim', ('due', 'leases', 'leased_by'),
+                           now, until, count, owner, since)
+
+    def complete(self, id_, owner):
+        return self.script('complete', ('leases', 'leased_by', 'items'),
+                           id_, owner)
+
+    def reap(self, now, count=10):
+        return self.script('reap', ('leases', 'leased_by', 'due'), now, count)
+
+    def renew(self, until, owner, *ids):
+        return self.script('renew', ('leases', 'leased_by'), until, owner,
+                           *ids)
+
+    def due(self):
+        return self.wait(self.storage.zrange('due'))
+
+    def test_claim_complete_reap_round_trip(self):
+        self.assertEqual(self.claim(50, 60, 'one'), ['a', 'b'])
+        self.assertEqual(self.due(), ['c'])
+        self.assertEqual(self.wait(self.storage.zrange('leases',
+            withscores=True)), [('a', 60), ('b', 60)])
+
+        # Only the owner can complete, which deletes the item
+        self.assertEqual(self.complete('a', 'two'), 0)
+        self.assertEqual(self.complete('a', 'one'), 1)
+        self.assertIsNone(self.wait(self.storage.hget('items', 'a')))
+
+        # b's lease hasn't run out at 59, but has at 61
+        self.assertEqual(self.reap(59), 0)
+        self.assertEqual(self.reap(61), 1)
+        self.assertEqual(self.wait(self.storage.zrange('due',
+            withscores=True)), [('b', 61), ('c', 100)])
+        self.assertEqual(self.wait(self.storage.hgetall('leased_by')), {})
+
+        # Once reaped, the old owner can't complete it, and it's still there
+        #   for another process to claim
+        self.assertEqual(self.complete('b', 'one'), 0)
+        self.assertEqual(self.wait(self.storage.hget('items', 'b')),
+                         'payload b')
+        self.assertEqual(self.claim(70, 80, 'two'), ['b'])
+        self.assertEqual(self.complete('b', 'two'), 1)
+
+    def test_claim_limits(self):
+        self.assertEqual(self.claim(50, 60, 'one', count=1), ['a'])
+        self.assertEqual(self.claim(50, 60, 'one', since=15), ['b'])
+        self.assertEqual(self.claim(50, 60, 'one'), [])
+
+    def test_renew_keeps_leases_from_the_reaper(self):
+        self.claim(50, 60, 'one')
+        self.assertEqual(self.renew(90, 'one', 'a', 'b'), 2)
+        self.assertEqual(self.renew(120, 'two', 'a'), 0)
+        self.assertEqual(self.reap(61), 0)
+        self.assertEqual(self.reap(91), 2)
+        self.assertEqual(self.renew(150, 'one', 'a', 'b'), 0)
+
+    def test_reschedule_needs_the_lease(self):
+        self.claim(50, 60, 'one')
+        keys = ('leases', 'leased_by', 'items', 'due')
+        self.assertEqual(self.script('reschedule', keys, 'a', 'two',
+                                     'new a', 200), 0)
+        self.assertEqual(self.script('reschedule', keys, 'a', 'one',
+                                     'new a', 200), 1)
+        self.assertEqual(self.due(), ['c', 'a'])
+        self.assertEqual(self.wait(self.storage.hget('items', 'a')), 'new a')
+
+    def test_cancel_only_waiting_items(self):
+        self.claim(50, 60, 'one')
+        self.assertEqual(self.script('cancel', ('due', 'items'), 'a'), 0)
+        self.assertEqual(self.script('cancel', ('due', 'items'), 'c'), 1)
+        self.assertIsNone(self.wait(self.storage.hget('items', 'c')))
+
+    def test_migrate_only_moves_the_tail(self):
+        self.wait(self.storage.rpush('saved', 'x', 'y', 'z'))
+        keys = ('saved', 'items', 'due')
+        # Another process took z after this one read the list
+        self.wait(self.storage.rpop('saved'))
+        self.assertEqual(self.script('migrate', keys, 'z', 'id z', 'z', 1,
+                                     'y', 'id y', 'y', 30), 0)
+        self.assertEqual(self.wait(self.storage.llen('saved')), 2)
+
+        self.assertEqual(self.script('migrate', keys, 'y', 'id y', 'y', 30,
+                                     'x', 'id x', 'x', 40), 2)
+        self.assertEqual(self.wait(self.storage.llen('saved')), 0)
+        self.assertEqual(self.wait(self.storage.hget('items', 'id x')), 'x')
+        self.assertEqual(self.due(), ['a', 'b', 'id y', 'id x', 'c'])
+
+    def test_upgrade_only_waiting_unchanged_items(self):
+        self.claim(15, 60, 'one')
+        self.wait(self.storage.hset('items', 'b', 'changed b'))
+        self.assertEqual(self.script('upgrade', ('due', 'items'),
+            'a', 'payload a', 'new a', 'b', 'payload b', 'new b',
+            'c', 'payload c', 'new c', 'd', 'payload d', 'new d'), 1)
+        # a is leased, b changed since it was read, and d is gone
+        self.assertEqual(self.wait(self.storage.hmget('items', 'a', 'b', 'c',
+            'd')), ['payload a', 'changed b', 'new c', None])
+
+
+class LeaseRenewalTest(AsyncTestCase):
+    """Items that take longer than a lease to run only fire once"""
+    def test_slow_items_fire_once(self):
+        from benchmarks.schedule import FakeBot, random_item, wait_loaded
+
+        class QuickSchedule(Schedule):
+            LEASE_TIMEOUT = 0.5
+            POLL_INTERVAL = 0.1
+
+        async def run():
+            db = EmbeddedDb(loop=self.loop, log=logging.getLogger('test'))
+            storage = db.get_namespace('')
+            await storage.ready()
+            bot = FakeBot(self.loop, storage)
+
+            fired = []
+            async def send_message(channel, content):
+                fired.append(content)
+                await asyncio.sleep(1.5)
+            bot.send_message = send_message
+
+            sched = QuickSchedule(bot)
+            await wait_loaded(sched)
+            for _ in range(3):
+                await sched.add_saved(
+                    random_item(sched, bot, time.time() + 0.1))
+            await asyncio.sleep(2.5)
+
+            sched._Schedule__unload()
+            await db.close()
+            return fired, sched._in_flight
+
+        fired, in_flight = self.wait(run())
+        self.assertEqual(len(fired), 3)
+        self.assertEqual(len(set(fired)), 3)
+        self.assertEqual(in_flight, {})
+
+
+if __name__ == '__main__':
+    unittest.main()